@@ -0,0 +1,120 @@
+"""
+    Module to prepare a sharded background, used to make synthetic datasets
+"""
+
+import json
+import logging
+
+from mutacc.parse.path_parse import make_dir, parse_path
+from mutacc.utils.bam_handler import bin_read_names
+from mutacc.utils.fastq_handler import write_fastq_shards
+from mutacc.utils.read_names import ReadNameBins
+
+LOG = logging.getLogger(__name__)
+
+# Index of the shards, and map of read names to shards, in a background directory
+BACKGROUND_INDEX = "mutacc_background.json"
+BACKGROUND_NAMES = "mutacc_background.names"
+
+# Size (bp) of the genomic bins the reads are sharded on
+BIN_SIZE = 1000000
+
+
+def prepare_background(bam_file, fastq_files, out_dir, bin_size=BIN_SIZE, tmp_dir=None,
+                       threads=1, reference=None):
+
+    """
+        Splits the background fastq files into shards of the reads aligned to
+        each genomic bin, so that synthetic datasets only need to search the
+        shards holding the reads of the variants. Each read pair is placed in the
+        bin of its leftmost alignment in the background bam file, and reads not
+        placed in the bam file are put in a last shard.
+
+        Args:
+            bam_file (str): path to background bam or cram file
+            fastq_files (list(str)): paths to background fastq files, one per read end
+            out_dir (Path): directory where the sharded background is written
+            bin_size (int): size of each bin in bp
+            tmp_dir (Path): directory for temporary files
+            threads (int): number of threads used for BGZF decompression
+            reference (str): path to reference fasta, used to decode a cram file
+        Returns:
+            index_file (Path): path to the index of the sharded background
+    """
+
+    bam_file = parse_path(bam_file)
+    fastq_files = [parse_path(fastq_file) for fastq_file in fastq_files]
+    out_dir = make_dir(out_dir)
+    names_file = out_dir.joinpath(BACKGROUND_NAMES)
+
+    LOG.info("Placing the reads of %s in bins of %s bp", bam_file, bin_size)
+    read_name_bins, contigs = bin_read_names(bam_file, bin_size, spill_dir=tmp_dir,
+                                             threads=threads, reference=reference)
+    with read_name_bins:
+        read_name_bins.save(names_file)
+
+    unplaced = contigs[-1][2] + contigs[-1][1] // bin_size + 1 if contigs else 0
+
+    out_names = []
+    members = []
+    with ReadNameBins.load(names_file) as read_name_bins:
+        for fastq_file in fastq_files:
+            out_name = fastq_file.name.split(".")[0] + ".fastq.gz"
+            LOG.info("Splitting %s into shards", fastq_file)
+            members.append(write_fastq_shards(
+                fastq_file,
+                lambda read_name: read_name_bins.get(read_name, unplaced),
+                out_dir.joinpath(out_name),
+                tmp_dir=tmp_dir
+            ))
+            out_names.append(out_name)
+
+    # The read ends have the same shards, unless a read end is missing reads
+    shards = sorted(set().union(*members))
+    index = {
+        "bam_file": str(bam_file.resolve()),
+        "bin_size": bin_size,
+        "contigs": [list(contig) for contig in contigs],
+        "fastq_files": out_names,
+        "names_file": BACKGROUND_NAMES,
+        "shards": [
+            {"bin": shard,
+             "members": [list(end_members.get(shard, (0, 0))) for end_members in members]}
+            for shard in shards
+        ],
+    }
+
+    index_file = out_dir.joinpath(BACKGROUND_INDEX)
+    with open(index_file, "w") as index_handle:
+        json.dump(index, index_handle)
+
+    log_msg = f"Sharded background with {len(shards)} shards written to {out_dir}"
+    LOG.info(log_msg)
+
+    return index_file
+
+
+def load_background(background_dir):
+
+    """
+        Reads the index of a sharded background
+
+        Args:
+            background_dir (Path): directory of sharded background
+        Returns:
+            background (dict): background with keys 'bam_file', 'fastq_files',
+                'shards' and 'names_file', as given to mutacc.builds.build_dataset.Dataset
+    """
+
+    background_dir = parse_path(background_dir, file_type='dir')
+    with open(background_dir.joinpath(BACKGROUND_INDEX), "r") as index_handle:
+        index = json.load(index_handle)
+
+    return {
+        "bam_file": index["bam_file"],
+        "fastq_files": [
+            str(background_dir.joinpath(fastq_file)) for fastq_file in index["fastq_files"]
+        ],
+        "shards": index["shards"],
+        "names_file": str(background_dir.joinpath(index["names_file"])),
+    }
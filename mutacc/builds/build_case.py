@@ -19,7 +19,17 @@ class Case(dict):
     """
 
     def __init__(
-        self, input_case, read_dir, padding=None, sv_padding=None, picard_exe=None, vcf_parse=None
+        self,
+        input_case,
+        read_dir,
+        padding=None,
+        sv_padding=None,
+        picard_exe=None,
+        vcf_parse=None,
+        workers=1,
+        threads=1,
+        reference=None,
+        index_fastq=False,
     ):
 
         """
@@ -34,6 +44,13 @@ class Case(dict):
                                alignment file.
                 picard_exe(str): path to picard executable
                 vcf_parse(str): path to yaml file with vcf parsing information
+                workers(int): number of processes used to build the samples,
+                              and to search their alignment and fastq files
+                threads(int): number of threads used for compression and
+                              decompression, shared by all files
+                reference(str): path to reference fasta, used to decode cram files
+                index_fastq(bool): if True, an index of the read names is built for each
+                                   fastq file without one, to be used by later extractions
         """
 
         super(Case, self).__init__()
@@ -46,11 +63,22 @@ class Case(dict):
 
         # Build samples
         self["samples"] = self._build_samples(
-            read_dir=read_dir, padding=padding, picard_exe=picard_exe
+            read_dir=read_dir,
+            padding=padding,
+            picard_exe=picard_exe,
+            workers=workers,
+            threads=threads,
+            reference=reference,
+            index_fastq=index_fastq,
         )
         # Build case
         self["case"] = self.input_case["case"]
 
+        # Throughput metrics of the fastq scan of each sample
+        self.metrics = {
+            sample["sample_id"]: sample.metrics for sample in self["samples"] if sample.metrics
+        }
+
     def _build_variants(self, padding=None, sv_padding=None, vcf_parse=None):
         """
             Method that parses the vcf in the case dictionary.
@@ -80,7 +108,16 @@ class Case(dict):
 
         return variant_objects
 
-    def _build_samples(self, read_dir, padding=None, picard_exe=None):
+    def _build_samples(
+        self,
+        read_dir,
+        padding=None,
+        picard_exe=None,
+        workers=1,
+        threads=1,
+        reference=None,
+        index_fastq=False,
+    ):
         """
             Method makes a list of sample objects, ready to load into a mongodb. This includes
             looking for the raw reads responsible for the variants in the vcf for each sample,
@@ -90,6 +127,13 @@ class Case(dict):
 
                 read_dir(pathlib.Path): Path to directory where the new fastq files are to be
                 stored.
+                workers(int): number of processes used to build the samples,
+                              and to search their alignment and fastq files
+                threads(int): number of threads used for compression and
+                              decompression, shared by all files
+                reference(str): path to reference fasta, used to decode cram files
+                index_fastq(bool): if True, an index of the read names is built for each
+                                   fastq file without one
         """
 
         date_str = time.strftime("%Y-%m-%d")
@@ -103,6 +147,10 @@ class Case(dict):
             padding=padding,
             picard_exe=picard_exe,
             case_dir=case_dir,
+            workers=workers,
+            threads=threads,
+            reference=reference,
+            index_fastq=index_fastq,
         ):
 
             sample_objects.append(sample)
@@ -2,12 +2,15 @@
     Module to build synthetic dataset
 """
 
+from contextlib import ExitStack
 import logging
 import os
+import warnings
 
 from mutacc.utils.bam_handler import BAMContext
-from mutacc.subprocessing.exclude_from_fastq import exclude_from_fastq
-from mutacc.subprocessing.merge_fastqs import merge_fastqs as merge_fastqs_sub
+from mutacc.utils.fastq_handler import fastq_exclude_many, fastq_exclude_shards_many
+from mutacc.utils.read_names import ReadNameBins
+from mutacc.utils.process_pool import process_pool
 from mutacc.parse.path_parse import parse_path
 
 LOG = logging.getLogger(__name__)
@@ -20,126 +23,281 @@ class Dataset():
     """
 
     def __init__(self, samples, variants, tmp_dir, background, member, out_dir,
-                 seqkit_exe=None, save_background=True):
+                 seqkit_exe=None, save_background=True, threads=1, reference=None,
+                 workers=1, make_fastqs=True):
         """
             Args:
                 samples (mutacc.utils.pedigree.Individual): list of samples. sample
                     is parsed with the Individual class
                 regions (list(dict)): list of regions. Each region is
                     represented as a dictionary with keys 'chrom', 'start', 'end'
+                background (dict): background with keys 'bam_file' and 'fastq_files',
+                    and 'shards' and 'names_file' if the background is sharded
+                seqkit_exe (str): deprecated and ignored, seqkit is no longer
+                    used. Will be removed in the next release
+                save_background (bool): If true, the backgrounds with excluded
+                    reads are also written to tmp_dir
+                threads (int): number of threads used for compression and
+                    decompression
+                reference (str): path to reference fasta, used to decode a
+                    background cram file
+                workers (int): number of processes used to make the synthetic
+                    fastq files of paired end reads concurrently
+                make_fastqs (bool): if False, the synthetic fastq files are made
+                    later, e.g. together with other datasets by make_datasets
         """
+        if seqkit_exe is not None:
+            warnings.warn("seqkit_exe is deprecated and ignored, seqkit is no longer used",
+                          DeprecationWarning, stacklevel=2)
         self.samples = samples
         self.variants = variants
         self.tmp_dir = tmp_dir
         self.background = background
         self.member = member
+        self.threads = threads
+        self.reference = reference
+        self.workers = workers
 
-        self.excluded_backgrounds = self.exclude_from_background(seqkit_exe=seqkit_exe)
-        self.synthetic_fastqs = self.merge_fastqs(out_dir=out_dir,
-                                                  save_background=save_background)
+        self.excluded_backgrounds = []
+        self.synthetic_fastqs = []
+        if make_fastqs:
+            self.make_synthetic_fastqs(out_dir=out_dir, save_background=save_background)
 
-    def exclude_from_background(self, seqkit_exe=None):
+    def make_synthetic_fastqs(self, out_dir, save_background=True):
 
         """
-            for each background fastq file exclude the reads overlapping with
-            any region in self.regions by finding the names of the reads, and
-             writing new fastq files excluding these reads.
+            For each background fastq file, exclude the reads overlapping with
+            any variant in self.variants by finding the names of the reads, and
+            merge the remaining reads with the fastq files holding the reads
+            supporting the variants. Each background fastq file is read once,
+            and the synthetic fastq file is written directly.
 
             Args:
-                tmp_dir (str): path to directory where fastq_files with excluded
-                               reads, i.e. the 'background' reads.
-                backgrounds (list): list of paths to the 'background' bam files
-                member (str): synthetic family member for synthetic dataset.
-                    choices: 'child', 'father', 'mother', 'affected'
+                out_dir (path): Path to directory where synthetic fastqs are stored
+                save_background (bool): If true, the backgrounds with excluded
+                                        reads are written to self.tmp_dir as well.
+            Returns:
+                synthetic_fastqs (list(Path)): synthetic fastq files
+        """
+
+        make_datasets([self], out_dir=out_dir, save_background=save_background)
+
+        return self.synthetic_fastqs
+
+    def find_excluded_reads(self):
+
+        """
+            Finds the names of the background reads overlapping any variant in
+            self.variants
+
+            Returns:
+                excluded_reads (mutacc.utils.read_names.ReadNameSet): read names
         """
 
         bam_file = parse_path(self.background["bam_file"])
-        fastq_files = [parse_path(fastq) for fastq in self.background["fastq_files"]]
 
-        with BAMContext(bam_file=bam_file) as bam_handle:
-            #for each region, find the reads overlapping
-            for variant in self.variants:
-                bam_handle.find_names_from_region(chrom=variant["chrom"],
-                                                  start=variant["start"],
-                                                  end=variant["end"],
-                                                  padding=variant["padding"])
+        # Read names are spilled to disk, so that memory use does not grow with
+        # the number of variants
+        with BAMContext(bam_file=bam_file, threads=self.threads,
+                        reference=self.reference, spill_dir=self.tmp_dir) as bam_handle:
+            #find the reads overlapping any of the regions
+            bam_handle.find_names_from_regions(self.variants)
 
-            log_msg = f"{bam_handle.record_number} reads to be excluded from {fastq_files}"
+            log_msg = (f"{bam_handle.record_number} reads to be excluded from the "
+                       f"background of {self.member}")
             LOG.info(log_msg)
 
-            name_file = bam_handle.make_names_temp(self.tmp_dir)
-            excluded_backgrounds = []
-            for fastq_file in fastq_files:
+            return bam_handle.found_reads
 
-                fastq_path = str(fastq_file)
-                out_name = str(self.member) + "_" + str(fastq_file.name)
-                out_path = str(self.tmp_dir.joinpath(out_name))
 
-                #Here command line tool seqkit grep is used
-                exclude_from_fastq(name_file,
-                                   out_path,
-                                   fastq_path,
-                                   seqkit_exe=seqkit_exe)
+def make_datasets(datasets, out_dir, save_background=True):
 
-                excluded_backgrounds.append(out_path)
+    """
+        Makes the synthetic fastq files of several datasets with the same
+        background, reading each background fastq file once. Each background
+        record is written to the synthetic fastq file of every dataset that does
+        not exclude it. The background, threads and workers of the first dataset
+        are used.
+
+        Args:
+            datasets (list(Dataset)): datasets, made with make_fastqs=False
+            out_dir (path): Path to directory where synthetic fastqs are stored
+            save_background (bool): If true, the backgrounds with excluded
+                                    reads are written to the tmp_dir as well.
+        Returns:
+            datasets (list(Dataset)): the datasets, with their synthetic fastq files
+    """
 
-        return excluded_backgrounds
+    members = [str(dataset.member) for dataset in datasets]
+    if len(set(members)) < len(members):
+        raise ValueError(f"Datasets must have different members, got {members}")
 
+    first = datasets[0]
+    fastq_files = [parse_path(fastq) for fastq in first.background["fastq_files"]]
+    out_dir = parse_path(out_dir, file_type='dir')
 
+    with ExitStack() as stack:
+        excluded_reads = [
+            stack.enter_context(dataset.find_excluded_reads()) for dataset in datasets
+        ]
 
-    def merge_fastqs(self, out_dir, save_background=True):
-        """
-            Merge the background file with the fastq_files Holding
-            the reads supporting the variants
+        shards = _searched_shards(first.background, excluded_reads, len(fastq_files))
 
-            Args:
-                out_dir (path): Path to directory where synthetic fastqs are stored
-                save_background (bool): If true, the backgrounds with excluded
-                                        reads are not removed.
-        """
-        synthetic_fastqs = []
+        #For each fastq file given as background (two if paired end)
+        jobs = []
+        for i, fastq_file in enumerate(fastq_files):
+
+            outputs = []
+            for dataset, dataset_excluded in zip(datasets, excluded_reads):
+                variant_fastqs = [
+                    sample['variant_fastq_files'][i] for sample in dataset.samples
+                    if len(sample['variant_fastq_files']) == len(fastq_files)
+                    and sample['variant_fastq_files'][i]
+                ]
+
+                out_name = str(dataset.member) + "_" + str(fastq_file.name)
+                outputs.append({
+                    'record_ids': dataset_excluded,
+                    'out_path': out_dir.joinpath("synthetic_" + out_name),
+                    'append_files': variant_fastqs,
+                    'excluded_path': dataset.tmp_dir.joinpath(out_name) if save_background
+                                     else None,
+                })
+
+            LOG.info("Excluding reads from %s, and merging with variant reads", fastq_file)
+            jobs.append((fastq_file, outputs, shards[i] if shards else None))
+
+        try:
+            excluded_counts = _exclude_from_backgrounds(jobs, first.threads, first.workers)
+        except:
+            # Partial outputs of every read end are removed, so that no
+            # incomplete synthetic fastq file is left behind
+            for _, outputs, _ in jobs:
+                for output in outputs:
+                    for path in (output['out_path'], output['excluded_path']):
+                        if path is not None and os.path.exists(path):
+                            os.remove(path)
+            raise
+
+    for (fastq_file, outputs, _), end_counts in zip(jobs, excluded_counts):
+        for dataset, output, excluded in zip(datasets, outputs, end_counts):
+
+            log_msg = f"{excluded} reads excluded from {fastq_file} for {dataset.member}"
+            LOG.info(log_msg)
 
-        out_dir = parse_path(out_dir, file_type='dir')
+            if output['excluded_path']:
+                dataset.excluded_backgrounds.append(str(output['excluded_path']))
+            dataset.synthetic_fastqs.append(output['out_path'])
 
-        reads = len(self.excluded_backgrounds)
+    for dataset in datasets:
+        for fastq in dataset.synthetic_fastqs:
+            log_msg = f"Created {fastq}"
+            LOG.info(log_msg)
 
-        #For each fastq file given as background (two if paired end)
-        for i in range(reads):
+    return datasets
 
-            fastq_list = [self.excluded_backgrounds[i]]
 
-            for sample in self.samples:
+def _searched_shards(background, excluded_reads, ends):
 
-                if len(sample['variant_fastq_files']) != reads:
-                    continue
+    """
+        Finds the shards of a sharded background (see
+        mutacc.builds.build_background) holding any of the excluded reads.
+
+        Args:
+            background (dict): background of the datasets
+            excluded_reads (list(mutacc.utils.read_names.ReadNameSet)): read names
+                to exclude from each dataset
+            ends (int): number of background fastq files
+        Returns:
+            shards (list(list(tuple))): offset, size and whether to search each
+                shard, for each background fastq file, or None if the
+                background is not sharded
+    """
 
-                fastq_list.append(sample['variant_fastq_files'][i])
+    if background.get("shards") is None:
+        return None
 
-            file_name = parse_path(self.excluded_backgrounds[i]).name
-            out_path = out_dir.joinpath("synthetic_"+file_name)
+    with ReadNameBins.load(background["names_file"]) as read_name_bins:
+        searched = {
+            read_name_bins.get_fingerprint(name_fingerprint)
+            for dataset_excluded in excluded_reads
+            for name_fingerprint in dataset_excluded.fingerprints()
+        }
 
-            LOG.info("Merging fastq files")
+    shards = background["shards"]
+    log_msg = (f"{sum(shard['bin'] in searched for shard in shards)} of {len(shards)} "
+               "background shards to be searched")
+    LOG.info(log_msg)
 
-            try:
-                merge_fastqs_sub(fastq_list, out_path)
+    return [
+        [(shard["members"][i][0], shard["members"][i][1], shard["bin"] in searched)
+         for shard in shards]
+        for i in range(ends)
+    ]
 
-            except:
 
-                log_msg = f"Files were not merged, background files in {out_dir} not removed"
-                LOG.critical(log_msg)
-                raise
+def _exclude_from_backgrounds(jobs, threads, workers):
 
-            synthetic_fastqs.append(out_path)
+    """
+        Writes the synthetic fastq files of each background fastq file. The
+        read ends are independent of each other, so if more than one worker is
+        given they are written concurrently in separate processes, sharing
+        the sets of excluded read names.
+
+        Args:
+            jobs (list(tuple)): background fastq file, outputs and shards of
+                each read end
+            threads (int): number of threads used to compress the outputs, shared
+                by the read ends written concurrently
+            workers (int): number of processes
+        Returns:
+            excluded_counts (list(list(int))): number of reads excluded from each
+                background fastq file, for each output
+    """
 
-        #Remove background fastqs
-        if not save_background:
-            for background in self.excluded_backgrounds:
-                log_msg = f"Removing file from disk: {background}"
-                LOG.info(log_msg)
-                os.remove(background)
+    if workers > 1 and len(jobs) > 1:
+        job_threads = max(1, threads // min(workers, len(jobs)))
+        with process_pool(min(workers, len(jobs))) as executor:
+            futures = [
+                executor.submit(_exclude_from_background, fastq_file, outputs, job_threads,
+                                shards)
+                for fastq_file, outputs, shards in jobs
+            ]
+            excluded_counts = []
+            for (fastq_file, _, _), future in zip(jobs, futures):
+                try:
+                    excluded_counts.append(future.result())
+                except Exception:
+                    log_msg = f"Synthetic fastq files of {fastq_file} were not created"
+                    LOG.critical(log_msg)
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+            return excluded_counts
+
+    excluded_counts = []
+    for fastq_file, outputs, shards in jobs:
+
+        try:
+            excluded_counts.append(_exclude_from_background(fastq_file, outputs, threads,
+                                                            shards))
+        except:
+
+            log_msg = f"Synthetic fastq files of {fastq_file} were not created"
+            LOG.critical(log_msg)
+            raise
+
+    return excluded_counts
+
+
+def _exclude_from_background(fastq_file, outputs, threads, shards):
 
-        for fastq in synthetic_fastqs:
-            log_msg = f"Created {fastq}"
-            LOG.info(log_msg)
+    """
+        Writes the synthetic fastq files of a background fastq file, searching
+        only the given shards if the background is sharded
+    """
+
+    if shards is not None:
+        return fastq_exclude_shards_many(fastq_file, outputs, shards, threads=threads)
 
-        return synthetic_fastqs
+    return fastq_exclude_many(fastq_file, outputs, threads=threads)
@@ -6,7 +6,9 @@ import logging
 
 from mutacc.utils.bam_handler import BAMContext
 from mutacc.parse.path_parse import make_dir, parse_path
-from mutacc.utils.fastq_handler import fastq_extract
+from mutacc.utils.fastq_handler import fastq_extract, fastq_extract_lanes
+from mutacc.utils.read_names import route_read_names
+from mutacc.utils.process_pool import process_pool
 from mutacc.subprocessing.bam_to_fastq import bam_to_fastq
 
 LOG = logging.getLogger(__name__)
@@ -17,7 +19,8 @@ class Sample(dict):
         Class to represent sample
     """
 
-    def __init__(self, input_sample, variants, padding, picard_exe, case_dir):
+    def __init__(self, input_sample, variants, padding, picard_exe, case_dir, workers=1,
+                 threads=1, reference=None, index_fastq=False):
 
         super(Sample, self).__init__(**input_sample)
 
@@ -26,6 +29,11 @@ class Sample(dict):
         self.padding = padding
         self.picard_exe = picard_exe
         self.case_dir = case_dir
+        self.workers = workers
+        self.threads = threads
+        self.reference = reference
+        self.index_fastq = index_fastq
+        self.metrics = None
         self.bam_file = parse_path(self.input_sample['bam_file'])
 
         # Build sample
@@ -48,16 +56,17 @@ class Sample(dict):
         # For each variant, the reads spanning this genomic region in
         # the bam file are found
 
-        with BAMContext(bam_file=self.bam_file) as bam_handle:
-            for variant in self.variants:
+        # The read names are kept by read group only when they are routed to
+        # the lanes of the sample
+        route_lanes = isinstance(self.input_sample['fastq_files'][0], dict)
+        with BAMContext(bam_file=self.bam_file, threads=self.threads,
+                        reference=self.reference,
+                        track_read_groups=route_lanes) as bam_handle:
 
-                bam_handle.find_names_from_region(
-                    chrom=variant["chrom"],
-                    start=variant["start"],
-                    end=variant["end"],
-                    padding=variant["padding"])
+            bam_handle.find_names_from_regions(self.variants, workers=self.workers)
 
-                read_ids = bam_handle.found_reads
+            read_ids = bam_handle.found_reads
+            read_group_names = bam_handle.read_group_names
 
         log_msg = f"{len(read_ids)} reads found for sample {self.input_sample['sample_id']}"
         LOG.info(log_msg)
@@ -66,10 +75,31 @@ class Sample(dict):
         # extracted from the fastq files
         LOG.info("Search in fastq file")
 
-        variant_fastq_files = fastq_extract(
-            self.input_sample['fastq_files'],
+        # Fastq files split in lanes are given as a list of files for each lane,
+        # or as a list of lanes with the read groups sequenced in each lane
+        fastq_files = self.input_sample['fastq_files']
+        extract_args = {}
+        extract = fastq_extract
+        if isinstance(fastq_files[0], dict):
+            extract = fastq_extract_lanes
+            lane_read_groups = [lane_read_groups_of(lane) for lane in fastq_files]
+            fastq_files = [lane['fastq_files'] for lane in fastq_files]
+            # Each lane is only searched for the reads in its read groups
+            extract_args['lane_record_ids'] = route_read_names(
+                read_group_names, lane_read_groups
+            )
+        elif isinstance(fastq_files[0], list):
+            extract = fastq_extract_lanes
+
+        variant_fastq_files = extract(
+            fastq_files,
             read_ids,
-            dir_path=sample_dir
+            dir_path=sample_dir,
+            threads=self.threads,
+            workers=self.workers,
+            index=self.index_fastq,
+            metrics_callback=self._store_metrics,
+            **extract_args
             )
 
         # Add path to fastq files with the reads containing the variant
@@ -78,51 +108,82 @@ class Sample(dict):
         self['variant_fastq_files'] = variant_fastq_files
 
 
+    def _store_metrics(self, metrics):
+
+        # Metrics are kept as an attribute, not to be imported with the sample
+        self.metrics = metrics.to_dict()
+
     def _extract_bam(self, sample_dir):
 
-        with BAMContext(self.bam_file, out_dir=sample_dir) as bam_handle:
+        # The read pairs are written directly to fastq files, unless a picard
+        # executable is given, in which case picard SamToFastq is used to convert
+        # an intermediate bam file
+        out_format = "bam" if self.picard_exe else "fastq"
 
-            for variant in self.variants:
+        with BAMContext(self.bam_file, out_dir=sample_dir, threads=self.threads,
+                        out_format=out_format, reference=self.reference) as bam_handle:
 
-                bam_handle.find_reads_from_region(
-                    chrom=variant["chrom"],
-                    start=variant["start"],
-                    end=variant["end"],
-                    padding=variant["padding"]
-                )
+            bam_handle.find_reads_from_regions(self.variants, workers=self.workers)
 
             log_msg = "{} reads found for sample {}".format(
                 bam_handle.record_number,
                 self.input_sample['sample_id']
             )
             LOG.info(log_msg)
-            variant_bam_file = bam_handle.out_file
+            out_files = bam_handle.out_files
+            paired = bam_handle.paired
+
+        if out_format == "fastq":
+            fastq1 = out_files[0]
+            fastq2 = out_files[1] if paired else None
+
+        else:
+            variant_bam_file = out_files[0]
             self.input_sample["variant_bam_file"] = variant_bam_file
             file_name = parse_path(variant_bam_file).name
-            paired = bam_handle.paired
 
-        # Convert bam to fastq
-        fastq1 = str(sample_dir.joinpath(file_name.split('.')[0] + '_R1.fastq.gz'))
-        fastq2 = None
-        if paired:
-            fastq2 = str(sample_dir.joinpath(file_name.split('.')[0] + '_R2.fastq.gz'))
+            # Convert bam to fastq
+            fastq1 = str(sample_dir.joinpath(file_name.split('.')[0] + '_R1.fastq.gz'))
+            fastq2 = None
+            if paired:
+                fastq2 = str(sample_dir.joinpath(file_name.split('.')[0] + '_R2.fastq.gz'))
 
-        # Use picard SamToFastq to convert from bam to paired end fastqs
+            # Use picard SamToFastq to convert from bam to paired end fastqs
 
-        bam_to_fastq(
-            variant_bam_file,
-            fastq1,
-            fastq2,
-            picard_exe=self.picard_exe
-        )
+            bam_to_fastq(
+                variant_bam_file,
+                fastq1,
+                fastq2,
+                picard_exe=self.picard_exe
+            )
 
         self["variant_fastq_files"] = [fastq1, fastq2]
         self["paired_reads"] = paired
 
-def get_samples(samples, variants, padding, picard_exe, case_dir):
+def lane_read_groups_of(lane):
+
+    """
+        Gives the read groups of a lane, given as one read group or a list
+
+        Args:
+            lane (dict): lane with fastq files, and key 'read_group'
+
+        Returns:
+            read_groups (list(str)): read groups of the lane
+    """
+
+    read_groups = lane.get('read_group') or []
+    if isinstance(read_groups, str):
+        return [read_groups]
+    return list(read_groups)
+
+def get_samples(samples, variants, padding, picard_exe, case_dir, workers=1, threads=1,
+                reference=None, index_fastq=False):
 
     """
-        Parse a list of samples, given as input to importable sample objects
+        Parse a list of samples, given as input to importable sample objects.
+        If more than one worker is given, the samples are built concurrently
+        in a pool of processes, and the workers are shared between them.
 
         Args:
             samples (list(dict)): list of samples
@@ -130,9 +191,38 @@ def get_samples(samples, variants, padding, picard_exe, case_dir):
             padding (int): padding to be used
             picard_exe (str): path to picard binary
             case_dir (Path): path to dir where reads for case are to be stored
+            workers (int): number of processes used to build the samples
+            threads (int): number of threads used for compression and
+                decompression, shared by the samples built concurrently
+            reference (str): path to reference fasta, used to decode cram files
+            index_fastq (bool): if True, an index is built for each fastq file without one
 
     """
 
+    if workers > 1 and len(samples) > 1:
+
+        # Each sample searches its bam and fastq files with its share of the workers
+        # and threads
+        sample_workers = max(1, workers // len(samples))
+        sample_threads = max(1, threads // min(workers, len(samples)))
+        with process_pool(min(workers, len(samples))) as executor:
+            futures = [
+                executor.submit(Sample, sample, variants, padding, picard_exe, case_dir,
+                                workers=sample_workers, threads=sample_threads,
+                                reference=reference, index_fastq=index_fastq)
+                for sample in samples
+            ]
+            for sample, future in zip(samples, futures):
+                try:
+                    yield future.result()
+                except Exception:
+                    LOG.error("Failed to extract reads for sample %s", sample['sample_id'])
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+        return
+
     for sample in samples:
 
-        yield Sample(sample, variants, padding, picard_exe, case_dir)
+        yield Sample(sample, variants, padding, picard_exe, case_dir, workers=workers,
+                     threads=threads, reference=reference, index_fastq=index_fastq)
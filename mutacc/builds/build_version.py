@@ -7,6 +7,7 @@ import datetime
 import ped_parser
 
 from mutacc.subprocessing.get_md5 import get_md5
+from mutacc.utils.checksums import MANIFEST_NAME, read_checksums
 from mutacc.parse.path_parse import parse_path, list_files, list_dirs
 from mutacc.parse.parse_ped import parse_ped
 
@@ -32,7 +33,8 @@ class VersionedDataset(dict):
         for sample in family['samples']:
             sample_id = sample['sample_id']
             sample_dir = self.find_sample_dir(sample_id)
-            sample_files = list_files(sample_dir)
+            sample_files = [file for file in list_files(sample_dir)
+                            if file.name != MANIFEST_NAME]
             files = [{'path': str(file),
                       'md5': self._get_md5(file) if md5 else None}
                      for file in sample_files]
@@ -78,4 +80,11 @@ class VersionedDataset(dict):
 
     @staticmethod
     def _get_md5(file_path):
+        # Files written by mutacc have their checksums in a manifest, so that
+        # they are not read a second time
+        checksums = read_checksums(file_path)
+        if checksums and checksums.get('md5'):
+            log_msg = f"md5sum of {file_path} found in manifest"
+            LOG.info(log_msg)
+            return checksums['md5']
         return get_md5(file_path)
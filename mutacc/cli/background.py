@@ -0,0 +1,60 @@
+"""
+    Commands to prepare backgrounds for synthetic datasets
+"""
+
+import logging
+from pathlib import Path
+
+import click
+
+from mutacc.builds.build_background import BIN_SIZE, prepare_background
+
+LOG = logging.getLogger(__name__)
+
+
+@click.group('background')
+def background_group():
+
+    """
+        Prepare backgrounds for synthetic datasets
+    """
+
+
+@click.command('prepare')
+@click.option('-b', '--background-bam', type=click.Path(exists=True), required=True)
+@click.option('-f', '--background-fastq', type=click.Path(exists=True), required=True)
+@click.option('-f2', '--background-fastq2', type=click.Path(exists=True))
+@click.option('-o', '--out-dir', type=click.Path(),
+              help='directory of the sharded background, defaults to a directory in backgrounds')
+@click.option('--bin-size', type=int, default=BIN_SIZE, show_default=True,
+              help='size (bp) of the genomic bins the reads are sharded on')
+@click.pass_context
+def prepare_command(context, background_bam, background_fastq, background_fastq2, out_dir,
+                    bin_size):
+
+    """
+        Split background fastq files into shards of genomic bins, so that
+        synthesize only searches the shards overlapping the variants
+    """
+
+    fastq_files = [background_fastq]
+    if background_fastq2:
+        fastq_files.append(background_fastq2)
+
+    out_dir = out_dir or context.obj['background_dir'].joinpath(
+        Path(background_bam).name.split(".")[0]
+    )
+
+    index_file = prepare_background(bam_file=background_bam,
+                                    fastq_files=fastq_files,
+                                    out_dir=out_dir,
+                                    bin_size=bin_size,
+                                    tmp_dir=context.obj.get('temp_dir'),
+                                    threads=context.obj.get('threads', 1),
+                                    reference=context.obj.get('reference'))
+
+    log_msg = f"Use 'mutacc synthesize --background-dir {Path(index_file).parent}'"
+    LOG.info(log_msg)
+
+
+background_group.add_command(prepare_command)
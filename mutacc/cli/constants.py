@@ -34,6 +34,9 @@ SUB_DIRS = {
     #Subdirectory for synthetic datasets
     'dataset_dir': 'datasets',
 
+    #Subdirectory for sharded backgrounds, made by 'mutacc background prepare'
+    'background_dir': 'backgrounds',
+
     #Subdirectory for temp files such as
     #the files containing read_IDs for search in fastq files
     #and the fastq_files with some excluded reads.
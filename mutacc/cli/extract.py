@@ -29,8 +29,22 @@ LOG = logging.getLogger(__name__)
 @click.option("--padding", type=int, help="padding around SNVs and indels")
 @click.option("--sv-padding", type=int, help="padding around SVs")
 @click.option("--picard-executable", type=click.Path(exists=True))
+@click.option(
+    "-w", "--workers", type=int,
+    help="number of processes used to search each alignment file and BGZF fastq file"
+)
+@click.option(
+    "--index-fastq", is_flag=True,
+    help="index the read names of each fastq file, so that later extractions read only the reads needed"
+)
+@click.option(
+    "--metrics", is_flag=True,
+    help="write throughput metrics of the fastq scans next to the import file"
+)
 @click.pass_context
-def extract_command(context, case, padding, sv_padding, picard_executable):
+def extract_command(
+    context, case, padding, sv_padding, picard_executable, workers, index_fastq, metrics
+):
 
     """
         extract reads from case
@@ -48,6 +62,8 @@ def extract_command(context, case, padding, sv_padding, picard_executable):
     picard_executable = context.obj["binaries"].get("picard") or picard_executable
     padding = padding or context.obj.get("padding") or PADDING
     sv_padding = sv_padding or context.obj.get("sv_padding") or SV_PADDING
+    workers = workers or context.obj.get("workers") or 1
+    index_fastq = index_fastq or context.obj.get("index_fastq", False)
     case_obj = Case(
         input_case=input_case,
         read_dir=read_dir,
@@ -55,6 +71,10 @@ def extract_command(context, case, padding, sv_padding, picard_executable):
         sv_padding=sv_padding,
         picard_exe=picard_executable,
         vcf_parse=context.obj.get("vcf_parser_import"),
+        workers=workers,
+        threads=context.obj.get("threads", 1),
+        reference=context.obj.get("reference"),
+        index_fastq=index_fastq,
     )
 
     import_dir = context.obj.get("import_dir")
@@ -66,5 +86,12 @@ def extract_command(context, case, padding, sv_padding, picard_executable):
 
         json.dump(case_obj, json_handle)
 
+    if metrics:
+        metrics_file = import_dir.joinpath(case_obj.case_id + "_import_mutacc" + ".metrics.json")
+        with open(metrics_file, "w") as metrics_handle:
+            json.dump({"case_id": case_obj.case_id, "samples": case_obj.metrics}, metrics_handle,
+                      indent=2)
+        LOG.info("throughput metrics written to %s", metrics_file)
+
     log_msg = f"to import reads into mutaccDB, do:\n    mutacc db import {json_file}"
     LOG.info(log_msg)
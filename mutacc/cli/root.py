@@ -10,8 +10,10 @@ from mutacc import __version__
 from mutacc.mutaccDB.db_adapter import MutaccAdapter
 from mutacc.parse.path_parse import make_dir, parse_path
 from mutacc.resources import default_vcf_parser
+from mutacc.utils.bam_handler import set_reference_cache, set_stats_cache
 
 from .constants import PADDING, SUB_DIRS, SV_PADDING
+from .background import background_group as background_group
 from .database import database_group as database_group
 from .extract import extract_command as extract_command
 from .synthesize import synthesize_command as synthesize_command
@@ -26,9 +28,12 @@ LOG = logging.getLogger(__name__)
 @click.option("-r", "--root-dir", type=click.Path(exists=True))
 @click.option("-d", "--demo", is_flag=True)
 @click.option("--vcf-parser", type=click.Path(exists=True))
+@click.option(
+    "-t", "--threads", type=int, help="number of threads used for compression and decompression"
+)
 @click.version_option(__version__)
 @click.pass_context
-def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
+def cli(context, loglevel, config_file, root_dir, demo, vcf_parser, threads):
 
     coloredlogs.install(level=loglevel)
     LOG.info("Running mutacc")
@@ -42,6 +47,11 @@ def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
         password = None
         padding = PADDING
         sv_padding = SV_PADDING
+        workers = None
+        reference = None
+        ref_cache = None
+        stats_cache = None
+        index_fastq = False
         root_dir = make_dir(root_dir or "./mutacc_demo_root")
 
     else:
@@ -59,6 +69,12 @@ def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
         root_dir = cli_config.get("root_dir") or root_dir
         padding = cli_config.get("padding")
         sv_padding = cli_config.get("sv_padding")
+        workers = cli_config.get("workers")
+        threads = threads or cli_config.get("threads")
+        reference = cli_config.get("reference")
+        ref_cache = cli_config.get("ref_cache")
+        stats_cache = cli_config.get("stats_cache")
+        index_fastq = cli_config.get("index_fastq", False)
 
         if not root_dir:
             LOG.warning(
@@ -81,13 +97,25 @@ def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
     mutacc_config["demo"] = demo
     mutacc_config["padding"] = padding
     mutacc_config["sv_padding"] = sv_padding
+    mutacc_config["workers"] = workers
+    mutacc_config["threads"] = threads or 1
+    mutacc_config["reference"] = reference
+    mutacc_config["index_fastq"] = index_fastq
+
+    # Look up and cache the reference sequences of cram files in a local directory
+    if ref_cache:
+        set_reference_cache(make_dir(ref_cache))
 
     # Create subdirectories in root, if not already created
     for dir_type in SUB_DIRS.keys():
         subdir = mutacc_config["root_dir"].joinpath(SUB_DIRS[dir_type])
         mutacc_config[dir_type] = make_dir(subdir)
 
-    # Get binaries for picard and seqkit if specified in config
+    # Cache the statistics of bam files in a local directory, since the bam
+    # files may be on read-only storage
+    set_stats_cache(make_dir(stats_cache) if stats_cache else mutacc_config["temp_dir"])
+
+    # Get binaries for picard if specified in config
     mutacc_config["binaries"] = {}
 
     binaries = {}
@@ -95,7 +123,6 @@ def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
         binaries = cli_config["binaries"]
 
     mutacc_config["binaries"]["picard"] = binaries.get("picard")
-    mutacc_config["binaries"]["seqkit"] = binaries.get("seqkit")
 
     context.obj = mutacc_config
 
@@ -103,6 +130,7 @@ def cli(context, loglevel, config_file, root_dir, demo, vcf_parser):
 cli.add_command(extract_command)
 cli.add_command(synthesize_command)
 cli.add_command(database_group)
+cli.add_command(background_group)
 
 
 def get_vcf_parser(parser_file: str = None, config_dict: dict = None):
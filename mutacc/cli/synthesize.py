@@ -7,7 +7,8 @@ import click
 import json
 
 from mutacc.parse.path_parse import make_dir
-from mutacc.builds.build_dataset import Dataset
+from mutacc.builds.build_dataset import Dataset, make_datasets
+from mutacc.builds.build_background import load_background
 
 from mutacc.resources import (path_to_background_bam_file,
                               path_to_background_fastq1_file,
@@ -19,49 +20,78 @@ LOG = logging.getLogger(__name__)
 @click.option('-b', '--background-bam', type=click.Path())
 @click.option('-f', '--background-fastq', type=click.Path())
 @click.option('-f2', '--background-fastq2', type=click.Path())
+@click.option('--background-dir', type=click.Path(exists=True),
+              help='sharded background made by mutacc background prepare')
 @click.option('--dataset-dir', type=click.Path())
-@click.option('-q', '--query', type=click.Path(exists=True))
+@click.option('-q', '--query', 'queries', type=click.Path(exists=True), multiple=True,
+              help='query json file, may be given several times to make one dataset '
+                   'per query from one read of the background')
 @click.option('-s', '--save-background', is_flag=True)
 @click.option('-j', '--json-out', is_flag=True)
+@click.option('-w', '--workers', type=int,
+              help='number of processes used to write the read ends concurrently')
 @click.pass_context
 def synthesize_command(context,
                        background_bam,
                        background_fastq,
                        background_fastq2,
+                       background_dir,
                        dataset_dir,
-                       query,
+                       queries,
                        save_background,
-                       json_out):
+                       json_out,
+                       workers):
 
     """
         Command to make synthetic dataset
     """
 
-    # load json file containing a mutacc query
-    with open(query, "r") as json_handle:
+    query_results = []
+    for query in queries:
 
-        samples, _, variants, sample_name = json.load(json_handle)
+        # load json file containing a mutacc query
+        with open(query, "r") as json_handle:
 
-    #Abort if no cases correspond to query
-    num_cases = len(samples)
-    if num_cases == 0:
+            samples, _, variants, sample_name = json.load(json_handle)
+
+        #Skip queries with no cases
+        num_cases = len(samples)
+        if num_cases == 0:
+            log_msg = f"No cases were found for query {query}"
+            LOG.warning(log_msg)
+            continue
+
+        num_variants = len(variants)
+
+        log_msg = f"{num_cases} cases found, with a total of {num_variants} variants."
+        LOG.info(log_msg)
+
+        query_results.append((samples, variants, sample_name))
+
+    #Abort if no cases correspond to any query
+    if not query_results:
         LOG.warning("No cases were found")
         context.abort()
 
-    num_variants = len(variants)
-
-    log_msg = f"{num_cases} cases found, with a total of {num_variants} variants."
-    LOG.info(log_msg)
+    #The synthetic fastq files are named after the sample of each query
+    sample_names = [str(sample_name) for _, _, sample_name in query_results]
+    if len(set(sample_names)) < len(sample_names):
+        log_msg = f"Queries must be made for different samples, got {sample_names}"
+        LOG.warning(log_msg)
+        context.abort()
 
     if context.obj.get('demo', False):
         background_bam = path_to_background_bam_file
         background_fastq = path_to_background_fastq1_file
         background_fastq2 = path_to_background_fastq2_file
 
-    background = {"bam_file": background_bam,
-                  "fastq_files": [background_fastq]}
-    if background_fastq2:
-        background["fastq_files"].append(background_fastq2)
+    if background_dir:
+        background = load_background(background_dir)
+    else:
+        background = {"bam_file": background_bam,
+                      "fastq_files": [background_fastq]}
+        if background_fastq2:
+            background["fastq_files"].append(background_fastq2)
 
     #Create temporary directory
     temp_dir = context.obj.get('temp_dir')
@@ -69,27 +99,38 @@ def synthesize_command(context,
     log_msg = f"Temporay files stored in {temp_dir}"
     LOG.info(log_msg)
 
-    seqkit_executable = context.obj['binaries'].get('seqkit')
     dataset_dir = dataset_dir or context.obj.get('dataset_dir')
     dataset_dir = make_dir(dataset_dir)
 
-    #make object make_set from Dataset class
-    dataset = Dataset(samples=samples,
-                      variants=variants,
-                      tmp_dir=temp_dir,
-                      background=background,
-                      member=sample_name,
-                      out_dir=dataset_dir,
-                      seqkit_exe=seqkit_executable,
-                      save_background=save_background)
+    #make objects from Dataset class, made together from one read of the background
+    datasets = [Dataset(samples=samples,
+                        variants=variants,
+                        tmp_dir=temp_dir,
+                        background=background,
+                        member=sample_name,
+                        out_dir=dataset_dir,
+                        save_background=save_background,
+                        threads=context.obj.get('threads', 1),
+                        reference=context.obj.get('reference'),
+                        workers=workers or context.obj.get('workers') or 1,
+                        make_fastqs=False)
+                for samples, variants, sample_name in query_results]
+
+    make_datasets(datasets, out_dir=dataset_dir, save_background=save_background)
 
-    synthetics = dataset.synthetic_fastqs
+    synthetics = [synthetic for dataset in datasets for synthetic in dataset.synthetic_fastqs]
 
     for synthetic in synthetics:
         log_msg = f"Synthetic datasets created in {synthetic}"
         LOG.info(log_msg)
 
     if json_out:
-        output_info = {'fastq_files': [str(synthetic) for synthetic in synthetics]}
+        output_info = {
+            'fastq_files': [str(synthetic) for synthetic in synthetics],
+            'datasets': {
+                str(dataset.member): [str(synthetic) for synthetic in dataset.synthetic_fastqs]
+                for dataset in datasets
+            },
+        }
         output_json = json.dumps(output_info)
         click.echo(output_json)
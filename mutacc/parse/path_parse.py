@@ -1,6 +1,8 @@
 from pathlib import Path
 import os
-import gzip
+
+from mutacc.utils.compression import gzip_reader
+
 def parse_path(path, file_type: str  = 'file'):
 
     path = Path(path).expanduser().absolute()
@@ -33,18 +35,18 @@ def make_dir(path):
 
     return path
 
-def get_file_handle(file_name):
+def get_file_handle(file_name, mode='rt'):
 
     file_name = parse_path(file_name)
 
 
     if file_name.name.endswith('.gz'):
 
-        return gzip.open(file_name, 'rt')
+        return gzip_reader(file_name, mode)
 
     else:
 
-        return open(file_name, 'r')
+        return open(file_name, mode)
 
 def list_files(directory):
 
@@ -41,6 +41,24 @@ def yaml_parse(yaml_file):
                     'bam', and 'fastq'"
             )
 
+    for sample in yaml_dict["samples"]:
+
+        fastq_files = sample.get("fastq_files")
+        if fastq_files and isinstance(fastq_files[0], (list, dict)):
+
+            # Lanes are given as lists of fastq files, or with their read groups as
+            # dictionaries with keys 'read_group' and 'fastq_files'
+            lanes = [
+                lane.get("fastq_files") if isinstance(lane, dict) else lane
+                for lane in fastq_files
+            ]
+            if not all(isinstance(lane, type(fastq_files[0])) for lane in fastq_files) or \
+                    not all(isinstance(lane, list) and len(lane) == len(lanes[0]) for lane in lanes):
+                raise YAMLFieldsError(
+                    "fastq files split in lanes must be given as a list of lanes,\
+                        each with the same number of fastq files"
+                )
+
     # Check if valid pedigree with ped_parser classes Family and individual
     family = ped_parser.Family(family_id=yaml_dict["case"]["case_id"])
     for sample in yaml_dict["samples"]:
@@ -2,41 +2,212 @@
     Module with to handle bam files
 """
 
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
+import json
 import logging
 import tempfile
 import os
+from pathlib import Path
+import shutil
 
 import pysam
 
 from mutacc.parse.path_parse import parse_path
+from mutacc.utils.compression import gzip_writer
+from mutacc.utils.read_names import ReadNameBins, ReadNameSet
+from mutacc.utils.region_handler import merge_regions
 
 LOG = logging.getLogger(__name__)
 
+# Mate positions closer than this (in bp) are fetched in the same sweep
+MATE_CLUSTER_DISTANCE = 5000
+
+# Number of reads sampled to estimate the bam statistics, and the number of
+# genomic strata the reads are sampled from
+STATS_READ_COUNT = 10000
+STATS_STRATA = 50
+INSERT_SIZE_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Suffix of the sidecar file caching the bam statistics, and the environment
+# variable holding the directory the sidecar files are written to
+STATS_SUFFIX = ".mutacc_stats.json"
+STATS_CACHE_ENV = "MUTACC_STATS_CACHE"
+
+OUT_FORMATS = ("bam", "fastq")
+
+# Magic number of CRAM files
+CRAM_MAGIC = b"CRAM"
+
+# SAM flag bits
+FLAG_READ2 = 0x80
+FLAG_NON_PRIMARY = 0x100 | 0x800
+
+
+class ReadPairs:
+    """
+        Table of reads waiting for their mates. Each pair is keyed on query name
+        and holds one slot per read end, so that a read already seen in an
+        overlapping region is detected from its flag bits alone. Only primary
+        alignments are paired. The secondary and supplementary alignments of a
+        name are kept aside, to be written with its pair.
+    """
+
+    __slots__ = ("ends", "_pairs", "_non_primary")
+
+    def __init__(self, ends=2):
+        """
+            Args:
+                ends (int): number of reads in a complete pair, 2 if paired else 1
+        """
+        self.ends = ends
+        self._pairs = {}
+        self._non_primary = {}
+
+    def add(self, read):
+        """
+            Adds read to its pair. Secondary and supplementary alignments are
+            not paired, but kept with the other alignments of their name, and
+            reads already in the table are ignored.
+
+            Args:
+                read (pysam.AlignedSegment): read to add
+            Returns:
+                complete (bool): True if the pair is complete
+        """
+        flag = read.flag
+        if flag & FLAG_NON_PRIMARY:
+            alignments = self._non_primary.setdefault(read.query_name, [])
+            if _alignment_key(read) not in map(_alignment_key, alignments):
+                alignments.append(read)
+            return False
+        end = 1 if self.ends == 2 and flag & FLAG_READ2 else 0
+        pair = self._pairs.get(read.query_name)
+        if pair is None:
+            pair = self._pairs[read.query_name] = [None] * self.ends
+        elif pair[end] is not None:
+            return False
+        pair[end] = read
+        return None not in pair
+
+    def pending_read(self, read_name):
+        """
+            Returns the read of an incomplete pair
+        """
+        pair = self._pairs[read_name]
+        return pair[0] if pair[0] is not None else pair[1]
+
+    def pop(self, read_name):
+        """
+            Removes pair from the table, and returns its reads in the
+            order first end, second end
+        """
+        return [read for read in self._pairs.pop(read_name) if read is not None]
+
+    def pop_non_primary(self, read_name):
+        """
+            Removes and returns the secondary and supplementary alignments kept
+            for a name
+        """
+        return self._non_primary.pop(read_name, [])
+
+    def names(self):
+        """
+            Returns the names of the pairs in the table
+        """
+        return self._pairs.keys()
+
+    def clear(self):
+        """
+            Removes all pairs from the table
+        """
+        self._pairs.clear()
+        self._non_primary.clear()
+
+    def __contains__(self, read_name):
+        return read_name in self._pairs
+
+    def __len__(self):
+        return len(self._pairs)
+
 
 class BAMContext:
     """
         Context manager to deal with bam files
     """
 
-    def __init__(self, bam_file, out_dir=None):
+    def __init__(self, bam_file, out_dir=None, threads=1, out_format="bam", reference=None,
+                 spill_dir=None, track_read_groups=False):
         """
             Args:
-                bam_file (str): path to bam file
+                bam_file (str): path to bam or cram file
                 out_dir (Path): Directory where new bam-file is created
-                pared (bool): If bam containes paired reads
+                threads (int): number of threads used for BGZF compression and
+                    decompression, shared by the bam file and the output files
+                out_format (str): 'bam' to write the found read pairs to a new
+                    bam-file, or 'fastq' to write them to one gzipped fastq file
+                    per read end
+                reference (str): path to reference fasta, used to decode cram files
+                spill_dir (Path): if given, the found read names are spilled to
+                    disk in this directory instead of being held in memory
+                track_read_groups (bool): if True, the found read names are also
+                    kept by the RG tag of each read in read_group_names, e.g. to
+                    route them to the lanes of a sample
         """
+        if out_format not in OUT_FORMATS:
+            raise ValueError(f"out_format must be one of {OUT_FORMATS}")
+
         self.bam_file = parse_path(bam_file)
         self.file_name = self.bam_file.name
-        self.bam = pysam.AlignmentFile(self.bam_file, "rb")
-        self.paired, self.length, self.insert_size = self._check_bam()
-        self.reads = {}
+        self.threads = threads
+        self.reference = reference
+        # The threads are shared by the bam file and the output files, at most
+        # one per read end, which are read and written together
+        if not out_dir:
+            file_threads = threads
+        elif out_format == "fastq":
+            file_threads = max(threads // 3, 1)
+        else:
+            file_threads = max(threads // 2, 1)
+        self.bam = pysam.AlignmentFile(
+            self.bam_file,
+            "rc" if is_cram(self.bam_file) else "rb",
+            reference_filename=reference,
+            threads=file_threads
+        )
+        self.paired, self.length, self.insert_size_percentiles = self._check_bam()
+        self.insert_size = self.insert_size_percentiles[50]
         self.ends = 2 if self.paired else 1
-        self.found_reads = set()
+        self.reads = ReadPairs(self.ends)
+        # Secondary and supplementary alignments written to the new bam-file
+        self._written_non_primary = set()
+        self.found_reads = ReadNameSet(spill_dir=spill_dir)
+        # The found read names are also kept by the RG tag of the read, or None,
+        # if asked for
+        self.track_read_groups = track_read_groups
+        self.read_group_names = {}
+        self.spill_dir = spill_dir
+        # The names themselves are spooled to disk, to be listed by found_names
+        self._names_spool = tempfile.TemporaryFile("w+t", dir=spill_dir)
         self.out_dir = out_dir
+        self.out_format = out_format
         if self.out_dir:
             self.out_dir = parse_path(out_dir, file_type="dir")
-            self.out_name = out_dir.joinpath("mutacc_" + self.file_name)
-            self.out_bam = pysam.AlignmentFile(self.out_name, "wb", template=self.bam)
+            if self.out_format == "fastq":
+                out_stem = "mutacc_" + self.file_name.split(".")[0]
+                self.out_names = [
+                    self.out_dir.joinpath(f"{out_stem}_R{end + 1}.fastq.gz")
+                    for end in range(self.ends)
+                ]
+                self.out_fastqs = [gzip_writer(out_name, file_threads) for out_name in self.out_names]
+            else:
+                self.out_name = self.out_dir.joinpath(
+                    "mutacc_" + Path(self.file_name).with_suffix(".bam").name
+                )
+                self.out_bam = pysam.AlignmentFile(
+                    self.out_name, "wb", template=self.bam, threads=file_threads
+                )
 
     def __enter__(self):
         return self
@@ -45,14 +216,14 @@ class BAMContext:
         """Closes file handles and deletes tmp files"""
 
         self.bam.close()
+        self._names_spool.close()
 
         if self.out_dir:
-            self.out_bam.close()
-
-        try:
-            os.remove(self.names_temp)
-        except AttributeError:
-            pass
+            if self.out_format == "fastq":
+                for out_fastq in self.out_fastqs:
+                    out_fastq.close()
+            else:
+                self.out_bam.close()
 
     def find_names_from_region(self, chrom, start, end, padding=None):
         """Adds the read names in region to the set found_reads
@@ -66,14 +237,65 @@ class BAMContext:
 
         adjusted_padding = self._adjust_padding(padding)
 
-        read_names = [read.query_name for read in self.bam.fetch(chrom, start-adjusted_padding, end+adjusted_padding)]
-        self.found_reads = self.found_reads.union(set(read_names))
+        for read in self.bam.fetch(chrom, start-adjusted_padding, end+adjusted_padding):
+            self._add_found(read.query_name, self._read_group(read))
+
+    def find_names_from_regions(self, regions, workers=1):
+        """Adds the read names in a batch of regions to the set found_reads.
+
+            The padded regions are sorted on contig and position, and overlapping
+            regions are merged, so that each part of the bam file is only fetched once.
+            With more than one worker, the regions are sharded on contig and each
+            shard is searched in a separate process.
+
+            Args:
+                regions (iterable(dict)): regions with keys 'chrom', 'start', 'end',
+                    and optionally 'padding', e.g. variant objects
+                workers (int): number of processes to use
+        """
+
+        if workers > 1:
+            shards = self._shard_regions(regions)
+            if len(shards) > 1:
+                workers = min(workers, len(shards))
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for found_names in executor.map(
+                            _find_names_in_shard,
+                            itertools.repeat(self.bam_file),
+                            shards,
+                            itertools.repeat(max(self.threads // workers, 1)),
+                            itertools.repeat(self.reference),
+                            itertools.repeat(self.track_read_groups)
+                    ):
+                        for read_name, read_group in found_names:
+                            self._add_found(read_name, read_group)
+                return
+
+        padded_regions = []
+        for region in regions:
+            adjusted_padding = self._adjust_padding(region.get("padding"))
+            padded_regions.append(
+                (
+                    region["chrom"],
+                    max(int(region["start"] - adjusted_padding), 0),
+                    int(region["end"] + adjusted_padding),
+                )
+            )
+
+        padded_regions.sort(key=lambda region: (self.bam.get_tid(region[0]), region[1]))
+
+        for chrom, start, end in merge_regions(padded_regions):
+            for read in self.bam.fetch(chrom, start, end):
+                self._add_found(read.query_name, self._read_group(read))
 
     def find_reads_from_region(self, chrom, start, end, brute=False, find_mates=True, padding=None):
 
         """
             Writes the found reads in region to a new bam-file, if a out-dir is
-            given to the constructor, else adds the read names to set self.found_reads
+            given to the constructor, else adds the read names to set self.found_reads.
+            Read pairs are made of primary alignments. The secondary and
+            supplementary alignments of a found pair, seen in any region, are
+            also written to a new bam-file.
 
             Args:
                 chrom (str): name of contig
@@ -89,20 +311,9 @@ class BAMContext:
         for read in self.bam.fetch(chrom, start-adjusted_padding, end+adjusted_padding):
             read_name = read.query_name
             if read_name in self.found_reads:
+                self._write_non_primary(read)
                 continue
-            pair_list = self.reads.get(read_name)
-            if pair_list is not None:
-                paired_read = pair_list[0]
-                if str(paired_read) == str(read):
-                    continue
-                if read.is_read1:
-                    pair_list.insert(0, read)
-                else:
-                    pair_list.append(read)
-
-            else:
-                self.reads[read_name] = [read]
-            if len(self.reads[read_name]) == self.ends:
+            if self.reads.add(read):
                 self._flush_reads(read_name)
 
         if find_mates:
@@ -115,45 +326,241 @@ class BAMContext:
                     self._find_mates_close(*region)
         self._reset_reads()
 
+    def find_reads_from_regions(self, regions, workers=1):
+        """
+            Finds the read pairs in a batch of regions, see find_reads_from_region.
+            With more than one worker, the regions are sharded on contig, and each
+            shard is searched in a separate process writing its own partial bam-file.
+            The partial bam-files are merged in contig order, so that the result
+            does not depend on which process finishes first.
+
+            Args:
+                regions (iterable(dict)): regions with keys 'chrom', 'start', 'end',
+                    and optionally 'padding', e.g. variant objects
+                workers (int): number of processes to use
+        """
+
+        shards = self._shard_regions(regions)
+        if workers <= 1 or len(shards) <= 1:
+            for region in itertools.chain.from_iterable(shards):
+                self.find_reads_from_region(
+                    chrom=region["chrom"],
+                    start=region["start"],
+                    end=region["end"],
+                    padding=region["padding"]
+                )
+            return
+
+        workers = min(workers, len(shards))
+        shard_dirs = [Path(tempfile.mkdtemp(prefix="shard_", dir=self.out_dir)) for _ in shards]
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                partial_bams = list(
+                    executor.map(
+                        _find_reads_in_shard,
+                        itertools.repeat(self.bam_file),
+                        shards,
+                        shard_dirs,
+                        itertools.repeat(max(self.threads // workers, 1)),
+                        itertools.repeat(self.reference)
+                    )
+                )
+            for partial_bam in partial_bams:
+                # A pair with ends on two contigs is found in both shards, but only
+                # kept from the first one
+                with pysam.AlignmentFile(partial_bam, "rb") as partial_handle:
+                    for read in partial_handle.fetch(until_eof=True):
+                        if read.query_name in self.found_reads:
+                            self._write_non_primary(read)
+                            continue
+                        if self.reads.add(read):
+                            self._flush_reads(read.query_name)
+                self._reset_reads()
+        finally:
+            for shard_dir in shard_dirs:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def _shard_regions(self, regions):
+        """
+            Partitions regions on contig
+
+            Args:
+                regions (iterable(dict)): regions with keys 'chrom', 'start', 'end',
+                    and optionally 'padding'
+            Returns:
+                shards (list(list(dict))): one list of regions per contig, in the
+                    order of the contigs in the bam header
+        """
+        shards = {}
+        for region in regions:
+            shards.setdefault(region["chrom"], []).append(
+                {
+                    "chrom": region["chrom"],
+                    "start": region["start"],
+                    "end": region["end"],
+                    "padding": region.get("padding"),
+                }
+            )
+        return [shards[chrom] for chrom in sorted(shards, key=self.bam.get_tid)]
+
     def _flush_reads(self, read_name: str):
-        """Flushes the read pair to new bam-file
+        """Flushes the read pair to new bam-file, or fastq files. The secondary
+            and supplementary alignments of the name are written to the bam-file
+            as well, but not to the fastq files, which hold each read once.
             Args:
                 read_name (str): read name of read-pairs
         """
+        pair = self.reads.pop(read_name)
+        non_primary = self.reads.pop_non_primary(read_name)
         if self.out_dir:
-            for end in self.reads[read_name]:
-                self.out_bam.write(end)
-        self.found_reads.add(read_name)
-        self.reads.pop(read_name)
+            if self.out_format == "fastq":
+                for end, (read, out_fastq) in enumerate(zip(pair, self.out_fastqs)):
+                    out_fastq.write(self._fastq_record(read, end))
+            else:
+                for end in pair:
+                    self.out_bam.write(end)
+        self._add_found(read_name, self._read_group(pair[0]))
+        for read in non_primary:
+            self._write_non_primary(read)
+
+    def _write_non_primary(self, read):
+        """Writes a secondary or supplementary alignment of a found read pair to
+            the new bam-file, once, e.g. the split alignment of a read supporting
+            a structural variant
+            Args:
+                read (pysam.AlignedSegment): alignment of a found read
+        """
+        if not (self.out_dir and self.out_format == "bam" and read.flag & FLAG_NON_PRIMARY):
+            return
+        key = (read.query_name, *_alignment_key(read))
+        if key not in self._written_non_primary:
+            self._written_non_primary.add(key)
+            self.out_bam.write(read)
+
+    def _add_found(self, read_name, read_group=None):
+        """Adds read name to found_reads, and to the names spool if not found before
+            Args:
+                read_name (str): read name
+                read_group (str): RG tag of the read, or None
+        """
+        if self.found_reads.add(read_name):
+            self._names_spool.write(f"{read_name}\t{read_group or ''}\n")
+            if self.track_read_groups:
+                if read_group not in self.read_group_names:
+                    self.read_group_names[read_group] = ReadNameSet(spill_dir=self.spill_dir)
+                self.read_group_names[read_group].add(read_name)
+
+    def _read_group(self, read):
+        """Gives the RG tag of a read, or None if it has none or read groups
+            are not tracked
+        """
+        if self.track_read_groups and read.has_tag("RG"):
+            return read.get_tag("RG")
+        return None
+
+    def found_names(self):
+        """
+            Yields the names of the found reads, in the order they were found
+        """
+        for read_name, _ in self.found_read_groups():
+            yield read_name
+
+    def found_read_groups(self):
+        """
+            Yields the names of the found reads, with the RG tag of each read or
+            None, in the order they were found
+        """
+        self._names_spool.flush()
+        self._names_spool.seek(0)
+        try:
+            for line in self._names_spool:
+                read_name, read_group = line.rstrip("\n").split("\t")
+                yield read_name, read_group or None
+        finally:
+            self._names_spool.seek(0, os.SEEK_END)
+
+    def _fastq_record(self, read, end):
+        """Formats read as a fastq record, in the orientation it was sequenced.
+            As with picard SamToFastq, the names of paired reads are given
+            the suffix /1 or /2.
+
+            Args:
+                read (pysam.AlignedSegment): read to format
+                end (int): 0 for the first read end, 1 for the second
+            Returns:
+                record (str): fastq record
+        """
+        read_name = read.query_name
+        if self.ends == 2:
+            read_name = f"{read_name}/{end + 1}"
+        sequence = read.get_forward_sequence()
+        qualities = read.get_forward_qualities()
+        if qualities is None:
+            quality_string = "!" * len(sequence)
+        else:
+            quality_string = pysam.qualities_to_qualitystring(qualities)
+        return f"@{read_name}\n{sequence}\n+\n{quality_string}\n"
 
     def _find_mates_explicitly(self):
         """
-            Find mates by looking in bam_file
+            Find mates by looking in bam_file. The mate positions of all unmatched
+            reads are sorted and clustered, and each cluster is fetched once.
         """
-        unmatched_reads = list(self.unmatched_reads)
-        for unmatched_read in unmatched_reads:
-            mate = self._find_mate(self.reads[unmatched_read][0])
-            if mate:
-                if mate.is_read1:
-                    self.reads[unmatched_read].insert(0, mate)
-                else:
-                    self.reads[unmatched_read].append(mate)
-                if self.out_dir:
-                    for end in self.reads[unmatched_read]:
-                        self.out_bam.write(end)
-                self.found_reads.add(unmatched_read)
-            self.reads.pop(unmatched_read)
+        mate_positions = []
+        for read_name in self.unmatched_reads:
+            read = self.reads.pending_read(read_name)
+            if read.is_paired and read.next_reference_id >= 0:
+                mate_positions.append((read.next_reference_id, read.next_reference_start, read_name))
+        mate_positions.sort()
+
+        for tid, start, end, read_names in self._cluster_mate_positions(mate_positions):
+            for mate in self.bam.fetch(self.bam.get_reference_name(tid), start, end):
+                read_name = mate.query_name
+                if read_name not in read_names:
+                    continue
+                if read_name not in self.reads:
+                    continue
+                if self._is_mate(self.reads.pending_read(read_name), mate) and self.reads.add(mate):
+                    self._flush_reads(read_name)
 
-    def _find_mate(self, read):
+        self._reset_reads()
 
+    @staticmethod
+    def _cluster_mate_positions(mate_positions):
         """
-            Find mate for read
+            Groups sorted mate positions into regions that can be fetched at once
+
+            Args:
+                mate_positions (list(tuple)): sorted list of
+                    (reference_id, position, read_name) tuples
+            Yields:
+                (reference_id, start, end, read_names): region covering a cluster
+                    of mate positions, and the names of the reads in the cluster
         """
-        try:
-            mate = self.bam.mate(read)
-        except ValueError:
-            mate = None
-        return mate
+        cluster = None
+        for tid, position, read_name in mate_positions:
+            if cluster and cluster[0] == tid and position - cluster[2] <= MATE_CLUSTER_DISTANCE:
+                cluster[2] = position + 1
+                cluster[3].add(read_name)
+            else:
+                if cluster:
+                    yield tuple(cluster)
+                cluster = [tid, position, position + 1, {read_name}]
+        if cluster:
+            yield tuple(cluster)
+
+    @staticmethod
+    def _is_mate(read, mate):
+        """
+            Checks if mate is the primary alignment of the other end of read
+        """
+        return (
+            mate.is_read1 != read.is_read1
+            and not mate.is_secondary
+            and not mate.is_supplementary
+            and mate.reference_id == read.next_reference_id
+            and mate.reference_start == read.next_reference_start
+        )
 
     def _find_mates_close(self, chrom, start, end):
         """
@@ -162,13 +569,9 @@ class BAMContext:
         for read in self.bam.fetch(chrom, start, end):
             read_name = read.query_name
             if read_name in self.found_reads:
+                self._write_non_primary(read)
                 continue
-            pair_list = self.reads.get(read_name)
-            if pair_list is not None:
-                paired_read = pair_list[0]
-                if str(paired_read) == str(read):
-                    continue
-                pair_list.append(read)
+            if read_name in self.reads and self.reads.add(read):
                 self._flush_reads(read_name)
 
     def _reset_reads(self):
@@ -184,10 +587,19 @@ class BAMContext:
         """
         return str(self.out_name)
 
+    @property
+    def out_files(self):
+        """
+            returns output files, the bam-file or one fastq file per read end
+        """
+        if self.out_format == "fastq":
+            return [str(out_name) for out_name in self.out_names]
+        return [self.out_file]
+
     @property
     def unmatched_reads(self):
         """Returns reads without found mates"""
-        _unmatched_reads = self.reads.keys()
+        _unmatched_reads = self.reads.names()
         return _unmatched_reads
 
     @property
@@ -197,51 +609,124 @@ class BAMContext:
         """
         return len(self.found_reads)
 
-    def make_names_temp(self, out_dir):
-        """
-            Make temporary file holding each read name on separate line
-        """
-        with tempfile.NamedTemporaryFile("wt", dir=out_dir, delete=False) as temp_file:
-            temp_file.write("####READ NAMES####\n")
-            for name in self.found_reads:
-                temp_file.write(name + "\n")
-            self.names_temp = temp_file.name
-        return self.names_temp
-
-
     def _check_bam(self):
 
-        """Checks if reads in bam are paired
-        Args:
-            bam_file (path): path to bam file
+        """Checks if reads in bam are paired, and estimates the read length and
+        insert size distribution. The statistics are cached in a sidecar file in
+        the directory given to set_stats_cache, or else next to the bam file, and
+        only computed again if the bam file has changed.
 
         Returns:
-            (paired (bool), mean_length (int), median_insert_size (int)):
+            (paired (bool), mean_length (float), insert_size_percentiles (dict)):
             paired: True if reads are paired
             mean_length: mean read length
-            median_insert_size: median insert size
+            insert_size_percentiles: insert size for each percentile in
+                INSERT_SIZE_PERCENTILES
+        """
+
+        stat_result = os.stat(self.bam_file)
+        key = {
+            "path": str(self.bam_file),
+            "size": stat_result.st_size,
+            "mtime": stat_result.st_mtime,
+        }
+        sidecar = stats_cache_path(self.bam_file)
+
+        stats = None
+        try:
+            with open(sidecar, "r") as sidecar_handle:
+                cached = json.load(sidecar_handle)
+            if cached.get("key") == key:
+                stats = cached["stats"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if stats is None:
+            stats = self._sample_bam_stats()
+            _write_stats_cache(sidecar, {"key": key, "stats": stats})
+
+        insert_size_percentiles = {
+            int(percentile): insert_size
+            for percentile, insert_size in stats["insert_size_percentiles"].items()
+        }
+        return stats["paired"], stats["length"], insert_size_percentiles
+
+    def _sample_bam_stats(self):
+        """Estimates the bam statistics from a sample of the primary alignments
+
+        Returns:
+            stats (dict): dictionary with keys 'paired', 'length', and
+                'insert_size_percentiles'
         """
 
         insert_sizes = []
         acc_length = 0
         paired = False
         read_count = 0
-        MAX_READ_COUNT = 10000
-        for read in self.bam:
+        for read in self._sample_reads():
             read_count += 1
             if read.is_paired:
                 paired = True
             acc_length += read.query_length
-            insert_sizes.append(abs(read.template_length))
-            if read_count == MAX_READ_COUNT:
-                break
-        mean_length = acc_length / read_count
+            if read.template_length > 0:
+                insert_sizes.append(read.template_length)
+        mean_length = acc_length / read_count if read_count else 0
         insert_sizes.sort()
-        median_insert_size = insert_sizes[int(read_count/2)]
-
-
-        return paired, mean_length, median_insert_size
+        insert_size_percentiles = {
+            str(percentile): (
+                insert_sizes[int(len(insert_sizes) * percentile / 100)] if insert_sizes else 0
+            )
+            for percentile in INSERT_SIZE_PERCENTILES
+        }
+
+        return {
+            "paired": paired,
+            "length": mean_length,
+            "insert_size_percentiles": insert_size_percentiles,
+        }
+
+    def _sample_reads(self):
+        """Samples primary alignments evenly across the mapped reads in the bam
+        index. Each contig is split into strata in proportion to its number of
+        mapped reads, and a fixed number of reads is taken from each stratum.
+        If a stratum holds too few reads, the remainder is taken from the next.
+        Falls back to the first reads in the file if there is no index.
+
+        Yields:
+            read (pysam.AlignedSegment): sampled read
+        """
 
+        try:
+            contig_stats = [stat for stat in self.bam.get_index_statistics() if stat.mapped > 0]
+        except ValueError:
+            contig_stats = []
+
+        if not contig_stats:
+            reads = (
+                read for read in self.bam.fetch(until_eof=True)
+                if not read.flag & FLAG_NON_PRIMARY
+            )
+            yield from itertools.islice(reads, STATS_READ_COUNT)
+            return
+
+        total_mapped = sum(stat.mapped for stat in contig_stats)
+        reads_per_stratum = STATS_READ_COUNT // STATS_STRATA
+        quota = 0
+        for stat in contig_stats:
+            contig_length = self.bam.get_reference_length(stat.contig)
+            strata = max(1, round(STATS_STRATA * stat.mapped / total_mapped))
+            for stratum in range(strata):
+                quota += reads_per_stratum
+                start = contig_length * stratum // strata
+                end = contig_length * (stratum + 1) // strata
+                for read in self.bam.fetch(stat.contig, start, end):
+                    if quota == 0:
+                        break
+                    # Only count reads starting in the stratum, so that no read is sampled twice
+                    if read.flag & FLAG_NON_PRIMARY or read.reference_start < start:
+                        continue
+                    quota -= 1
+                    yield read
 
     def _adjust_padding(self, padding):
         """Given the read lengths in a BAM, calculate the real padding needed taking
@@ -260,3 +745,153 @@ class BAMContext:
             adjusted_padding = 0
 
         return adjusted_padding
+
+
+def is_cram(file_path):
+    """
+        Checks if file is a cram file, from its magic number
+
+        Args:
+            file_path (Path): path to alignment file
+        Returns:
+            (bool): True if file is a cram file
+    """
+    with open(file_path, "rb") as file_handle:
+        return file_handle.read(len(CRAM_MAGIC)) == CRAM_MAGIC
+
+
+def bin_read_names(bam_file, bin_size, spill_dir=None, threads=1, reference=None):
+    """
+        Maps the name of every read in a bam file to the genomic bin of its
+        leftmost alignment. The bins are numbered in the order of the contigs
+        in the header, so that the bins of a contig follow each other. Unmapped
+        reads are placed in the bin of their mate, and read names with no
+        placed alignment are left out.
+
+        Args:
+            bam_file (str): path to bam or cram file
+            bin_size (int): size of each bin in bp
+            spill_dir (Path): directory where the runs of the map are written
+            threads (int): number of threads used for BGZF decompression
+            reference (str): path to reference fasta, used to decode cram files
+        Returns:
+            read_name_bins (mutacc.utils.read_names.ReadNameBins): map of read
+                names to bins, to be saved
+            contigs (list(tuple)): name, length and first bin of each contig
+    """
+    bam_file = parse_path(bam_file)
+    read_name_bins = ReadNameBins(spill_dir=spill_dir)
+    with pysam.AlignmentFile(
+        bam_file,
+        "rc" if is_cram(bam_file) else "rb",
+        reference_filename=reference,
+        threads=threads
+    ) as bam:
+        contigs = []
+        first_bins = []
+        first_bin = 0
+        for name, length in zip(bam.references, bam.lengths):
+            contigs.append((name, length, first_bin))
+            first_bins.append(first_bin)
+            first_bin += length // bin_size + 1
+
+        for read in bam.fetch(until_eof=True):
+            if read.reference_id < 0:
+                continue
+            read_name_bins.add(
+                read.query_name,
+                first_bins[read.reference_id] + read.reference_start // bin_size
+            )
+
+    return read_name_bins, contigs
+
+
+def set_reference_cache(cache_dir):
+    """
+        Makes htslib look up and store the reference sequences used to decode
+        cram files in a local directory, keyed on the MD5 of each sequence. This
+        is inherited by the worker processes.
+
+        Args:
+            cache_dir (Path): path to reference cache directory
+    """
+    cache_pattern = os.path.join(str(cache_dir), "%2s", "%2s", "%s")
+    os.environ["REF_CACHE"] = cache_pattern
+    os.environ["REF_PATH"] = cache_pattern
+
+
+def set_stats_cache(cache_dir):
+    """
+        Makes the statistics of bam files be cached in a local directory instead
+        of next to each bam file, which may be on read-only storage. This is
+        inherited by the worker processes.
+
+        Args:
+            cache_dir (Path): path to statistics cache directory
+    """
+    os.environ[STATS_CACHE_ENV] = str(cache_dir)
+
+
+def stats_cache_path(bam_file):
+    """
+        Gives the path to the sidecar file caching the statistics of a bam file.
+        Files in the cache directory are told apart by a hash of the bam path.
+
+        Args:
+            bam_file (Path): path to bam file
+        Returns:
+            (Path): path to sidecar file
+    """
+    bam_file = Path(bam_file)
+    cache_dir = os.environ.get(STATS_CACHE_ENV)
+    if not cache_dir:
+        return bam_file.with_name(bam_file.name + STATS_SUFFIX)
+    path_hash = hashlib.md5(str(bam_file.resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir).joinpath(f"{path_hash}_{bam_file.name}{STATS_SUFFIX}")
+
+
+def _write_stats_cache(sidecar, content):
+    """
+        Writes a sidecar file through a temporary file in the same directory,
+        moved into place, so that processes opening the same bam file never
+        read a partly written file
+    """
+    temp_name = None
+    try:
+        with tempfile.NamedTemporaryFile("w", dir=sidecar.parent, prefix=sidecar.name,
+                                         suffix=".tmp", delete=False) as temp_handle:
+            temp_name = temp_handle.name
+            json.dump(content, temp_handle)
+        os.replace(temp_name, sidecar)
+    except OSError as error:
+        log_msg = f"Could not cache bam statistics in {sidecar}: {error}"
+        LOG.warning(log_msg)
+        if temp_name is not None and os.path.exists(temp_name):
+            os.remove(temp_name)
+
+
+def _alignment_key(read):
+    """
+        Tells apart the alignments of a read name
+    """
+    return read.flag, read.reference_id, read.reference_start
+
+
+def _find_names_in_shard(bam_file, regions, threads, reference, track_read_groups):
+    """
+        Finds the read names in a shard of regions, in a worker process
+    """
+    with BAMContext(bam_file, threads=threads, reference=reference,
+                    track_read_groups=track_read_groups) as bam_handle:
+        bam_handle.find_names_from_regions(regions)
+        return list(bam_handle.found_read_groups())
+
+
+def _find_reads_in_shard(bam_file, regions, out_dir, threads, reference):
+    """
+        Writes the read pairs in a shard of regions to a partial bam-file in
+        out_dir, in a worker process
+    """
+    with BAMContext(bam_file, out_dir=out_dir, threads=threads, reference=reference) as bam_handle:
+        bam_handle.find_reads_from_regions(regions)
+        return bam_handle.out_file
@@ -0,0 +1,180 @@
+"""
+    Module with checksums of the files written by mutacc, computed while the
+    files are written
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+LOG = logging.getLogger(__name__)
+
+# Manifest of the checksums of the files in a directory
+MANIFEST_NAME = "mutacc_checksums.json"
+
+# Number of bytes hashed at a time when reading a file
+HASH_CHUNK_SIZE = 1 << 22
+
+
+def checksum_algorithms():
+    """
+        Gives the checksums computed: md5, and xxh64 if xxhash is installed
+
+        Returns:
+            (tuple(str)): names of the checksums
+    """
+    if xxhash is None:
+        return ("md5",)
+    return ("md5", "xxh64")
+
+
+def _new_hash(algorithm):
+    """
+        Starts a checksum computation
+    """
+    if algorithm == "xxh64":
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+class ChecksumFile:
+    """
+        File handle writing bytes to a file, and computing the checksums of the
+        bytes written. A gzip writer given this handle computes the checksums of
+        the compressed file.
+    """
+
+    def __init__(self, file_name, algorithms=None):
+        """
+            Args:
+                file_name (str): path to file
+                algorithms (tuple(str)): checksums to compute, defaults to
+                    those given by checksum_algorithms
+        """
+        self.name = str(file_name)
+        self._handle = open(file_name, "wb")
+        self._hashes = {
+            algorithm: _new_hash(algorithm)
+            for algorithm in (algorithms or checksum_algorithms())
+        }
+
+    def write(self, data):
+        for file_hash in self._hashes.values():
+            file_hash.update(data)
+        return self._handle.write(data)
+
+    def flush(self):
+        self._handle.flush()
+
+    def tell(self):
+        return self._handle.tell()
+
+    @property
+    def closed(self):
+        return self._handle.closed
+
+    def close(self):
+        self._handle.close()
+
+    def digests(self):
+        """
+            Gives the checksums of the bytes written so far
+
+            Returns:
+                (dict): hex digest of each checksum
+        """
+        return {algorithm: file_hash.hexdigest() for algorithm, file_hash in self._hashes.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def file_checksums(file_path, algorithms=None):
+    """
+        Computes the checksums of a file, reading it in chunks
+
+        Args:
+            file_path (str): path to file
+            algorithms (tuple(str)): checksums to compute, defaults to those
+                given by checksum_algorithms
+        Returns:
+            (dict): hex digest of each checksum
+    """
+    hashes = {
+        algorithm: _new_hash(algorithm) for algorithm in (algorithms or checksum_algorithms())
+    }
+    with open(file_path, "rb") as file_handle:
+        while True:
+            chunk = file_handle.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            for file_hash in hashes.values():
+                file_hash.update(chunk)
+    return {algorithm: file_hash.hexdigest() for algorithm, file_hash in hashes.items()}
+
+
+def write_checksums(file_path, digests):
+    """
+        Adds the checksums of a file to the manifest of its directory, together
+        with the size and modification time of the file. The manifest is locked
+        while it is updated, since the files of a directory may be written by
+        several processes.
+
+        Args:
+            file_path (str): path to file
+            digests (dict): hex digest of each checksum
+    """
+    file_path = Path(file_path)
+    file_stat = os.stat(file_path)
+    entry = {"size": file_stat.st_size, "mtime": file_stat.st_mtime, **digests}
+    manifest_path = file_path.parent.joinpath(MANIFEST_NAME)
+    with open(manifest_path, "a+") as manifest_handle:
+        fcntl.flock(manifest_handle, fcntl.LOCK_EX)
+        manifest_handle.seek(0)
+        content = manifest_handle.read()
+        manifest = json.loads(content) if content else {}
+        manifest[file_path.name] = entry
+        manifest_handle.seek(0)
+        manifest_handle.truncate()
+        json.dump(manifest, manifest_handle, indent=2)
+
+
+def read_checksums(file_path):
+    """
+        Finds the checksums of a file in the manifest of its directory. The
+        checksums are only given if the file has the size and modification time
+        it had when they were computed.
+
+        Args:
+            file_path (str): path to file
+        Returns:
+            (dict): hex digest of each checksum, or None if not found
+    """
+    file_path = Path(file_path)
+    manifest_path = file_path.parent.joinpath(MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r") as manifest_handle:
+            fcntl.flock(manifest_handle, fcntl.LOCK_SH)
+            manifest = json.load(manifest_handle)
+    except (OSError, ValueError):
+        return None
+
+    entry = manifest.get(file_path.name)
+    if entry is None:
+        return None
+    file_stat = os.stat(file_path)
+    if entry.pop("size") != file_stat.st_size or entry.pop("mtime") != file_stat.st_mtime:
+        LOG.warning("Checksums of %s are out of date", file_path)
+        return None
+    return entry
@@ -0,0 +1,387 @@
+"""
+    Module with functions to open compressed files
+"""
+
+import gzip
+import io
+import logging
+import queue
+import shutil
+import subprocess
+import threading
+import zlib
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+LOG = logging.getLogger(__name__)
+
+PIGZ = "pigz"
+IGZIP = "igzip"
+
+# Decompression backends, in order of preference
+DECOMPRESSION_BACKENDS = ("isal", IGZIP, PIGZ, "zlib")
+
+# Size of the chunks read ahead, and the number of chunks held in the queue
+READ_AHEAD_SIZE = 1 << 22
+READ_AHEAD_CHUNKS = 4
+
+# Every BGZF block starts with a gzip header with a single 'BC' extra field,
+# holding the size of the block
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_SUBFIELD = b"BC\x02\x00"
+BGZF_HEADER_SIZE = 18
+
+
+class PipedGzipWriter:
+    """
+        File handle writing gzip compressed data through a pigz process,
+        compressing with several threads
+    """
+
+    def __init__(self, file_name, threads, pigz_exe=PIGZ, mode="wt", compresslevel=9):
+        """
+            Args:
+                file_name (str): path to gzip file, or a binary file handle
+                    to write to, which is left open
+                threads (int): number of compression threads
+                pigz_exe (str): path to pigz executable
+                mode (str): 'wt' to write text, or 'wb' to write bytes
+                compresslevel (int): compression level, from 1 to 9
+        """
+        self._copy_thread = None
+        if hasattr(file_name, "write"):
+            self.name = getattr(file_name, "name", None)
+            self._out_handle = file_name
+            self._owns_out_handle = False
+        else:
+            self.name = str(file_name)
+            self._out_handle = open(file_name, "wb")
+            self._owns_out_handle = True
+        # A handle without a file descriptor is given the output through a thread.
+        # Data buffered in a handle with one is flushed before pigz writes to it
+        try:
+            self._out_handle.fileno()
+            self._out_handle.flush()
+            stdout = self._out_handle
+        except (AttributeError, OSError):
+            stdout = subprocess.PIPE
+        self._process = subprocess.Popen(
+            [pigz_exe, "-c", f"-{compresslevel}", "-p", str(threads)],
+            stdin=subprocess.PIPE,
+            stdout=stdout,
+        )
+        if stdout is subprocess.PIPE:
+            self._copy_thread = threading.Thread(target=self._copy_output, daemon=True)
+            self._copy_thread.start()
+        if "b" in mode:
+            self._in_handle = self._process.stdin
+        else:
+            self._in_handle = io.TextIOWrapper(self._process.stdin)
+
+    def _copy_output(self):
+        """
+            Copies the compressed data from pigz to the output handle
+        """
+        shutil.copyfileobj(self._process.stdout, self._out_handle, READ_AHEAD_SIZE)
+
+    def write(self, data):
+        return self._in_handle.write(data)
+
+    def close(self):
+        """
+            Closes the pipe and waits for pigz to finish
+        """
+        if self._in_handle.closed:
+            return
+        self._in_handle.close()
+        exit_status = self._process.wait()
+        if self._copy_thread is not None:
+            self._copy_thread.join()
+            self._process.stdout.close()
+        if self._owns_out_handle:
+            self._out_handle.close()
+        if exit_status != 0:
+            raise subprocess.CalledProcessError(returncode=exit_status, cmd=PIGZ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def gzip_writer(file_name, threads=1, mode="wt", compresslevel=9):
+    """
+        Opens a gzip file for writing. If more than one thread is given, and
+        pigz is installed, the data is compressed by pigz using all threads.
+        Else the data is compressed in this thread.
+
+        Args:
+            file_name (str): path to gzip file, or a binary file handle to
+                write to, which is left open when the gzip file is closed
+            threads (int): number of compression threads
+            mode (str): 'wt' to write text, or 'wb' to write bytes
+            compresslevel (int): compression level, from 1 to 9
+        Returns:
+            handle: file handle with write and close methods
+    """
+    if threads > 1:
+        pigz_exe = shutil.which(PIGZ)
+        if pigz_exe:
+            return PipedGzipWriter(file_name, threads, pigz_exe=pigz_exe, mode=mode,
+                                   compresslevel=compresslevel)
+        LOG.debug("pigz not found, compressing %s with one thread", file_name)
+    return gzip.open(file_name, mode, compresslevel=compresslevel)
+
+
+class PipedGzipReader:
+    """
+        File handle reading gzip compressed data decompressed by an igzip or
+        pigz process
+    """
+
+    def __init__(self, file_name, executable, mode="rt"):
+        """
+            Args:
+                file_name (str): path to gzip file
+                executable (str): path to igzip or pigz executable
+                mode (str): 'rt' to read text, or 'rb' to read bytes
+        """
+        self.name = str(file_name)
+        self._executable = executable
+        self._at_eof = False
+        self._process = subprocess.Popen(
+            [executable, "-dc", self.name],
+            stdout=subprocess.PIPE,
+        )
+        if "b" in mode:
+            self._out_handle = self._process.stdout
+        else:
+            self._out_handle = io.TextIOWrapper(self._process.stdout)
+
+    def read(self, size=-1):
+        data = self._out_handle.read(size)
+        if not data or size is None or size < 0:
+            self._at_eof = True
+        return data
+
+    def readline(self, size=-1):
+        line = self._out_handle.readline(size)
+        if not line:
+            self._at_eof = True
+        return line
+
+    def __iter__(self):
+        yield from self._out_handle
+        self._at_eof = True
+
+    @property
+    def closed(self):
+        return self._out_handle.closed
+
+    def close(self):
+        """
+            Closes the pipe. If the whole file was read, waits for the
+            decompression process and checks its exit status, so that a failure
+            on corrupt or truncated input is raised. If the pipe is closed
+            before the end, the process is stopped.
+        """
+        if self._out_handle.closed:
+            return
+        if not self._at_eof:
+            self._process.kill()
+            self._process.wait()
+            self._out_handle.close()
+            return
+        self._out_handle.close()
+        self._process.wait()
+        if self._process.returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode=self._process.returncode,
+                cmd=self._executable
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def gzip_reader(file_name, mode="rt", backends=DECOMPRESSION_BACKENDS):
+    """
+        Opens a gzip file for reading with the first available backend. The
+        isal backend uses the python bindings to ISA-L, the igzip and pigz
+        backends decompress in a separate process, and zlib is used by the
+        gzip module of the standard library.
+
+        Args:
+            file_name (str): path to gzip file
+            mode (str): 'rt' to read text, or 'rb' to read bytes
+            backends (tuple(str)): backends to try, in order
+        Returns:
+            handle: file handle with read, readline and close methods
+    """
+    for backend in backends:
+        if backend == "isal":
+            if igzip is not None:
+                return igzip.open(file_name, mode)
+        elif backend == "zlib":
+            return gzip.open(file_name, mode)
+        else:
+            executable = shutil.which(backend)
+            if executable:
+                return PipedGzipReader(file_name, executable, mode=mode)
+        LOG.debug("decompression backend %s not found", backend)
+    raise ValueError(f"no decompression backend found among {backends}")
+
+
+class ReadAheadReader:
+    """
+        File handle reading chunks of a file in a separate thread, so that
+        decompression of the next chunks overlaps with the work done on the
+        current one. The chunks are passed through a bounded queue, so the
+        thread stops reading ahead when the queue is full.
+    """
+
+    def __init__(self, handle, chunk_size=READ_AHEAD_SIZE, chunks=READ_AHEAD_CHUNKS):
+        """
+            Args:
+                handle: file handle to read, which is closed with the reader
+                chunk_size (int): number of bytes read at a time
+                chunks (int): number of chunks held in the queue
+        """
+        self.name = getattr(handle, "name", None)
+        self._handle = handle
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=chunks)
+        self._stop = threading.Event()
+        self._at_end = False
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self):
+        """
+            Reads chunks into the queue until the end of the file, or until the
+            reader is closed. An exception is passed on to be raised by read.
+        """
+        try:
+            while not self._stop.is_set():
+                chunk = self._handle.read(self._chunk_size)
+                self._queue.put(chunk)
+                if not chunk:
+                    return
+        except Exception as error:
+            self._queue.put(error)
+
+    def read(self, size=-1):
+        """
+            Gives the next chunk read ahead, regardless of size. An empty chunk
+            is given at the end of the file.
+        """
+        if self._at_end:
+            return b""
+        chunk = self._queue.get()
+        if isinstance(chunk, Exception):
+            self._at_end = True
+            raise chunk
+        if not chunk:
+            self._at_end = True
+        return chunk
+
+    def close(self):
+        """
+            Stops the read ahead thread, and closes the file
+        """
+        if self._handle.closed:
+            return
+        self._stop.set()
+        # Empties the queue, so that the thread is not blocked on a full queue
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._thread.join()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def is_bgzf(file_name):
+    """
+        Checks if a file is BGZF compressed, e.g. by bgzip
+
+        Args:
+            file_name (str): path to file
+        Returns:
+            (bool): True if the file starts with a BGZF block
+    """
+    with open(file_name, "rb") as handle:
+        header = handle.read(BGZF_HEADER_SIZE)
+    return header[:4] == BGZF_MAGIC and header[12:16] == BGZF_SUBFIELD
+
+
+def bgzf_block_offsets(file_name):
+    """
+        Finds the blocks of a BGZF file, reading only the block headers and the
+        decompressed size at the end of each block
+
+        Args:
+            file_name (str): path to BGZF file
+        Yields:
+            (offset (int), size (int)): file offset of each block, and the size
+                of its decompressed data
+    """
+    offset = 0
+    with open(file_name, "rb") as handle:
+        while True:
+            header = handle.read(BGZF_HEADER_SIZE)
+            if not header:
+                return
+            block_size = _bgzf_block_size(header)
+            handle.seek(offset + block_size - 4)
+            yield offset, int.from_bytes(handle.read(4), "little")
+            offset += block_size
+            handle.seek(offset)
+
+
+def read_bgzf_block(handle):
+    """
+        Reads and decompresses the BGZF block at the current position
+
+        Args:
+            handle: BGZF file handle opened in binary mode
+        Returns:
+            (bytes): decompressed block, or None at the end of the file
+    """
+    header = handle.read(BGZF_HEADER_SIZE)
+    if not header:
+        return None
+    block_size = _bgzf_block_size(header) - BGZF_HEADER_SIZE
+    block = handle.read(block_size)
+    if len(block) != block_size:
+        raise ValueError(f"Truncated BGZF block in {handle.name}")
+    # The block ends with the CRC32 and the size of the decompressed data
+    data = zlib.decompress(block[:-8], wbits=-15)
+    if zlib.crc32(data) != int.from_bytes(block[-8:-4], "little") \
+            or len(data) != int.from_bytes(block[-4:], "little"):
+        raise ValueError(f"Corrupt BGZF block in {handle.name}")
+    return data
+
+
+def _bgzf_block_size(header):
+    """
+        Gives the size of a BGZF block from its header
+    """
+    if len(header) < BGZF_HEADER_SIZE or header[:4] != BGZF_MAGIC \
+            or header[12:16] != BGZF_SUBFIELD:
+        raise ValueError("Invalid BGZF block header")
+    return int.from_bytes(header[16:18], "little") + 1
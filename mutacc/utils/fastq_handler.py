@@ -2,18 +2,204 @@
     Module with functions to parse fastqs
 """
 
+from array import array
 import gzip
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import json
 import logging
+import mmap
+import os
 from pathlib import Path
-from contextlib import ExitStack
-
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+import re
+import shutil
+from contextlib import ExitStack, nullcontext
+import tempfile
+import time
 
 from mutacc.parse.path_parse import parse_path, get_file_handle
+from mutacc.utils.compression import (gzip_writer, is_bgzf, bgzf_block_offsets, read_bgzf_block,
+                                      ReadAheadReader)
+from mutacc.utils.read_names import ReadNameSet, ReadNameUnion, fingerprint
+from mutacc.utils.metrics import ScanMetrics
+from mutacc.utils.checksums import ChecksumFile, write_checksums
+from mutacc.utils.process_pool import process_pool
 
 LOG = logging.getLogger(__name__)
 
-def fastq_extract(fastq_files: list, record_ids: set, dir_path=''):
+# Number of decompressed bytes scanned at a time
+CHUNK_SIZE = 1 << 22
+
+# Compressed size of the ranges of BGZF blocks scanned by each process
+BGZF_RANGE_SIZE = 1 << 24
+
+# Read names searched for in a process scanning BGZF blocks
+_RECORD_NAMES = None
+
+# Suffix of the read name index written next to a fastq file
+INDEX_SUFFIX = ".mutacc_idx"
+
+# Number of index entries sorted in memory at a time when building an index
+INDEX_RUN_SIZE = 1 << 22
+
+# Number of bytes read at an indexed offset to find the record
+RECORD_READ_SIZE = 1 << 12
+
+# Number of bytes of records held in memory when splitting a fastq file into
+# shards, before each shard is compressed into a gzip member
+SHARD_BUFFER_LIMIT = 1 << 28
+
+# Compression level of the gzip members of shards
+SHARD_COMPRESS_LEVEL = 6
+
+#Lane tag in a fastq file name, e.g. L001 in sample_L001_R1_001.fastq.gz
+LANE_TAG = re.compile(r"(^|[._-])L\d+(?=[._-]|$)")
+
+def fastq_records(handle, chunk_size=CHUNK_SIZE):
+
+    """
+
+        Scans a fastq file in large chunks of bytes, finding the record boundaries
+        with bytes.find. Nothing is decoded, and each record is given as a view
+        into the chunk, so that it can be written verbatim. Records are assumed to
+        span four lines each.
+
+        Args:
+
+            handle: fastq file handle opened in binary mode
+            chunk_size (int): number of bytes read at a time
+
+        Yields:
+
+            (read_name (bytes), record (memoryview)): the read name, without comment
+                and /1 or /2 suffix, and the whole record including its last newline
+
+    """
+
+    data = b""
+    at_end = False
+    while not at_end:
+        chunk = handle.read(chunk_size)
+        if chunk:
+            data = data + chunk
+        else:
+            at_end = True
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+
+        view = memoryview(data)
+        position = yield from _split_records(data, view)
+        view.release()
+        data = data[position:]
+
+    if data.strip():
+        raise ValueError(f"Truncated fastq record at end of file: {data[:100]}")
+
+def mapped_fastq_records(fastq_file, metrics=None):
+
+    """
+
+        Scans an uncompressed fastq file through a memory map, finding the records
+        directly in the mapped file. Records are given as views into the map, and
+        reading the file is left to the page cache of the OS.
+
+        Args:
+
+            fastq_file (Path): path to uncompressed fastq file
+            metrics (mutacc.utils.metrics.ScanMetrics): if given, the bytes scanned
+                are added when the scan is done or closed. The reading is done in page
+                faults while parsing, so the metrics are marked as not timing it
+
+        Yields:
+
+            (read_name (bytes), record (memoryview)): as given by fastq_records
+
+    """
+
+    if metrics is not None:
+        metrics.reading_timed = False
+    with open(fastq_file, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+    # The map is closed when the last view of it is released
+    position = 0
+    try:
+        for read_name, record in _split_records(mapped, memoryview(mapped)):
+            yield read_name, record
+            position += len(record)
+        tail = mapped[position:]
+        if tail.strip():
+            # The last record has no final newline
+            tail += b"\n"
+            tail_position = yield from _split_records(tail, memoryview(tail))
+            if tail[tail_position:].strip():
+                raise ValueError(f"Truncated fastq record at end of file: {tail[:100]}")
+            position = len(mapped)
+    finally:
+        if metrics is not None:
+            metrics.add(decompressed_bytes=position)
+
+def _split_records(data, view):
+
+    """
+
+        Finds the whole fastq records in data
+
+        Args:
+
+            data (bytes or mmap.mmap): data starting with a fastq record
+            view (memoryview): view of data
+
+        Yields:
+
+            (read_name (bytes), record (memoryview)): as given by fastq_records
+
+        Returns:
+
+            position (int): position after the last whole record
+
+    """
+
+    find = data.find
+    position = 0
+    while True:
+        header_end = find(b"\n", position)
+        if header_end < 0:
+            break
+        sequence_end = find(b"\n", header_end + 1)
+        if sequence_end < 0:
+            break
+        separator_end = find(b"\n", sequence_end + 1)
+        if separator_end < 0:
+            break
+        record_end = find(b"\n", separator_end + 1) + 1
+        if record_end == 0:
+            break
+        if data[position] != ord("@") or data[sequence_end + 1] != ord("+"):
+            raise ValueError(f"Invalid fastq record: {bytes(view[position:record_end])}")
+
+        # Example: if the header is '@ST-E00266:38:H2TF5CCXX:8:1101:2563:2170 1:N:0:CGCGCATT'
+        # the read name is 'ST-E00266:38:H2TF5CCXX:8:1101:2563:2170'
+        name_end = find(b" ", position, header_end)
+        if name_end < 0:
+            name_end = header_end
+        read_name = data[position + 1:name_end]
+        if b"/" in read_name or b"\t" in read_name or b"\r" in read_name:
+            read_name = read_name.split(None, 1)[0].split(b"/", 1)[0]
+
+        yield read_name, view[position:record_end]
+        position = record_end
+
+    return position
+
+def fastq_extract(fastq_files: list, record_ids, dir_path='', threads=1, workers=1,
+                  index=False, metrics_callback=None, checksums=True):
 
     """
 
@@ -23,8 +209,18 @@ def fastq_extract(fastq_files: list, record_ids: set, dir_path=''):
         Args:
 
             fastq_files (list): List of fastq files
-            record_ids (set): Set of read names
+            record_ids (set or mutacc.utils.read_names.ReadNameSet): Set of read names
             dir_path (string): path to directory where new fastq files are written to
+            threads (int): number of threads used to compress the output files, shared
+                between them
+            workers (int): number of processes used to scan BGZF compressed fastq files
+            index (bool): if True, an index of the read names is built for each fastq
+                file that has none, so that this and later extractions read only the
+                records needed. An existing index is used regardless
+            metrics_callback (callable): called with the mutacc.utils.metrics.ScanMetrics
+                of the scan when it is done
+            checksums (bool): if True, the checksums of the fastq files are computed
+                while they are written, and added to the manifest of dir_path
 
         Returns:
 
@@ -40,58 +236,1318 @@ def fastq_extract(fastq_files: list, record_ids: set, dir_path=''):
 
     dir_path = parse_path(dir_path, file_type='dir')
 
+    record_names = _as_record_names(record_ids)
+
     #Uses ExitStack context manager to manage a variable number of
     #files
     with ExitStack() as stack:
-        #Opens fastq files and places file handles in list fastq_handles and Opens __exit__ method
-        # to the ExitStack callback stack.
-        fastq_handles = [stack.enter_context(get_file_handle(fastq_file)) \
-                for fastq_file in fastq_files]
 
-        #Opens fastq files to write found records.
-        out_handles = [stack.enter_context(gzip.open(dir_path.joinpath(file_name + "_mutacc" +
-                                                                       ".fastq.gz"), 'wt')) \
-                for file_name in file_names]
+        #Opens fastq files to write found records. The compressed data is hashed
+        #on its way to the file
+        out_paths = [str(dir_path.joinpath(file_name + "_mutacc" + ".fastq.gz"))
+                     for file_name in file_names]
+        out_files = out_paths
+        if checksums:
+            out_files = [stack.enter_context(ChecksumFile(out_path)) for out_path in out_paths]
+        #The threads are shared by the output files, which are written together
+        out_threads = max(threads // len(out_files), 1)
+        out_handles = [stack.enter_context(gzip_writer(out_file, out_threads, mode='wb'))
+                       for out_file in out_files]
+
+        fastq_indexes = [stack.enter_context(fastq_index) for fastq_index in
+                         _get_fastq_indexes(fastq_files, build=index) if fastq_index]
+
+        #Indexed fastq files are read at the offsets of the records only
+        if len(fastq_indexes) == len(fastq_files):
+            metrics = ScanMetrics(mode="index")
+        #BGZF compressed fastq files are split into block ranges, scanned in parallel
+        elif workers > 1 and all(is_bgzf(fastq_file) for fastq_file in fastq_files):
+            metrics = ScanMetrics(mode="bgzf")
+        else:
+            metrics = ScanMetrics(mode="serial")
+        metrics.input_bytes = sum(os.path.getsize(fastq_file) for fastq_file in fastq_files)
+        metrics.start()
+
+        #Writes to the output files are timed
+        out_writers = [metrics.writer(out_handle) for out_handle in out_handles]
+
+        if metrics.mode == "index":
+            records_found = _index_extract(fastq_files, fastq_indexes, record_names, out_writers,
+                                           metrics)
+            LOG.info("%s READS FOUND", records_found)
+
+        elif metrics.mode == "bgzf":
+            records_found = _bgzf_extract(fastq_files, record_names, out_writers, workers, metrics)
+            LOG.info("%s READS FOUND", records_found)
+
+        else:
+            fastqs = [_scan_fastq(fastq_file, stack, metrics) for fastq_file in fastq_files]
+
+            _serial_extract(fastqs, record_names, out_writers, metrics)
+
+    if checksums:
+        for out_file in out_files:
+            write_checksums(out_file.name, out_file.digests())
+
+    metrics.stop()
+    LOG.info("Scan metrics: %s", json.dumps(metrics.to_dict()))
+    if metrics_callback is not None:
+        metrics_callback(metrics)
+
+    return out_paths
+
+def _as_record_names(record_ids):
+
+    """
+
+        Gives read names as a frozenset of bytes, since read names are scanned as bytes,
+        unless given as a mutacc.utils.read_names.ReadNameSet or ReadNameUnion too large
+        to keep its names. A lookup in a frozenset is cheaper than in a ReadNameSet,
+        which is only needed to bound the memory of large sets.
+
+    """
+
+    if isinstance(record_ids, (ReadNameSet, ReadNameUnion)):
+        names = record_ids.names()
+        return record_ids if names is None else names
+    return frozenset(record_id.encode() for record_id in record_ids)
+
+def _scan_fastq(fastq_file, stack, metrics=None):
+
+    """
+
+        Starts a scan of a fastq file for records
+
+        Args:
+
+            fastq_file (Path): path to fastq file
+            stack (contextlib.ExitStack): stack the opened file is closed with
+            metrics (mutacc.utils.metrics.ScanMetrics): if given, reads are timed
+
+        Returns:
+
+            records (generator): (read name, record) of each record
+
+    """
+
+    #Uncompressed fastq files are scanned in place through a memory map
+    if not str(fastq_file).endswith('.gz'):
+        return mapped_fastq_records(fastq_file, metrics)
+
+    #Opens fastq file and places its __exit__ method to the ExitStack
+    #callback stack. The file is decompressed ahead in a separate thread,
+    #while this thread looks for the read names.
+    fastq_handle = stack.enter_context(
+        ReadAheadReader(get_file_handle(fastq_file, mode='rb'), chunk_size=CHUNK_SIZE)
+    )
+    if metrics is not None:
+        fastq_handle = metrics.reader(fastq_handle)
+    return fastq_records(fastq_handle)
+
+def fastq_exclude(fastq_file, record_ids, out_path, append_files=(), threads=1,
+                  excluded_path=None):
+
+    """
+
+        Writes the records of a fastq file, except those with read names in record_ids,
+        followed by the records of the fastq files in append_files, in one pass over
+        the fastq file. The output is gzip compressed if out_path ends with '.gz'.
+
+        Args:
+
+            fastq_file (str): path to fastq file
+            record_ids (set or mutacc.utils.read_names.ReadNameSet): read names to exclude
+            out_path (Path): path to the fastq file written
+            append_files (list): paths to fastq files appended to the output
+            threads (int): number of threads used to compress the output, shared with
+                excluded_path
+            excluded_path (Path): if given, the records not excluded are also written
+                to this fastq file, without the appended files. The checksums of
+                out_path are computed while it is written, and added to the manifest
+                of its directory
+
+        Returns:
+
+            excluded (int): number of records excluded
+
+    """
+
+    output = {'record_ids': record_ids, 'out_path': out_path, 'append_files': append_files,
+              'excluded_path': excluded_path}
+    return fastq_exclude_many(fastq_file, [output], threads=threads)[0]
+
+def fastq_exclude_many(fastq_file, outputs, threads=1):
+
+    """
+
+        Writes several fastq files from one pass over a fastq file, as fastq_exclude
+        writes one. Each record is written to every output whose read names to exclude
+        do not include it.
+
+        Args:
+
+            fastq_file (str): path to fastq file
+            outputs (list(dict)): outputs, each with the arguments 'record_ids',
+                'out_path', and optionally 'append_files' and 'excluded_path' of
+                fastq_exclude
+            threads (int): number of threads used to compress the outputs, shared
+                between them
+
+        Returns:
+
+            excluded (list(int)): number of records excluded from each output
+
+    """
+
+    fastq_file = parse_path(fastq_file)
+    output_names = [_as_record_names(output['record_ids']) for output in outputs]
+
+    with ExitStack() as stack:
+        excluded_names = _excluded_names(output_names)
+        if excluded_names is not None:
+            stack.enter_context(excluded_names)
+        out_files = [stack.enter_context(ChecksumFile(output['out_path'])) for output in outputs]
+        #The threads are shared by the output files, which are written together
+        out_threads = max(threads // sum(1 + (output.get('excluded_path') is not None)
+                                         for output in outputs), 1)
+        with ExitStack() as writers:
+            output_handles = []
+            for output, out_file in zip(outputs, out_files):
+                out_handles = [writers.enter_context(
+                    _fastq_writer(output['out_path'], out_threads, out_file)
+                )]
+                if output.get('excluded_path') is not None:
+                    out_handles.append(writers.enter_context(
+                        _fastq_writer(output['excluded_path'], out_threads)
+                    ))
+                output_handles.append(out_handles)
+
+            excluded = _demultiplex(_scan_fastq(fastq_file, writers), output_names,
+                                    excluded_names, output_handles)
 
-        #parse fastq and places in list fastqs
-        #FastqGeneralIterator parses each record as a tuple with name, seq, and quality
-        #on index 0, 1, 2 respectively.
-        fastqs = [FastqGeneralIterator(handle) for handle in fastq_handles]
+        #Appended after the records are compressed, so that gzip files are added as
+        #whole members
+        for output, out_file in zip(outputs, out_files):
+            for append_file in output.get('append_files', ()):
+                _append_fastq(parse_path(append_file), out_file,
+                              str(output['out_path']).endswith('.gz'))
 
-        records_found = 0
-        #Iterates over parsed fastq files simultaneously
-        for count, records in enumerate(zip(*fastqs)):
+    for out_file in out_files:
+        write_checksums(out_file.name, out_file.digests())
 
-            # Checks if record name exists in record_ids. This Check is only done for one of the
-            # fastq files (records[0]). It is thus assumed that paired end reads exists on the same
-            # position in the two files
-            # Example: if records[0][0] is 'ST-E00266:38:H2TF5CCXX:8:1101:2563:2170 1:N:0:CGCGCATT'
-            # records[0][0].split()[0] is 'ST-E00266:38:H2TF5CCXX:8:1101:2563:2170'
-            if records[0][0].split()[0].split("/")[0] in record_ids:
+    return excluded
 
-                records_found += 1
+def _excluded_names(output_names):
 
-                #Writes current records from each fastq file to corresponding output file
-                for record, out_handle in zip(records, out_handles):
+    """
 
-                    out_handle.write("@{}\n{}\n+\n{}\n".format(record[0], record[1], record[2]))
+        Gives the fingerprints of the read names excluded from any of several outputs,
+        so that most records are written to all outputs after a single lookup. The
+        merged set spills to the directory of the sets it is built from. With a single
+        output, None is given, and its read names are looked up directly.
 
-                #removes found record name from the record_ids set
-                record_ids.remove(records[0][0].split()[0].split("/")[0])
+    """
 
-                #If record_ids is empty all records have been found so there is no need to iterate
-                #further over the fastq files
-                if not record_ids:
-                    break
+    if len(output_names) < 2:
+        return None
+    name_sets = []
+    for record_names in output_names:
+        if isinstance(record_names, ReadNameUnion):
+            name_sets.extend(record_names.read_name_sets)
+        else:
+            name_sets.append(record_names)
+    spill_dir = next((name_set.spill_dir for name_set in name_sets
+                      if isinstance(name_set, ReadNameSet) and name_set.spill_dir is not None),
+                     None)
+    return ReadNameSet.merge(name_sets, spill_dir=spill_dir)
 
-            if count%1e6 == 0:
-                log_msg = f"### {count/1e6}M READS PROCESSED: {records_found} READS FOUND ###\r"
-                LOG.info(log_msg)
+def _demultiplex(records, output_names, excluded_names, output_handles):
 
-        #for out_buffer in out_buffers: out_buffer.flush()
+    """
 
-    #Returns the file paths for the output fastq files, that should only contain the records
-    #with its record name in record_ids
-        out_paths = [out_handle.name for out_handle in out_handles]
+        Writes each record to the handles of every output not excluding its read name
+
+        Returns:
+
+            excluded (list(int)): number of records excluded from each output
+
+    """
+
+    all_handles = [out_handle for out_handles in output_handles for out_handle in out_handles]
+    outputs = list(zip(output_names, output_handles))
+    excluded = [0] * len(outputs)
+    for read_name, record in records:
+        if (excluded_names is not None
+                and not excluded_names.has_fingerprint(fingerprint(read_name)[0])):
+            for out_handle in all_handles:
+                out_handle.write(record)
+            continue
+        for output_index, (record_names, out_handles) in enumerate(outputs):
+            if read_name in record_names:
+                excluded[output_index] += 1
+                continue
+            for out_handle in out_handles:
+                out_handle.write(record)
+    return excluded
+
+def _fastq_writer(out_path, threads=1, out_file=None):
+
+    """
+
+        Opens a fastq file for writing bytes, gzip compressed if the path ends with '.gz'.
+        If an open binary file is given, the fastq file is written to it, and it is left
+        open.
+
+    """
+
+    if str(out_path).endswith('.gz'):
+        return gzip_writer(out_file or out_path, threads, mode='wb')
+    if out_file is not None:
+        return nullcontext(out_file)
+    return open(out_path, 'wb')
+
+def _append_fastq(fastq_file, out_file, compressed):
+
+    """
+
+        Appends the records of a fastq file to an open fastq file. A gzip compressed
+        fastq file is appended as it is to a gzip compressed output, else the records
+        are decompressed or compressed as needed.
+
+    """
+
+    if compressed:
+        if fastq_file.name.endswith('.gz'):
+            out_handle = nullcontext(out_file)
+        else:
+            out_handle = gzip.open(out_file, 'wb')
+        in_handle = open(fastq_file, 'rb')
+    else:
+        out_handle = nullcontext(out_file)
+        in_handle = get_file_handle(fastq_file, mode='rb')
+
+    with in_handle, out_handle as out_writer:
+        shutil.copyfileobj(in_handle, out_writer, CHUNK_SIZE)
+
+def write_fastq_shards(fastq_file, shard_of, out_path, tmp_dir=None):
+
+    """
+
+        Splits the records of a fastq file into shards, written one after the other
+        to a gzip compressed fastq file. Each shard is made of whole gzip members, so
+        that a shard can be copied, or decompressed, on its own. The records of a
+        shard keep their order in the fastq file.
+
+        Args:
+
+            fastq_file (str): path to fastq file
+            shard_of (callable): gives the shard (int) of a read name (bytes)
+            out_path (Path): path to the gzip compressed fastq file written
+            tmp_dir (Path): directory where the shards are gathered
+
+        Returns:
+
+            members (dict): offset and size in out_path of each shard
+
+    """
+
+    fastq_file = parse_path(fastq_file)
+    shard_dir = Path(tempfile.mkdtemp(prefix="shards_", dir=tmp_dir))
+    buffers = {}
+    buffered = 0
+
+    def flush():
+        for shard, buffer in buffers.items():
+            with open(shard_dir.joinpath(str(shard)), 'ab') as shard_handle:
+                shard_handle.write(
+                    gzip.compress(buffer, compresslevel=SHARD_COMPRESS_LEVEL, mtime=0)
+                )
+        buffers.clear()
+
+    try:
+        with ExitStack() as stack:
+            for read_name, record in _scan_fastq(fastq_file, stack):
+                shard = shard_of(read_name)
+                buffer = buffers.get(shard)
+                if buffer is None:
+                    buffer = buffers[shard] = bytearray()
+                buffer += record
+                buffered += len(record)
+                if buffered >= SHARD_BUFFER_LIMIT:
+                    flush()
+                    buffered = 0
+        flush()
+
+        members = {}
+        offset = 0
+        with open(out_path, 'wb') as out_handle:
+            for shard in sorted(int(shard_path.name) for shard_path in shard_dir.iterdir()):
+                with open(shard_dir.joinpath(str(shard)), 'rb') as shard_handle:
+                    shutil.copyfileobj(shard_handle, out_handle, CHUNK_SIZE)
+                size = out_handle.tell() - offset
+                members[shard] = (offset, size)
+                offset += size
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return members
+
+def fastq_exclude_shards(fastq_file, record_ids, out_path, shards, append_files=(),
+                         excluded_path=None, threads=1):
+
+    """
+
+        Writes the records of a fastq file split into shards by write_fastq_shards,
+        except those with read names in record_ids, followed by the records of the
+        fastq files in append_files. Only the shards that may hold excluded reads are
+        decompressed and searched, the other shards are copied as they are.
+
+        Args:
+
+            fastq_file (str): path to sharded fastq file
+            record_ids (set or mutacc.utils.read_names.ReadNameSet): read names to exclude
+            out_path (Path): path to the gzip compressed fastq file written
+            shards (list(tuple)): offset, size and whether to search each shard
+            append_files (list): paths to fastq files appended to the output
+            excluded_path (Path): if given, the records not excluded are also written
+                to this gzip compressed fastq file, without the appended files. The
+                checksums of out_path are computed while it is written, and added to
+                the manifest of its directory
+            threads (int): number of threads used to compress the searched shards,
+                shared with excluded_path
+
+        Returns:
+
+            excluded (int): number of records excluded
+
+    """
+
+    output = {'record_ids': record_ids, 'out_path': out_path, 'append_files': append_files,
+              'excluded_path': excluded_path}
+    return fastq_exclude_shards_many(fastq_file, [output], shards, threads=threads)[0]
+
+def fastq_exclude_shards_many(fastq_file, outputs, shards, threads=1):
+
+    """
+
+        Writes several fastq files from one pass over a sharded fastq file, as
+        fastq_exclude_shards writes one. The shards searched are searched once, and each
+        record is written to every output whose read names to exclude do not include it.
+
+        Args:
+
+            fastq_file (str): path to sharded fastq file
+            outputs (list(dict)): outputs, each with the arguments 'record_ids',
+                'out_path', and optionally 'append_files' and 'excluded_path' of
+                fastq_exclude_shards
+            shards (list(tuple)): offset, size and whether to search each shard, for
+                any of the outputs
+            threads (int): number of threads used to compress the searched shards,
+                shared between the outputs
+
+        Returns:
+
+            excluded (list(int)): number of records excluded from each output
+
+    """
+
+    fastq_file = parse_path(fastq_file)
+    output_names = [_as_record_names(output['record_ids']) for output in outputs]
+
+    #The shards that are not searched are copied as they are, so every output is
+    #gzip compressed
+    for output in outputs:
+        for path in (output['out_path'], output.get('excluded_path')):
+            if path is not None and not str(path).endswith('.gz'):
+                raise ValueError(f"Output of a sharded fastq file must end with .gz: {path}")
+
+    excluded = [0] * len(outputs)
+    with ExitStack() as stack:
+        excluded_names = _excluded_names(output_names)
+        if excluded_names is not None:
+            stack.enter_context(excluded_names)
+        fastq_handle = stack.enter_context(open(fastq_file, 'rb'))
+        out_files = [stack.enter_context(ChecksumFile(output['out_path'])) for output in outputs]
+        output_handles = []
+        for output, out_file in zip(outputs, out_files):
+            out_handles = [out_file]
+            if output.get('excluded_path') is not None:
+                out_handles.append(stack.enter_context(open(output['excluded_path'], 'wb')))
+            output_handles.append(out_handles)
+        all_handles = [out_handle for out_handles in output_handles for out_handle in out_handles]
+        out_threads = max(threads // len(all_handles), 1)
+
+        for offset, size, search in shards:
+            fastq_handle.seek(offset)
+            if not search:
+                while size > 0:
+                    data = fastq_handle.read(min(size, CHUNK_SIZE))
+                    if not data:
+                        raise ValueError(f"Truncated shard in {fastq_file}")
+                    for out_handle in all_handles:
+                        out_handle.write(data)
+                    size -= len(data)
+                continue
+
+            #The kept records of a searched shard are compressed into a new gzip member.
+            #The shard is decompressed as it is read, without reading past its end
+            out_members = [
+                [gzip_writer(out_handle, out_threads, mode='wb',
+                             compresslevel=SHARD_COMPRESS_LEVEL)
+                 for out_handle in out_handles]
+                for out_handles in output_handles
+            ]
+            with gzip.GzipFile(fileobj=_ShardReader(fastq_handle, size)) as shard_handle:
+                shard_excluded = _demultiplex(fastq_records(shard_handle), output_names,
+                                              excluded_names, out_members)
+            excluded = [total + count for total, count in zip(excluded, shard_excluded)]
+            for members in out_members:
+                for out_member in members:
+                    out_member.close()
+
+        for output, out_file in zip(outputs, out_files):
+            for append_file in output.get('append_files', ()):
+                _append_fastq(parse_path(append_file), out_file, compressed=True)
+
+    for out_file in out_files:
+        write_checksums(out_file.name, out_file.digests())
+
+    return excluded
+
+def fastq_extract_lanes(lanes: list, record_ids, dir_path='', threads=1, workers=1,
+                        index=False, metrics_callback=None, lane_record_ids=None):
+
+    """
+
+        Given a list of read identifiers, and fastq files split in lanes, creates new
+        fastq files only containing the reads specified. Each lane is given as one or
+        two (for paired end) fastq files, and the lanes are scanned concurrently. The
+        records found in each lane are then concatenated, lane by lane, into one fastq
+        file per read end.
+
+        Args:
+
+            lanes (list(list)): List of fastq files of each lane
+            record_ids (set or mutacc.utils.read_names.ReadNameSet): Set of read names
+            dir_path (string): path to directory where new fastq files are written to
+            threads (int): number of threads used to compress the output files, shared
+                by the lanes scanned concurrently
+            workers (int): number of processes, shared by the lanes
+            index (bool): if True, an index of the read names is built for each fastq
+                file that has none
+            metrics_callback (callable): called with the mutacc.utils.metrics.ScanMetrics
+                of all lanes when they are done
+            lane_record_ids (list): if given, the read names searched for in each lane,
+                instead of record_ids
+
+        Returns:
+
+            out_paths (list): List of paths to newly created fastq files, one per read end
+
+    """
+
+    dir_path = parse_path(dir_path, file_type='dir')
+
+    metrics = ScanMetrics(mode="lanes")
+    metrics.start()
+
+    #The records of each lane are written to a directory of its own
+    lane_dirs = [Path(tempfile.mkdtemp(prefix="lane_", dir=dir_path)) for _ in lanes]
+    lane_workers = max(1, workers // len(lanes))
+    if lane_record_ids is None:
+        lane_record_ids = [record_ids] * len(lanes)
+    try:
+        if workers > 1 and len(lanes) > 1:
+            lane_threads = max(1, threads // min(workers, len(lanes)))
+            with process_pool(min(workers, len(lanes))) as executor:
+                futures = [
+                    executor.submit(_extract_lane, lane, lane_ids, lane_dir, lane_threads,
+                                    lane_workers, index)
+                    for lane, lane_ids, lane_dir in zip(lanes, lane_record_ids, lane_dirs)
+                ]
+                lane_results = [future.result() for future in futures]
+        else:
+            lane_results = [
+                _extract_lane(lane, lane_ids, lane_dir, threads, lane_workers, index)
+                for lane, lane_ids, lane_dir in zip(lanes, lane_record_ids, lane_dirs)
+            ]
+
+        #Concatenated gzip files are read as one, so the lanes are merged as they are
+        file_names = _merged_lane_names(lanes)
+        out_paths = []
+        for end, file_name in enumerate(file_names):
+            out_path = dir_path.joinpath(file_name + "_mutacc" + ".fastq.gz")
+            with ChecksumFile(out_path) as out_handle:
+                for lane_paths, _ in lane_results:
+                    with open(lane_paths[end], 'rb') as lane_handle:
+                        shutil.copyfileobj(lane_handle, out_handle)
+            write_checksums(out_path, out_handle.digests())
+            out_paths.append(str(out_path))
+    finally:
+        for lane_dir in lane_dirs:
+            shutil.rmtree(lane_dir, ignore_errors=True)
+
+    for _, lane_metrics in lane_results:
+        metrics.add_metrics(lane_metrics)
+    metrics.stop()
+    LOG.info("Scan metrics: %s", json.dumps(metrics.to_dict()))
+    if metrics_callback is not None:
+        metrics_callback(metrics)
 
     return out_paths
+
+def _merged_lane_names(lanes):
+
+    """
+
+        Names the merged fastq file of each read end after the part of the file names
+        common to all lanes, without lane tags, e.g. sample_R1_001 for the lanes
+        sample_L001_R1_001.fastq.gz and sample_L002_R1_001.fastq.gz. The read end is
+        added if the names of the read ends are otherwise the same.
+
+        Args:
+
+            lanes (list(list)): List of fastq files of each lane
+
+        Returns:
+
+            file_names (list(str)): name of the merged fastq file of each read end
+
+    """
+
+    file_names = []
+    for end in range(len(lanes[0])):
+        stems = [LANE_TAG.sub("", Path(lane[end]).name.split(".")[0]).strip("_.-")
+                 for lane in lanes]
+        file_names.append(os.path.commonprefix(stems).rstrip("_.-"))
+    if not all(file_names) or len(set(file_names)) < len(file_names):
+        file_names = [f"{file_name or 'lanes'}_R{end + 1}"
+                      for end, file_name in enumerate(file_names)]
+    return file_names
+
+def _extract_lane(lane, record_ids, dir_path, threads, workers, index):
+
+    """
+
+        Extracts the reads of one lane, e.g. in a worker process
+
+        Returns:
+
+            (out_paths, metrics): paths to the fastq files of the lane, and the
+                mutacc.utils.metrics.ScanMetrics of its scan
+
+    """
+
+    lane_metrics = []
+    out_paths = fastq_extract(lane, record_ids, dir_path=dir_path, threads=threads,
+                              workers=workers, index=index,
+                              metrics_callback=lane_metrics.append, checksums=False)
+    return out_paths, lane_metrics[0]
+
+def _serial_extract(fastqs, record_names, out_handles, metrics):
+
+    """
+
+        Scans the fastq files from start to end, writing the records in record_names
+
+        Args:
+
+            fastqs (list): (read name, record) iterator of each fastq file
+            record_names (set or mutacc.utils.read_names.ReadNameSet): Set of read names
+            out_handles (list): file handles to write found records to
+            metrics (mutacc.utils.metrics.ScanMetrics): metrics of the scan
+
+    """
+
+    records_found = 0
+    records_total = len(record_names)
+    count = -1
+    #Iterates over parsed fastq files simultaneously
+    for count, records in enumerate(zip(*fastqs)):
+
+        # Checks if record name exists in record_names. This Check is only done for one of the
+        # fastq files (records[0]). It is thus assumed that paired end reads exists on the same
+        # position in the two files
+        if records[0][0] in record_names:
+
+            records_found += 1
+
+            #Writes current records from each fastq file verbatim to corresponding output file
+            for (_, record), out_handle in zip(records, out_handles):
+
+                out_handle.write(record)
+
+            #If all records in record_ids have been found there is no need to iterate
+            #further over the fastq files
+            if records_found == records_total:
+                break
+
+        if count%1e6 == 0:
+            log_msg = f"### {count/1e6}M READS PROCESSED: {records_found} READS FOUND ###\r"
+            LOG.info(log_msg)
+
+    #Closing the scans lets them count the bytes scanned
+    for fastq in fastqs:
+        fastq.close()
+
+    metrics.add(records=(count + 1) * len(fastqs), matches=records_found * len(fastqs))
+    #Time not spent reading or writing is spent parsing
+    metrics.parsing_seconds = metrics.elapsed() - metrics.reading_seconds - metrics.writing_seconds
+
+def _bgzf_extract(fastq_files, record_names, out_handles, workers, metrics):
+
+    """
+
+        Scans BGZF compressed fastq files in ranges of blocks, using a pool of processes.
+        Since the reads of a pair have the same name, each fastq file is scanned on its
+        own, and the found records are written in the order of the ranges. The read names
+        found in each file are then checked to be the same, in the same order.
+
+        Args:
+
+            fastq_files (list): paths to BGZF compressed fastq files
+            record_names (set or mutacc.utils.read_names.ReadNameSet): Set of read names
+            out_handles (list): file handles to write found records to
+            workers (int): number of processes
+            metrics (mutacc.utils.metrics.ScanMetrics): metrics of the scan
+
+        Returns:
+
+            records_found (int): number of records found in each file
+
+    """
+
+    found_names = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_set_record_names,
+                             initargs=(record_names,)) as executor:
+
+        #Submits the ranges of all files before collecting the results
+        file_scans = [
+            [executor.submit(_scan_bgzf_range, fastq_file, *bgzf_range)
+             for bgzf_range in bgzf_ranges(fastq_file, BGZF_RANGE_SIZE)]
+            for fastq_file in fastq_files
+        ]
+
+        for range_scans, out_handle in zip(file_scans, out_handles):
+            names = []
+            for range_scan in range_scans:
+                found, range_metrics = range_scan.result()
+                metrics.add(**range_metrics)
+                for read_name, record in found:
+                    names.append(read_name)
+                    out_handle.write(record)
+            metrics.add(matches=len(names))
+            found_names.append(names)
+
+    _check_pairs(fastq_files, found_names)
+
+    return len(found_names[0])
+
+def _check_pairs(fastq_files, found_names):
+
+    """
+
+        Checks that the same read names, in the same order, were found in each of
+        the fastq files
+
+        Args:
+
+            fastq_files (list): paths to fastq files
+            found_names (list(list)): read names found in each file
+
+    """
+
+    for fastq_file, names in zip(fastq_files[1:], found_names[1:]):
+        if names != found_names[0]:
+            raise ValueError(f"Reads in {fastq_file} are not paired with {fastq_files[0]}")
+
+def bgzf_ranges(fastq_file, range_size=BGZF_RANGE_SIZE):
+
+    """
+
+        Splits a BGZF compressed file into ranges of whole blocks
+
+        Args:
+
+            fastq_file (Path): path to BGZF compressed file
+            range_size (int): compressed size of each range
+
+        Yields:
+
+            (previous, start, end): file offset of the last block before the range
+                holding any data, or None if there is none, and start and end offsets
+                of the range. End is None for the last range
+
+    """
+
+    previous = None
+    start = 0
+    last_offset = None
+    for offset, size in bgzf_block_offsets(fastq_file):
+        if offset - start >= range_size:
+            yield previous, start, offset
+            previous = last_offset
+            start = offset
+        #Empty blocks, e.g. the end of file marker, hold no byte to start a range after
+        if size:
+            last_offset = offset
+
+    yield previous, start, None
+
+def _set_record_names(record_names):
+
+    """
+
+        Sets the read names searched for by _scan_bgzf_range in a worker process
+
+    """
+
+    global _RECORD_NAMES
+    _RECORD_NAMES = record_names
+
+def _scan_bgzf_range(fastq_file, previous, start, end):
+
+    """
+
+        Scans the fastq records starting in a range of BGZF blocks, for the read names
+        set by _set_record_names. The first record in the range is found after the first
+        newline followed by a line starting with '@', two lines before a line starting
+        with '+'. A quality line starting with '@' is instead two lines before a sequence.
+        The last record starting in the range is read to its end in the following blocks.
+
+        Args:
+
+            fastq_file (Path): path to BGZF compressed fastq file
+            previous (int): file offset of the last block before the range holding
+                data, or None
+            start (int): file offset of the first block of the range
+            end (int): file offset of the block after the range, or None
+
+        Returns:
+
+            found (list): (read name, record) of the records found
+            range_metrics (dict): counts and times of the scan, to add to ScanMetrics
+
+    """
+
+    metrics = ScanMetrics(mode="bgzf")
+    metrics.start()
+    with open(fastq_file, "rb") as handle:
+
+        #The range is prefixed with the last byte of the previous block, so that
+        #a record starting at the first byte of the range is found after a newline
+        data = b"\n"
+        if previous is not None:
+            handle.seek(previous)
+            data = read_bgzf_block(handle)[-1:]
+
+        handle.seek(start)
+        blocks = [data]
+        while end is None or handle.tell() < end:
+            block = read_bgzf_block(handle)
+            if block is None:
+                break
+            blocks.append(block)
+        data = b"".join(blocks)
+        range_size = len(data)
+        metrics.add(reading_seconds=metrics.elapsed())
+
+        reader = _BGZFReader(handle)
+        position = None
+        search = 0
+        while position is None:
+            candidate = data.find(b"\n@", search) + 1
+            if candidate == 0 or candidate >= range_size:
+                return [], _range_metrics(metrics)
+            sequence_end = data.find(b"\n", candidate)
+            separator_start = data.find(b"\n", sequence_end + 1) + 1
+            if sequence_end < 0 or separator_start in (0, len(data)):
+                block = reader.read()
+                if not block:
+                    position = candidate
+                data += block
+            elif data[separator_start] == ord("+"):
+                position = candidate
+            else:
+                search = candidate
+
+        reader.data = data[position:]
+        found = []
+        for read_name, record in fastq_records(metrics.reader(reader)):
+            if position >= range_size:
+                break
+            if read_name in _RECORD_NAMES:
+                found.append((read_name, bytes(record)))
+            metrics.records += 1
+            position += len(record)
+
+    return found, _range_metrics(metrics)
+
+def _range_metrics(metrics):
+
+    """
+
+        Gives the counts and times measured while scanning a range of BGZF blocks
+
+    """
+
+    return {
+        "decompressed_bytes": metrics.decompressed_bytes,
+        "records": metrics.records,
+        "reading_seconds": metrics.reading_seconds,
+        "parsing_seconds": metrics.elapsed() - metrics.reading_seconds,
+    }
+
+class _ShardReader:
+
+    """
+
+        File like reader of a shard of a file, from the current position of a file
+        handle, which reads no further than the end of the shard
+
+    """
+
+    def __init__(self, handle, size):
+
+        """
+
+            Args:
+
+                handle: file handle opened in binary mode
+                size (int): size of the shard in bytes
+
+        """
+
+        self.handle = handle
+        self.remaining = size
+
+    def read(self, size=-1):
+
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.handle.read(size)
+        if size and not data:
+            raise ValueError(f"Truncated shard in {self.handle.name}")
+        self.remaining -= len(data)
+        return data
+
+class _BGZFReader:
+
+    """
+
+        File like reader of decompressed BGZF blocks, from the current position of
+        a file handle, after some leading data
+
+    """
+
+    def __init__(self, handle, data=b"", blocks=None):
+
+        """
+
+            Args:
+
+                handle: BGZF file handle opened in binary mode
+                data (bytes): data read before the first block
+                blocks (list): if given, (decompressed position, file offset) of each
+                    block read is appended
+
+        """
+
+        self.handle = handle
+        self.data = data
+        self.blocks = blocks
+        self.position = 0
+
+    def read(self, size=-1):
+
+        if self.data:
+            data, self.data = self.data, b""
+            self.position += len(data)
+            return data
+        while True:
+            block_offset = self.handle.tell()
+            block = read_bgzf_block(self.handle)
+            if block is None:
+                return b""
+            if block:
+                if self.blocks is not None:
+                    self.blocks.append((self.position, block_offset))
+                self.position += len(block)
+                return block
+
+def _index_extract(fastq_files, fastq_indexes, record_names, out_handles, metrics):
+
+    """
+
+        Reads the records in record_names at the offsets given by the index of each
+        fastq file
+
+        Args:
+
+            fastq_files (list): paths to fastq files
+            fastq_indexes (list(FastqIndex)): index of each fastq file
+            record_names (set or mutacc.utils.read_names.ReadNameSet): Set of read names
+            out_handles (list): file handles to write found records to
+            metrics (mutacc.utils.metrics.ScanMetrics): metrics of the scan
+
+        Returns:
+
+            records_found (int): number of records found in each file
+
+    """
+
+    if isinstance(record_names, (ReadNameSet, ReadNameUnion)):
+        name_fingerprints = list(record_names.fingerprints())
+    else:
+        name_fingerprints = [fingerprint(read_name)[0] for read_name in record_names]
+
+    found_names = []
+    for fastq_file, fastq_index, out_handle in zip(fastq_files, fastq_indexes, out_handles):
+        names = []
+        offsets = fastq_index.offsets(name_fingerprints)
+        #Reads of other names may share a fingerprint with a read in record_names
+        for read_name, record in read_records_at(fastq_file, offsets, fastq_index.bgzf,
+                                                  metrics=metrics):
+            if read_name in record_names:
+                names.append(read_name)
+                out_handle.write(record)
+        metrics.add(records=len(offsets), matches=len(names))
+        found_names.append(names)
+
+    #Time not spent reading or writing is spent parsing
+    metrics.parsing_seconds = metrics.elapsed() - metrics.reading_seconds - metrics.writing_seconds
+
+    _check_pairs(fastq_files, found_names)
+
+    return len(found_names[0])
+
+def read_records_at(fastq_file, offsets, bgzf=False, metrics=None):
+
+    """
+
+        Reads the fastq records at the given offsets
+
+        Args:
+
+            fastq_file (Path): path to uncompressed or BGZF compressed fastq file
+            offsets (list(int)): sorted byte offsets, or BGZF virtual offsets, of records
+            bgzf (bool): True if the fastq file is BGZF compressed
+            metrics (mutacc.utils.metrics.ScanMetrics): if given, the reads are timed
+
+        Yields:
+
+            (read_name (bytes), record (bytes)): the read name and record at each offset
+
+    """
+
+    with open(fastq_file, "rb") as handle:
+        block_offset = None
+        for offset in offsets:
+            if bgzf:
+                # The upper 48 bits of a virtual offset give the file offset of the
+                # block, and the lower 16 bits the offset within the decompressed block
+                if offset >> 16 != block_offset:
+                    block_offset = offset >> 16
+                    handle.seek(block_offset)
+                    start = time.perf_counter()
+                    block = read_bgzf_block(handle)
+                    if metrics is not None:
+                        metrics.add(reading_seconds=time.perf_counter() - start)
+                    next_block_offset = handle.tell()
+                handle.seek(next_block_offset)
+                reader = _BGZFReader(handle, block[offset & 0xFFFF:])
+            else:
+                handle.seek(offset)
+                reader = handle
+            if metrics is not None:
+                reader = metrics.reader(reader)
+            read_name, record = next(fastq_records(reader, chunk_size=RECORD_READ_SIZE))
+            yield read_name, bytes(record)
+
+def fastq_offsets(fastq_file, bgzf=False):
+
+    """
+
+        Scans a fastq file for the offset of each record
+
+        Args:
+
+            fastq_file (Path): path to uncompressed or BGZF compressed fastq file
+            bgzf (bool): True if the fastq file is BGZF compressed
+
+        Yields:
+
+            (read_name (bytes), offset (int)): the read name and the byte offset, or
+                BGZF virtual offset, of each record
+
+    """
+
+    position = 0
+    if not bgzf:
+        for read_name, record in mapped_fastq_records(fastq_file):
+            yield read_name, position
+            position += len(record)
+        return
+
+    with open(fastq_file, "rb") as handle:
+        reader = _BGZFReader(handle, blocks=deque())
+        for read_name, record in fastq_records(reader):
+            while len(reader.blocks) > 1 and reader.blocks[1][0] <= position:
+                reader.blocks.popleft()
+            block_start, block_offset = reader.blocks[0]
+            yield read_name, block_offset << 16 | (position - block_start)
+            position += len(record)
+
+def index_path(fastq_file):
+
+    """
+
+        Gives the path to the index of a fastq file
+
+    """
+
+    return Path(str(fastq_file) + INDEX_SUFFIX)
+
+def build_fastq_index(fastq_file):
+
+    """
+
+        Builds an index of the read names in a fastq file, and writes it next to the
+        fastq file. The index holds the 64 bit fingerprint of each read name in sorted
+        order, followed by the offset of the record with that read name. Entries are
+        sorted in runs, merged when the index is written.
+
+        Args:
+
+            fastq_file (Path): path to uncompressed or BGZF compressed fastq file
+
+        Returns:
+
+            fastq_index (FastqIndex): the new index
+
+    """
+
+    bgzf = is_bgzf(fastq_file)
+    if not bgzf and str(fastq_file).endswith(".gz"):
+        raise ValueError(f"{fastq_file} is gzip compressed, but not with BGZF")
+
+    LOG.info("Building read name index of %s", fastq_file)
+    header = {"source": _source_stat(fastq_file), "bgzf": bgzf}
+    out_path = index_path(fastq_file)
+    with ExitStack() as stack:
+        runs = []
+        entries = []
+        records = 0
+        for read_name, offset in fastq_offsets(fastq_file, bgzf):
+            entries.append((fingerprint(read_name)[0], offset))
+            if len(entries) == INDEX_RUN_SIZE:
+                runs.append(stack.enter_context(_write_index_run(entries, out_path.parent)))
+                records += len(entries)
+                entries = []
+        entries.sort()
+        records += len(entries)
+        header["records"] = records
+
+        file_descriptor, temp_path = tempfile.mkstemp(suffix=INDEX_SUFFIX, dir=out_path.parent)
+        try:
+            with os.fdopen(file_descriptor, "wb") as index_handle, \
+                    tempfile.TemporaryFile(dir=out_path.parent) as offsets_handle:
+                # The header is padded to whole 8 byte words
+                header_line = json.dumps(header).encode()
+                header_line += b" " * (7 - len(header_line) % 8) + b"\n"
+                index_handle.write(header_line)
+                fingerprint_chunk = array("Q")
+                offset_chunk = array("Q")
+                for name_fingerprint, offset in heapq.merge(
+                        *(_read_index_run(run) for run in runs), entries):
+                    fingerprint_chunk.append(name_fingerprint)
+                    offset_chunk.append(offset)
+                    if len(fingerprint_chunk) == RECORD_READ_SIZE:
+                        fingerprint_chunk.tofile(index_handle)
+                        offset_chunk.tofile(offsets_handle)
+                        del fingerprint_chunk[:], offset_chunk[:]
+                fingerprint_chunk.tofile(index_handle)
+                offset_chunk.tofile(offsets_handle)
+                offsets_handle.seek(0)
+                shutil.copyfileobj(offsets_handle, index_handle)
+            os.replace(temp_path, out_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    return FastqIndex(out_path)
+
+def _write_index_run(entries, run_dir):
+
+    """
+
+        Sorts index entries, and writes them to a temporary file
+
+    """
+
+    entries.sort()
+    run = tempfile.TemporaryFile(dir=run_dir)
+    array("Q", (value for entry in entries for value in entry)).tofile(run)
+    return run
+
+def _read_index_run(run):
+
+    """
+
+        Iterates over the sorted index entries of a temporary file
+
+    """
+
+    run.seek(0)
+    while True:
+        chunk = array("Q")
+        try:
+            chunk.fromfile(run, 2 * RECORD_READ_SIZE)
+        except EOFError:
+            pass
+        if not chunk:
+            return
+        yield from zip(chunk[::2], chunk[1::2])
+
+def _source_stat(fastq_file):
+
+    """
+
+        Gives the size and modification time of a fastq file, used to find if an
+        index is out of date
+
+    """
+
+    stat = os.stat(fastq_file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def load_fastq_index(fastq_file):
+
+    """
+
+        Opens the index of a fastq file
+
+        Args:
+
+            fastq_file (Path): path to fastq file
+
+        Returns:
+
+            fastq_index (FastqIndex): the index, or None if the fastq file has no index,
+                or the fastq file has changed since the index was built
+
+    """
+
+    path = index_path(fastq_file)
+    if not path.is_file():
+        return None
+    fastq_index = FastqIndex(path)
+    if fastq_index.source != _source_stat(fastq_file):
+        LOG.warning("Index %s is out of date", path)
+        fastq_index.close()
+        return None
+    return fastq_index
+
+def _get_fastq_indexes(fastq_files, build=False):
+
+    """
+
+        Opens the index of each fastq file, building missing indexes if build is True.
+        An index can not be built for a fastq file gzip compressed without BGZF, or
+        next to a fastq file in a directory that is not writable
+
+        Args:
+
+            fastq_files (list): paths to fastq files
+            build (bool): if True, missing indexes are built
+
+        Returns:
+
+            fastq_indexes (list): index of each fastq file, or None
+
+    """
+
+    fastq_indexes = [load_fastq_index(fastq_file) for fastq_file in fastq_files]
+    if build:
+        for position, fastq_file in enumerate(fastq_files):
+            if fastq_indexes[position] is None:
+                try:
+                    fastq_indexes[position] = build_fastq_index(fastq_file)
+                except (ValueError, OSError) as error:
+                    LOG.warning("Could not build index of %s: %s", fastq_file, error)
+    return fastq_indexes
+
+class FastqIndex:
+
+    """
+
+        Index of the read names in a fastq file, memory mapped from the index file
+
+    """
+
+    def __init__(self, path):
+
+        """
+
+            Args:
+
+                path (Path): path to index file
+
+        """
+
+        self.path = path
+        with open(path, "rb") as index_handle:
+            header_line = index_handle.readline()
+            self._map = mmap.mmap(index_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        header = json.loads(header_line)
+        self.source = header["source"]
+        self.bgzf = header["bgzf"]
+        records = header["records"]
+        self._view = memoryview(self._map)
+        start = len(header_line)
+        self.fingerprints = self._view[start:start + 8 * records].cast("Q")
+        self.record_offsets = self._view[start + 8 * records:start + 16 * records].cast("Q")
+
+    def offsets(self, name_fingerprints):
+
+        """
+
+            Finds the offsets of the records with the given fingerprints
+
+            Args:
+
+                name_fingerprints (iterable(int)): read name fingerprints
+
+            Returns:
+
+                offsets (list(int)): sorted offsets of the records
+
+        """
+
+        offsets = []
+        size = len(self.fingerprints)
+        for name_fingerprint in name_fingerprints:
+            index = bisect_left(self.fingerprints, name_fingerprint)
+            while index < size and self.fingerprints[index] == name_fingerprint:
+                offsets.append(self.record_offsets[index])
+                index += 1
+        return sorted(offsets)
+
+    def close(self):
+
+        """
+
+            Closes the memory map of the index file
+
+        """
+
+        self.fingerprints.release()
+        self.record_offsets.release()
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
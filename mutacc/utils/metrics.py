@@ -0,0 +1,159 @@
+"""
+    Module with throughput metrics of fastq scans
+"""
+
+import time
+
+
+class ScanMetrics:
+    """
+        Throughput metrics of a scan for reads in fastq files. Time spent reading
+        (decompression and disk), parsing and writing is measured separately.
+        When the scan is split over several processes, the time of each part is
+        summed over the processes, while seconds is the wall time of the scan.
+        When the input is read ahead in a separate thread, the time spent reading
+        is the time spent waiting for it. When the input is scanned through a
+        memory map, it is read in page faults while it is parsed, so no reading
+        time or read rate is given, and the reading is part of the parsing time.
+    """
+
+    def __init__(self, mode="serial"):
+        """
+            Args:
+                mode (str): how the fastq files are searched; 'serial', 'bgzf'
+                    for parallel scans of BGZF blocks, 'index', or 'lanes' for
+                    the scans of several lanes together
+        """
+        self.mode = mode
+        self.input_bytes = 0
+        self.decompressed_bytes = 0
+        self.records = 0
+        self.matches = 0
+        self.reading_seconds = 0.0
+        self.parsing_seconds = 0.0
+        self.writing_seconds = 0.0
+        self.seconds = 0.0
+        # False if any input was read without timing, e.g. through a memory map
+        self.reading_timed = True
+        self._start = None
+
+    def start(self):
+        """
+            Starts the wall clock of the scan
+        """
+        self._start = time.perf_counter()
+
+    def stop(self):
+        """
+            Stops the wall clock of the scan
+        """
+        self.seconds = time.perf_counter() - self._start
+
+    def elapsed(self):
+        """
+            Gives the seconds since the scan was started
+        """
+        return time.perf_counter() - self._start
+
+    def add(self, **counts):
+        """
+            Adds counts and times, e.g. measured in another process
+        """
+        for key, value in counts.items():
+            setattr(self, key, getattr(self, key) + value)
+
+    def add_metrics(self, metrics):
+        """
+            Adds the counts and times of another scan, e.g. of a part of this scan
+        """
+        self.add(
+            input_bytes=metrics.input_bytes,
+            decompressed_bytes=metrics.decompressed_bytes,
+            records=metrics.records,
+            matches=metrics.matches,
+            reading_seconds=metrics.reading_seconds,
+            parsing_seconds=metrics.parsing_seconds,
+            writing_seconds=metrics.writing_seconds,
+        )
+        self.reading_timed = self.reading_timed and metrics.reading_timed
+
+    def reader(self, handle):
+        """
+            Wraps a file handle, timing the reads and counting the bytes read
+        """
+        return TimedReader(handle, self)
+
+    def writer(self, handle):
+        """
+            Wraps a file handle, timing the writes
+        """
+        return TimedWriter(handle, self)
+
+    @property
+    def records_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.records / self.seconds
+
+    @property
+    def read_bytes_per_second(self):
+        """
+            Rate of reading the input, or None if reading was not timed
+        """
+        if not self.reading_timed or not self.reading_seconds:
+            return None
+        return self.decompressed_bytes / self.reading_seconds
+
+    def to_dict(self):
+        """
+            Gives the metrics as a dictionary that can be serialized to json
+        """
+        return {
+            "mode": self.mode,
+            "input_bytes": self.input_bytes,
+            "decompressed_bytes": self.decompressed_bytes,
+            "records": self.records,
+            "matches": self.matches,
+            "records_per_second": self.records_per_second,
+            "read_bytes_per_second": self.read_bytes_per_second,
+            "reading_timed": self.reading_timed,
+            "seconds": {
+                "total": self.seconds,
+                "reading": self.reading_seconds if self.reading_timed else None,
+                "parsing": self.parsing_seconds,
+                "writing": self.writing_seconds,
+            },
+        }
+
+
+class TimedReader:
+    """
+        File handle wrapper adding the time and bytes of each read to metrics
+    """
+
+    def __init__(self, handle, metrics):
+        self.handle = handle
+        self.metrics = metrics
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.handle.read(size)
+        self.metrics.reading_seconds += time.perf_counter() - start
+        self.metrics.decompressed_bytes += len(data)
+        return data
+
+
+class TimedWriter:
+    """
+        File handle wrapper adding the time of each write to metrics
+    """
+
+    def __init__(self, handle, metrics):
+        self.handle = handle
+        self.metrics = metrics
+
+    def write(self, data):
+        start = time.perf_counter()
+        written = self.handle.write(data)
+        self.metrics.writing_seconds += time.perf_counter() - start
+        return written
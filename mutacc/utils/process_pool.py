@@ -0,0 +1,56 @@
+"""
+    Module with a process pool that logs through the parent process
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+
+LOG = logging.getLogger(__name__)
+
+
+@contextmanager
+def process_pool(max_workers, initializer=None, initargs=()):
+    """
+        Opens a process pool whose workers send their log records to the
+        handlers of this process, so that logs from all processes are
+        written in one place. Exceptions raised in a worker are raised again
+        by the result method of its future.
+
+        Args:
+            max_workers (int): number of processes
+            initializer (callable): called with initargs in each worker
+            initargs (tuple): arguments to initializer
+        Yields:
+            executor (concurrent.futures.ProcessPoolExecutor): the process pool
+    """
+    root_logger = logging.getLogger()
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(log_queue, root_logger.level, initializer, initargs),
+        ) as executor:
+            yield executor
+    finally:
+        listener.stop()
+        log_queue.close()
+
+
+def _init_worker(log_queue, level, initializer, initargs):
+    """
+        Replaces the log handlers of a worker with a handler putting log
+        records on the queue read by the parent process
+    """
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(level)
+    if initializer is not None:
+        initializer(*initargs)
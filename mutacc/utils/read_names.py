@@ -0,0 +1,583 @@
+"""
+    Module with a compact set of read names
+"""
+
+from array import array
+from bisect import bisect_left
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import tempfile
+import weakref
+
+# Number of fingerprints held in a dictionary before they are sorted into a run
+PENDING_SIZE = 1 << 16
+
+# Number of read names up to which a set also keeps the names themselves, so that
+# they can be looked up in a frozenset
+SMALL_SET_SIZE = PENDING_SIZE
+
+# Number of fingerprints held in memory before the runs are spilled to disk,
+# if a spill directory is given
+MEMORY_LIMIT = 1 << 22
+
+# Number of (fingerprint, bin) pairs sorted into a run by ReadNameBins
+RUN_SIZE = 1 << 20
+
+# Number of fingerprints written to a run file at a time
+WRITE_CHUNK_SIZE = 1 << 16
+
+
+def fingerprint(read_name):
+    """
+        Hashes a read name to a 64 bit fingerprint, and an independent 32 bit
+        check value used to tell apart names with the same fingerprint
+
+        Args:
+            read_name (bytes): read name
+        Returns:
+            (fingerprint (int), check (int))
+    """
+    digest = hashlib.blake2b(read_name, digest_size=12).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
+
+
+class ReadNameSet:
+    """
+        Set of read names, stored as 64 bit fingerprints in sorted arrays. Each
+        fingerprint takes 12 bytes together with its check value, compared to
+        roughly 100 bytes for a read name in a python set. Names whose fingerprint
+        collides with another name are kept in full, so that membership is
+        exact for every name added.
+
+        New fingerprints are gathered in a dictionary, which is sorted into a run
+        once it holds PENDING_SIZE entries. Runs of similar size are merged, so
+        that a lookup only has to search a few runs.
+
+        If a spill directory is given, the runs are written to a run file in that
+        directory once they hold more than MEMORY_LIMIT fingerprints, and are
+        searched through a memory map. The run files are merged into one the
+        first time the set is queried after a spill, so that memory use is
+        bounded by MEMORY_LIMIT regardless of the number of names.
+    """
+
+    def __init__(self, read_names=(), spill_dir=None):
+        """
+            Args:
+                read_names (iterable(str)): read names to add
+                spill_dir (Path): directory where run files are written
+        """
+        self._pending = {}
+        self._runs = []
+        self._disk_runs = []
+        self._merged = True
+        self._collisions = set()
+        self._names = set()
+        self._size = 0
+        self.spill_dir = spill_dir
+        self._finalizer = weakref.finalize(self, _close_runs, self._disk_runs)
+        self.update(read_names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+            Removes the run files from disk
+        """
+        self._finalizer()
+
+    def add(self, read_name):
+        """
+            Adds read name to set
+
+            Args:
+                read_name (str or bytes): read name
+            Returns:
+                (bool): True if the read name was not already in the set
+        """
+        read_name = _as_bytes(read_name)
+        name_fingerprint, check = fingerprint(read_name)
+        stored_check = self._lookup(name_fingerprint)
+        if stored_check is None:
+            self._pending[name_fingerprint] = check
+            if len(self._pending) >= PENDING_SIZE:
+                self._flush_pending()
+        elif stored_check != check:
+            if read_name in self._collisions:
+                return False
+            self._collisions.add(read_name)
+        else:
+            return False
+        self._size += 1
+        if self._names is not None:
+            if self._size > SMALL_SET_SIZE:
+                self._names = None
+            else:
+                self._names.add(read_name)
+        return True
+
+    def names(self):
+        """
+            Gives the read names of a small set, for lookups in a frozenset. These
+            take one hash of the name, instead of a digest and a search of each run.
+
+            Returns:
+                (frozenset(bytes)): read names, or None if the set has held more
+                    than SMALL_SET_SIZE names
+        """
+        if self._names is None:
+            return None
+        return frozenset(self._names)
+
+    def update(self, read_names):
+        """
+            Adds read names to set
+        """
+        for read_name in read_names:
+            self.add(read_name)
+
+    @classmethod
+    def merge(cls, read_name_sets, spill_dir=None):
+        """
+            Builds a set of the fingerprints of the read names in several sets,
+            e.g. to find out with one lookup whether a read name may be in any
+            of them. Names of different sets sharing a fingerprint are not told
+            apart, so the merged set is queried with has_fingerprint.
+
+            Args:
+                read_name_sets (list): ReadNameSets, or sets of read names
+                spill_dir (Path): directory where run files are written
+            Returns:
+                (ReadNameSet): merged set
+        """
+        merged = cls(spill_dir=spill_dir)
+        # The names behind the fingerprints are not known
+        merged._names = None
+        for read_name_set in read_name_sets:
+            if not isinstance(read_name_set, ReadNameSet):
+                merged.update(read_name_set)
+                continue
+            for name_fingerprint, check in read_name_set._entries():
+                if merged._lookup(name_fingerprint) is None:
+                    merged._pending[name_fingerprint] = check
+                    merged._size += 1
+                    if len(merged._pending) >= PENDING_SIZE:
+                        merged._flush_pending()
+        return merged
+
+    def _entries(self):
+        """
+            Iterates over the fingerprints in the set with their check values
+        """
+        if not self._merged:
+            self._merge_disk_runs()
+        yield from list(self._pending.items())
+        for fingerprints, checks in itertools.chain(self._runs, self._disk_runs):
+            yield from zip(fingerprints, checks)
+
+    def has_fingerprint(self, name_fingerprint):
+        """
+            Tells whether a read name in the set has the given fingerprint
+
+            Args:
+                name_fingerprint (int): fingerprint of a read name
+            Returns:
+                (bool): True if a read name has the fingerprint
+        """
+        if not self._merged:
+            self._merge_disk_runs()
+        return self._lookup(name_fingerprint) is not None
+
+    def _lookup(self, name_fingerprint):
+        """
+            Finds the check value stored with a fingerprint, or None if the
+            fingerprint is not in the set
+        """
+        check = self._pending.get(name_fingerprint)
+        if check is not None:
+            return check
+        for fingerprints, checks in itertools.chain(self._runs, self._disk_runs):
+            index = bisect_left(fingerprints, name_fingerprint)
+            if index < len(fingerprints) and fingerprints[index] == name_fingerprint:
+                return checks[index]
+        return None
+
+    def _flush_pending(self):
+        """
+            Sorts the pending fingerprints into a new run, and merges runs of
+            similar size
+        """
+        fingerprints = array("Q", sorted(self._pending))
+        checks = array("I", (self._pending[name_fingerprint] for name_fingerprint in fingerprints))
+        self._pending.clear()
+        self._runs.append((fingerprints, checks))
+        while len(self._runs) > 1 and len(self._runs[-2][0]) <= 2 * len(self._runs[-1][0]):
+            self._runs.append(self._merge_runs(self._runs.pop(-2), self._runs.pop()))
+        if self.spill_dir is not None and sum(len(run[0]) for run in self._runs) > MEMORY_LIMIT:
+            self._spill()
+
+    def _spill(self):
+        """
+            Writes the runs held in memory to a run file
+        """
+        self._disk_runs.append(_DiskRun.write(self.spill_dir, heapq.merge(
+            *(zip(*run) for run in self._runs)
+        )))
+        self._runs.clear()
+        self._merged = len(self._disk_runs) == 1
+
+    def _merge_disk_runs(self):
+        """
+            Merges the run files into one
+        """
+        disk_run = _DiskRun.write(self.spill_dir, heapq.merge(
+            *(zip(run.fingerprints, run.checks) for run in self._disk_runs)
+        ))
+        _close_runs(self._disk_runs)
+        self._disk_runs.append(disk_run)
+        self._merged = True
+
+    @staticmethod
+    def _merge_runs(run_1, run_2):
+        """
+            Merges two sorted runs into one
+        """
+        fingerprints = array("Q")
+        checks = array("I")
+        for name_fingerprint, check in heapq.merge(zip(*run_1), zip(*run_2)):
+            fingerprints.append(name_fingerprint)
+            checks.append(check)
+        return fingerprints, checks
+
+    def __contains__(self, read_name):
+        if not self._merged:
+            self._merge_disk_runs()
+        read_name = _as_bytes(read_name)
+        name_fingerprint, check = fingerprint(read_name)
+        stored_check = self._lookup(name_fingerprint)
+        if stored_check is None:
+            return False
+        return stored_check == check or read_name in self._collisions
+
+    def fingerprints(self):
+        """
+            Iterates over the fingerprints of the read names in the set, in no
+            particular order. Names with colliding fingerprints share one.
+
+            Yields:
+                fingerprint (int)
+        """
+        if not self._merged:
+            self._merge_disk_runs()
+        yield from list(self._pending)
+        for fingerprints, _ in itertools.chain(self._runs, self._disk_runs):
+            yield from fingerprints
+
+    def __len__(self):
+        return self._size
+
+    def __getstate__(self):
+        # Run files are shared with the unpickled copy, which does not remove them
+        if not self._merged:
+            self._merge_disk_runs()
+        state = self.__dict__.copy()
+        del state["_finalizer"]
+        state["_disk_runs"] = [disk_run.path for disk_run in self._disk_runs]
+        return state
+
+    def __setstate__(self, state):
+        state["_disk_runs"] = [_DiskRun(path, owner=False) for path in state["_disk_runs"]]
+        self.__dict__.update(state)
+        self._finalizer = weakref.finalize(self, _close_runs, self._disk_runs)
+
+    def __bool__(self):
+        return self._size > 0
+
+
+class ReadNameUnion:
+    """
+        Union of disjoint sets of read names, e.g. of the reads in several read
+        groups, without copying the names
+    """
+
+    def __init__(self, read_name_sets):
+        """
+            Args:
+                read_name_sets (iterable(ReadNameSet)): sets with no name in common
+        """
+        self.read_name_sets = list(read_name_sets)
+
+    def fingerprints(self):
+        """
+            Iterates over the fingerprints of the read names in the sets
+        """
+        for read_name_set in self.read_name_sets:
+            yield from read_name_set.fingerprints()
+
+    def __contains__(self, read_name):
+        return any(read_name in read_name_set for read_name_set in self.read_name_sets)
+
+    def names(self):
+        """
+            Gives the read names of small sets, see ReadNameSet.names
+
+            Returns:
+                (frozenset(bytes)): read names, or None if any set is not small
+        """
+        names = [read_name_set.names() for read_name_set in self.read_name_sets]
+        if None in names or sum(len(set_names) for set_names in names) > SMALL_SET_SIZE:
+            return None
+        return frozenset().union(*names)
+
+    def __len__(self):
+        return sum(len(read_name_set) for read_name_set in self.read_name_sets)
+
+    def __bool__(self):
+        return any(self.read_name_sets)
+
+
+class ReadNameBins:
+    """
+        Map of read names to bins, e.g. the genomic bins where the reads are
+        aligned. A read name added with several bins is mapped to the lowest one.
+        The (fingerprint, bin) pairs are sorted in runs of RUN_SIZE, which are
+        written to run files and merged into one map file by save. A saved map
+        is searched through a memory map, and names with colliding fingerprints
+        share the lowest bin of both.
+    """
+
+    def __init__(self, spill_dir=None):
+        """
+            Args:
+                spill_dir (Path): directory where run files are written
+        """
+        self.spill_dir = spill_dir
+        self._fingerprints = array("Q")
+        self._bins = array("I")
+        self._disk_runs = []
+        self._map = None
+        self._finalizer = weakref.finalize(self, _close_runs, self._disk_runs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+            Removes the run files from disk, and closes a loaded map
+        """
+        self._finalizer()
+
+    def add(self, read_name, bin_id):
+        """
+            Adds a read name in a bin
+
+            Args:
+                read_name (str or bytes): read name
+                bin_id (int): bin of read
+        """
+        self._fingerprints.append(fingerprint(_as_bytes(read_name))[0])
+        self._bins.append(bin_id)
+        if len(self._fingerprints) >= RUN_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """
+            Sorts the added pairs into a run file
+        """
+        if not self._fingerprints:
+            return
+        pairs = sorted(zip(self._fingerprints, self._bins))
+        del self._fingerprints[:], self._bins[:]
+        self._disk_runs.append(_DiskRun.write(self.spill_dir, pairs))
+
+    def save(self, path):
+        """
+            Merges the added read names into a map file, holding the lowest bin
+            of each name
+
+            Args:
+                path (str): path to map file
+        """
+        self._flush()
+        if not self._disk_runs:
+            open(path, "wb").close()
+            return
+        merged = heapq.merge(*(zip(run.fingerprints, run.checks) for run in self._disk_runs))
+        lowest = (
+            next(pairs) for _, pairs in itertools.groupby(merged, key=lambda pair: pair[0])
+        )
+        disk_run = _DiskRun.write(self.spill_dir, lowest)
+        disk_run.close(remove=False)
+        os.replace(disk_run.path, path)
+        _close_runs(self._disk_runs)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Opens a saved map file
+
+            Args:
+                path (str): path to map file
+            Returns:
+                (ReadNameBins): the map
+        """
+        read_name_bins = cls()
+        # An empty map can not be memory mapped, and has no names to find
+        if os.path.getsize(path) > 0:
+            read_name_bins._map = _DiskRun(path, owner=False)
+            read_name_bins._disk_runs.append(read_name_bins._map)
+        return read_name_bins
+
+    def get_fingerprint(self, name_fingerprint, default=None):
+        """
+            Finds the bin of a read name fingerprint in a loaded map
+
+            Args:
+                name_fingerprint (int): fingerprint of read name
+                default: returned if the fingerprint is not in the map
+            Returns:
+                bin_id (int): bin of read name
+        """
+        if self._map is None:
+            return default
+        fingerprints = self._map.fingerprints
+        index = bisect_left(fingerprints, name_fingerprint)
+        if index < len(fingerprints) and fingerprints[index] == name_fingerprint:
+            return self._map.checks[index]
+        return default
+
+    def get(self, read_name, default=None):
+        """
+            Finds the bin of a read name in a loaded map
+
+            Args:
+                read_name (str or bytes): read name
+                default: returned if the read name is not in the map
+            Returns:
+                bin_id (int): bin of read name
+        """
+        return self.get_fingerprint(fingerprint(_as_bytes(read_name))[0], default)
+
+
+def route_read_names(read_group_names, lane_read_groups):
+    """
+        Routes read names to the lanes sequenced in their read groups. Reads in
+        no lane's read group, or without read group, are routed to every lane.
+
+        Args:
+            read_group_names (dict): ReadNameSet of the reads in each read group
+            lane_read_groups (list(list(str))): read groups of each lane
+        Returns:
+            (list(ReadNameUnion)): read names of each lane
+    """
+    lane_groups = {read_group for read_groups in lane_read_groups for read_group in read_groups}
+    unrouted = [
+        read_names for read_group, read_names in read_group_names.items()
+        if read_group not in lane_groups
+    ]
+    return [
+        ReadNameUnion(
+            [read_group_names[read_group] for read_group in read_groups
+             if read_group in read_group_names] + unrouted
+        )
+        for read_groups in lane_read_groups
+    ]
+
+
+class _DiskRun:
+    """
+        Sorted run of fingerprints and check values in a memory mapped file
+    """
+
+    def __init__(self, path, owner=True):
+        """
+            Args:
+                path (str): path to run file
+                owner (bool): if True, the run file is removed when closed
+        """
+        self.path = path
+        self.owner = owner
+        with open(path, "rb") as run_handle:
+            self._map = mmap.mmap(run_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._map) // 12
+        self._view = memoryview(self._map)
+        self.fingerprints = self._view[:8 * size].cast("Q")
+        self.checks = self._view[8 * size:].cast("I")
+
+    @classmethod
+    def write(cls, spill_dir, items):
+        """
+            Writes sorted (fingerprint, check) items to a new run file
+
+            Args:
+                spill_dir (Path): directory of run file
+                items (iterable(tuple)): sorted (fingerprint, check) items
+            Returns:
+                (_DiskRun): the new run
+        """
+        file_descriptor, path = tempfile.mkstemp(suffix=".names", dir=spill_dir)
+        with os.fdopen(file_descriptor, "w+b") as run_handle:
+            checks = tempfile.TemporaryFile(dir=spill_dir)
+            with checks:
+                fingerprint_chunk = array("Q")
+                check_chunk = array("I")
+                for name_fingerprint, check in items:
+                    fingerprint_chunk.append(name_fingerprint)
+                    check_chunk.append(check)
+                    if len(fingerprint_chunk) == WRITE_CHUNK_SIZE:
+                        fingerprint_chunk.tofile(run_handle)
+                        check_chunk.tofile(checks)
+                        del fingerprint_chunk[:], check_chunk[:]
+                fingerprint_chunk.tofile(run_handle)
+                check_chunk.tofile(checks)
+                checks.seek(0)
+                while True:
+                    chunk = checks.read(4 * WRITE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    run_handle.write(chunk)
+        return cls(path)
+
+    def close(self, remove=True):
+        """
+            Closes the memory map and removes the run file, if owned
+
+            Args:
+                remove (bool): if False, the run file is kept
+        """
+        self.fingerprints.release()
+        self.checks.release()
+        self._view.release()
+        self._map.close()
+        if self.owner and remove:
+            os.remove(self.path)
+
+    def __iter__(self):
+        return iter((self.fingerprints, self.checks))
+
+
+def _close_runs(disk_runs):
+    """
+        Closes and removes a list of run files
+    """
+    for disk_run in disk_runs:
+        disk_run.close()
+    disk_runs.clear()
+
+
+def _as_bytes(read_name):
+    """
+        Encodes read name to bytes, if given as a string
+    """
+    if isinstance(read_name, str):
+        return read_name.encode()
+    return read_name
@@ -42,3 +42,23 @@ def overlapping_region(single_region, region_list):
         if overlaps(single_region, region):
             overlapping = True
     return overlapping
+
+def merge_regions(regions):
+    """
+        Merge a list of regions into a list of non-overlapping regions. Regions
+        on the same contig that overlap, or touch, are coalesced into one.
+
+        Args:
+            regions(list(tuple)): list of (chrom, start, end) tuples, sorted on
+                contig and start position
+
+        Returns:
+            merged(list(tuple)): list of coalesced (chrom, start, end) tuples
+    """
+    merged = []
+    for chrom, start, end in regions:
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2]:
+            merged[-1] = (chrom, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((chrom, start, end))
+    return merged
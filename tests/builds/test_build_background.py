@@ -0,0 +1,71 @@
+"""
+    Tests for build_background.py
+"""
+
+import gzip
+from pathlib import Path
+
+from Bio import SeqIO
+
+from mutacc.mutaccDB.query import mutacc_query
+from mutacc.builds.build_background import prepare_background, load_background
+from mutacc.builds.build_dataset import Dataset
+
+
+def _read_ids(fastq_file):
+    handle = gzip.open(fastq_file, 'rt') if str(fastq_file).endswith('.gz') else open(fastq_file)
+    with handle:
+        return [record.id.split("/")[0] for record in SeqIO.parse(handle, 'fastq')]
+
+
+def test_prepare_background(mock_real_adapter, background_fastqs, tmpdir, bam_path):
+
+    """
+        Test that a sharded background gives the same synthetic dataset
+    """
+
+    # GIVEN a background sharded in small bins
+    fastq_files = background_fastqs
+    background_dir = Path(str(tmpdir.join("background")))
+    temp_dir = Path(str(tmpdir.mkdir("tmp")))
+    prepare_background(bam_path, fastq_files, background_dir, bin_size=10000,
+                       tmp_dir=temp_dir)
+    background = load_background(background_dir)
+
+    # THEN all background reads are kept, in the same shards for both read ends
+    background_ids = _read_ids(fastq_files[0])
+    sharded_ids = _read_ids(background["fastq_files"][0])
+    assert sorted(sharded_ids) == sorted(background_ids)
+    assert _read_ids(background["fastq_files"][1]) == sharded_ids
+    assert len(background["shards"]) > 1
+
+    # WHEN making a synthetic dataset from the sharded and the original background
+    samples, _, variants = mutacc_query(
+        mock_real_adapter,
+        case_query={},
+        variant_query=None
+        )
+    datasets = []
+    for name, dataset_background in (
+            ("sharded", background),
+            ("original", {"bam_file": bam_path, "fastq_files": fastq_files})):
+        dataset = Dataset(samples=samples,
+                          variants=variants,
+                          tmp_dir=temp_dir,
+                          background=dataset_background,
+                          member='affected',
+                          out_dir=Path(str(tmpdir.mkdir(name))))
+        datasets.append(dataset)
+
+    # THEN the same reads are excluded from the backgrounds
+    sharded, original = datasets
+    sharded_background = _read_ids(sharded.excluded_backgrounds[0])
+    assert len(sharded_background) < len(background_ids)
+    assert sorted(sharded_background) == sorted(_read_ids(original.excluded_backgrounds[0]))
+
+    # THEN the synthetic fastq files hold the same reads, in the same order for
+    # both read ends
+    sharded_ends = [_read_ids(fastq) for fastq in sharded.synthetic_fastqs]
+    original_ends = [_read_ids(fastq) for fastq in original.synthetic_fastqs]
+    assert sharded_ends[0] == sharded_ends[1]
+    assert sorted(sharded_ends[0]) == sorted(original_ends[0])
@@ -41,3 +41,34 @@ def test_case(tmpdir, vcf_parser):
         for fastq_file in sample["variant_fastq_files"]:
 
             assert Path(fastq_file).exists()
+
+
+def test_case_workers(tmpdir, vcf_parser):
+
+    """
+        Test Case class with samples built concurrently
+    """
+
+    # GIVEN a case with several samples, and several workers
+    tmp_dir = Path(tmpdir.mkdir("build_case_workers_test"))
+    assert len(CASE["samples"]) > 1
+
+    # WHEN building the case
+    case = Case(
+        input_case=CASE,
+        read_dir=tmp_dir,
+        padding=100,
+        sv_padding=300,
+        vcf_parse=vcf_parser["import"],
+        workers=4,
+    )
+
+    # THEN the samples should be built in the order given, with their reads extracted
+    assert [sample["sample_id"] for sample in case["samples"]] == [
+        sample["sample_id"] for sample in CASE["samples"]
+    ]
+    for sample in case["samples"]:
+
+        for fastq_file in sample["variant_fastq_files"]:
+
+            assert Path(fastq_file).exists()
@@ -2,16 +2,19 @@
     Tests for build_dataset.py
 """
 
+import gzip
 from pathlib import Path
 
+import pytest
+
 from mutacc.mutaccDB.query import mutacc_query
-from mutacc.builds.build_dataset import Dataset
+from mutacc.builds.build_dataset import Dataset, make_datasets
 
 
-BAM = "tests/fixtures/reduced_ref_4_1000000_10002000.bam"
 FASTQ1 = "tests/fixtures/fastq1.fastq"
 FASTQ2 = "tests/fixtures/fastq2.fastq"
-def test_makeset(mock_real_adapter, tmpdir):
+@pytest.mark.parametrize("workers", [1, 2])
+def test_makeset(mock_real_adapter, tmpdir, workers, bam_path):
 
     """
         Test building dataset
@@ -23,7 +26,7 @@ def test_makeset(mock_real_adapter, tmpdir):
         variant_query=None
         )
 
-    background = {"bam_file": BAM,
+    background = {"bam_file": bam_path,
                   "fastq_files": [FASTQ1, FASTQ2]}
 
     temp_dir = Path(str(tmpdir.mkdir("export_tmp_test")))
@@ -35,8 +38,143 @@ def test_makeset(mock_real_adapter, tmpdir):
                       tmp_dir=temp_dir,
                       background=background,
                       member='affected',
-                      out_dir=out_dir)
+                      out_dir=out_dir,
+                      workers=workers)
 
     synthetics = dataset.synthetic_fastqs
     for synthetic in synthetics:
         assert Path(synthetic).exists()
+
+        assert Path(synthetic).name.startswith("synthetic_affected_")
+
+
+def test_makeset_failure(mock_real_adapter, tmpdir, bam_path):
+
+    """
+        Test that no partial synthetic fastq files are left when a read end fails
+    """
+
+    # GIVEN a paired end background where the second fastq file is broken
+    samples, _, variants = mutacc_query(
+        mock_real_adapter,
+        case_query={},
+        variant_query=None
+        )
+
+    broken_fastq = tmpdir.join("broken.fastq.gz")
+    broken_fastq.write("not gzip compressed")
+    background = {"bam_file": bam_path,
+                  "fastq_files": [FASTQ1, str(broken_fastq)]}
+
+    temp_dir = Path(str(tmpdir.mkdir("export_tmp_test")))
+    out_dir = Path(str(tmpdir.mkdir("export_out_test")))
+
+    # WHEN building the dataset with the read ends in parallel
+    with pytest.raises(Exception):
+        Dataset(samples=samples,
+                variants=variants,
+                tmp_dir=temp_dir,
+                background=background,
+                member='affected',
+                out_dir=out_dir,
+                workers=2)
+
+    # THEN the error is raised, and no synthetic fastq file is left behind
+    assert list(out_dir.glob("*.fastq*")) == []
+
+
+def test_makeset_seqkit_exe(mock_real_adapter, tmpdir, bam_path):
+
+    """
+        Test that the deprecated seqkit_exe argument is accepted and ignored
+    """
+
+    # GIVEN a background and variants
+    samples, _, variants = mutacc_query(
+        mock_real_adapter,
+        case_query={},
+        variant_query=None
+        )
+
+    background = {"bam_file": bam_path,
+                  "fastq_files": [FASTQ1, FASTQ2]}
+
+    temp_dir = Path(str(tmpdir.mkdir("export_tmp_test")))
+    out_dir = Path(str(tmpdir.mkdir("export_out_test")))
+
+    # WHEN building the dataset with a seqkit executable
+    with pytest.warns(DeprecationWarning):
+        dataset = Dataset(samples=samples,
+                          variants=variants,
+                          tmp_dir=temp_dir,
+                          background=background,
+                          member='affected',
+                          out_dir=out_dir,
+                          seqkit_exe='seqkit')
+
+    # THEN the synthetic fastq files are still made
+    assert len(dataset.synthetic_fastqs) == 2
+    for synthetic in dataset.synthetic_fastqs:
+        assert Path(synthetic).exists()
+
+
+def _read_ids(fastq_file):
+    with gzip.open(fastq_file, 'rt') as handle:
+        return [line.split()[0].split("/")[0] for index, line in enumerate(handle)
+                if index % 4 == 0]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_make_datasets(mock_real_adapter, background_fastqs, tmpdir, workers, bam_path):
+
+    """
+        Test making several datasets from one read of the background
+    """
+
+    # GIVEN two queries, each with part of the variants
+    samples, _, variants = mutacc_query(
+        mock_real_adapter,
+        case_query={},
+        variant_query=None
+        )
+    queries = [(samples, variants[::2], 'child'), (samples, variants[1::2], 'mother')]
+
+    background = {"bam_file": bam_path,
+                  "fastq_files": [fastq + ".gz" for fastq in background_fastqs]}
+    for fastq in background_fastqs:
+        with open(fastq, 'rb') as in_handle, gzip.open(fastq + ".gz", 'wb') as out_handle:
+            out_handle.write(in_handle.read())
+
+    temp_dir = Path(str(tmpdir.mkdir("export_tmp_test")))
+
+    # WHEN making the datasets together, and each on its own
+    together_dir = Path(str(tmpdir.mkdir("together")))
+    datasets = [Dataset(samples=query_samples,
+                        variants=query_variants,
+                        tmp_dir=temp_dir,
+                        background=background,
+                        member=member,
+                        out_dir=together_dir,
+                        workers=workers,
+                        make_fastqs=False)
+                for query_samples, query_variants, member in queries]
+    make_datasets(datasets, out_dir=together_dir)
+
+    for dataset, (query_samples, query_variants, member) in zip(datasets, queries):
+        alone_dir = Path(str(tmpdir.mkdir(member)))
+        alone = Dataset(samples=query_samples,
+                        variants=query_variants,
+                        tmp_dir=temp_dir,
+                        background=background,
+                        member=member,
+                        out_dir=alone_dir)
+
+        # THEN each dataset gets the same reads as when made on its own
+        assert len(dataset.synthetic_fastqs) == 2
+        for together_fastq, alone_fastq in zip(dataset.synthetic_fastqs,
+                                               alone.synthetic_fastqs):
+            assert _read_ids(together_fastq) == _read_ids(alone_fastq)
+
+    # THEN the datasets exclude different background reads
+    backgrounds = [set(_read_ids(dataset.excluded_backgrounds[0])) for dataset in datasets]
+    assert backgrounds[0] != backgrounds[1]
@@ -1,8 +1,10 @@
 import pytest
+import shutil
 from unittest.mock import patch
 
 from pathlib import Path
 from mutacc.builds.build_version import VersionedDataset
+from mutacc.utils.checksums import file_checksums, write_checksums
 
 SAMPLE_IDS = ('sample_1', 'sample_2', 'sample_3')
 E_SAMPLE_ID = 'sample_4'
@@ -38,3 +40,24 @@ def test_build_dataset(mock_md5, dataset_dir):
     assert set(versioned_dataset.keys()) == {'dataset_id', 'samples', 'vcf'}
     versioned_dataset.build_dataset(md5=True, comment='comment')
     assert set(versioned_dataset.keys()) == {'dataset_id', 'samples', 'vcf', 'comment'}
+
+
+def test_build_dataset_manifest(dataset_dir, tmpdir):
+
+    # GIVEN a dataset where the checksums of one file are in a manifest
+    dataset_copy = Path(str(tmpdir.join("dataset")))
+    shutil.copytree(dataset_dir, dataset_copy)
+    manifest_file = dataset_copy.joinpath('sample_1', 'sample_1_1.fastq.gz')
+    write_checksums(manifest_file, {'md5': 'manifest_md5'})
+
+    # WHEN versioning the dataset with md5 sums
+    versioned_dataset = VersionedDataset(dataset_dir=dataset_copy)
+    versioned_dataset.build_dataset(md5=True)
+
+    # THEN the md5 sum in the manifest is used, and the others are computed
+    files = {Path(file['path']).name: file['md5']
+             for sample in versioned_dataset['samples'] for file in sample['files']}
+    assert files['sample_1_1.fastq.gz'] == 'manifest_md5'
+    assert files['sample_1_2.fastq.gz'] == file_checksums(
+        dataset_copy.joinpath('sample_1', 'sample_1_2.fastq.gz'))['md5']
+    assert len(files) == 6
@@ -2,6 +2,7 @@
     Test extract command
 """
 
+import json
 from pathlib import Path
 import time
 
@@ -11,6 +12,7 @@ from mutacc.cli.root import cli
 
 
 CASE_PATH = "tests/fixtures/case.yaml"
+CASE_FASTQ_PATH = "tests/fixtures/case_fastq.yaml"
 CONFIG_PATH = "tests/fixtures/config.yaml"
 
 def test_extract(tmpdir):
@@ -34,7 +36,7 @@ def test_extract(tmpdir):
 
     for i in [1, 2, 3]:
 
-        assert Path(root_dir).joinpath(
+        assert not Path(root_dir).joinpath(
             "reads/12345/{}/{}/mutacc_reduced_ref_4_1000000_10002000.bam".format(
                 date_str,
                 i
@@ -54,3 +56,38 @@ def test_extract(tmpdir):
                 i
                 )
             ).exists()
+
+
+def test_extract_metrics(tmpdir):
+    """
+        test extract command writing throughput metrics
+    """
+
+    root_dir = str(tmpdir.mkdir("mutacc_root_test"))
+
+    # GIVEN a case with fastq files
+    runner = CliRunner()
+
+    # WHEN extracting reads with the --metrics option
+    result = runner.invoke(cli, [
+        '--root-dir', root_dir,
+        'extract',
+        '--padding', '1500',
+        '--case', CASE_FASTQ_PATH,
+        '--metrics'
+        ])
+
+    assert result.exit_code == 0
+
+    # THEN the metrics of each sample should be written next to the import file
+    metrics_file = Path(root_dir).joinpath("imports/12345_import_mutacc.metrics.json")
+    with open(metrics_file) as metrics_handle:
+        metrics = json.load(metrics_handle)
+
+    assert metrics["case_id"] == "12345"
+    assert set(metrics["samples"]) == {"1", "2", "3"}
+    for sample_metrics in metrics["samples"].values():
+        assert sample_metrics["mode"] == "serial"
+        assert sample_metrics["records"] > 0
+        assert sample_metrics["decompressed_bytes"] > 0
+        assert set(sample_metrics["seconds"]) == {"total", "reading", "parsing", "writing"}
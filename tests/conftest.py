@@ -4,6 +4,7 @@
 
 from pathlib import Path
 import random
+import shutil
 import pytest
 
 from pysam import AlignmentFile
@@ -24,9 +25,52 @@ CONFIG_PATH = "tests/fixtures/config.yaml"
 BAM_PATH = "tests/fixtures/reduced_ref_4_1000000_10002000.bam"
 
 
+@pytest.fixture(autouse=True)
+def stats_cache(tmp_path_factory, monkeypatch):
+    """
+    Cache the statistics of bam files in a temporary directory, and not next to
+    the bam files in the fixtures
+    """
+
+    cache_dir = tmp_path_factory.mktemp("stats_cache")
+    monkeypatch.setenv("MUTACC_STATS_CACHE", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture
+def bam_path(tmpdir):
+    """
+    Copy of the bam file, with its index
+    """
+
+    bam_copy = str(tmpdir.join(Path(BAM_PATH).name))
+    shutil.copy(BAM_PATH, bam_copy)
+    shutil.copy(BAM_PATH + ".bai", bam_copy + ".bai")
+    return bam_copy
+
+
 @pytest.fixture
-def bam_path():
-    return BAM_PATH
+def background_fastqs(tmpdir):
+    """
+    Fastq files with the primary read pairs of the bam file, one per read end
+    """
+
+    fastq_files = [str(tmpdir.join("background_R1.fastq")),
+                   str(tmpdir.join("background_R2.fastq"))]
+    pairs = {}
+    with AlignmentFile(BAM_PATH, "rb") as sam:
+        for read in sam.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            pairs.setdefault(read.query_name, [None, None])[0 if read.is_read1 else 1] = read
+    with open(fastq_files[0], "w") as handle_1, open(fastq_files[1], "w") as handle_2:
+        for name, reads in pairs.items():
+            if None in reads:
+                continue
+            for handle, read in zip((handle_1, handle_2), reads):
+                qualities = "".join(chr(quality + 33) for quality in read.get_forward_qualities())
+                handle.write(f"@{name}\n{read.get_forward_sequence()}\n+\n{qualities}\n")
+    return fastq_files
 
 
 @pytest.fixture
@@ -1,7 +1,17 @@
+import gzip
+import shutil
+
 import pytest
 import pysam
 from pathlib import Path
-from mutacc.utils.bam_handler import BAMContext
+from mutacc.utils.bam_handler import BAMContext, ReadPairs, STATS_SUFFIX, stats_cache_path
+
+
+def _read(name, flag):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.flag = flag
+    return read
 
 
 def test_BAMContext(tmpdir, bam_path):
@@ -19,13 +29,6 @@ def test_BAMContext(tmpdir, bam_path):
 
         assert bam_handle.out_name.exists()
 
-        temp_names = bam_handle.make_names_temp(Path(tmpdir.mkdir("names_dir")))
-
-        assert Path(temp_names).exists()
-
-
-    assert not Path(temp_names).exists()
-
 
 def test_BAMContext_find_names(read_ids_fixed, bam_path):
 
@@ -42,7 +45,7 @@ def test_BAMContext_find_names(read_ids_fixed, bam_path):
         )
 
     #THEN the set of read names found should correspond to the the above read names
-        assert set(read_ids_fixed) == bam_handle.found_reads
+        assert set(read_ids_fixed) == set(bam_handle.found_names())
 
 
 def test_BAMContext_find_reads_by_proximity(read_ids_fixed, bam_path):
@@ -61,7 +64,7 @@ def test_BAMContext_find_reads_by_proximity(read_ids_fixed, bam_path):
         )
 
     #THEN the set of read names found should correspond to the the above read names
-        assert bam_handle.found_reads.issubset(set(read_ids_fixed))
+        assert set(bam_handle.found_names()).issubset(set(read_ids_fixed))
 
 
 def test_BAMContext_find_reads_without_mates(read_ids_fixed, bam_path):
@@ -80,4 +83,319 @@ def test_BAMContext_find_reads_without_mates(read_ids_fixed, bam_path):
         )
 
     #THEN the set of read names found should correspond to the the above read names
-        assert bam_handle.found_reads.issubset(set(read_ids_fixed))
+        assert set(bam_handle.found_names()).issubset(set(read_ids_fixed))
+
+
+def test_BAMContext_find_names_from_regions(read_ids_fixed, bam_path):
+
+    # GIVEN overlapping regions covering the reads in the bam-file
+    regions = [
+        {"chrom": "4", "start": 5000000, "end": 10002000, "padding": 100},
+        {"chrom": "4", "start": 1000000, "end": 6000000},
+    ]
+
+    with BAMContext(bam_file=bam_path) as bam_handle:
+
+    # WHEN extracting the read names from all regions at once
+        bam_handle.find_names_from_regions(regions)
+
+    # THEN the read names should be the same as when fetching the whole region
+        assert set(read_ids_fixed) == set(bam_handle.found_names())
+
+
+def test_BAMContext_find_mates_explicitly(bam_path):
+
+    # GIVEN the reads in a small region whose mates can be found with pysam
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        reads_with_mates = set()
+        for read in bam.fetch("4", 10000400, 10000600):
+            try:
+                bam.mate(read)
+            except ValueError:
+                continue
+            reads_with_mates.add(read.query_name)
+
+    with BAMContext(bam_file=bam_path) as bam_handle:
+
+    # WHEN finding the reads in the region, and searching for their mates
+        bam_handle.find_reads_from_region(
+            chrom="4",
+            start=10000400,
+            end=10000600
+        )
+
+    # THEN the same read pairs should be found
+        assert set(bam_handle.found_names()) == reads_with_mates
+
+
+def test_ReadPairs():
+
+    # GIVEN a table for paired reads
+    pairs = ReadPairs(ends=2)
+
+    # WHEN adding the second end of a pair, and the same read again
+    read2 = _read("read", 0x1 | 0x80)
+    assert not pairs.add(read2)
+    assert not pairs.add(_read("read", 0x1 | 0x80))
+
+    # THEN supplementary alignments should not be paired, but kept once
+    supplementary = _read("read", 0x1 | 0x40 | 0x800)
+    assert not pairs.add(supplementary)
+    assert not pairs.add(_read("read", 0x1 | 0x40 | 0x800))
+    assert pairs.pending_read("read") is read2
+
+    # THEN the pair is complete when the first end is added
+    read1 = _read("read", 0x1 | 0x40)
+    assert pairs.add(read1)
+    assert pairs.pop("read") == [read1, read2]
+    assert pairs.pop_non_primary("read") == [supplementary]
+    assert len(pairs) == 0
+
+
+def _split_read_bam(tmpdir):
+    """
+        Writes a bam file with a read pair whose first end has a supplementary
+        alignment 5 kb away
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": "1", "LN": 100000}]}
+    bam_file = str(tmpdir.join("split_read.bam"))
+    with pysam.AlignmentFile(bam_file, "wb", header=header) as bam_handle:
+        for flag, start, mate_start in ((0x1 | 0x2 | 0x20 | 0x40, 1000, 1200),
+                                        (0x1 | 0x2 | 0x10 | 0x80, 1200, 1000),
+                                        (0x1 | 0x40 | 0x800, 6000, 1200)):
+            read = pysam.AlignedSegment()
+            read.query_name = "split_read"
+            read.flag = flag
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigarstring = "50M"
+            read.query_sequence = "A" * 50
+            read.query_qualities = pysam.qualitystring_to_array("I" * 50)
+            read.next_reference_id = 0
+            read.next_reference_start = mate_start
+            read.template_length = 250 if start < mate_start else -250
+            bam_handle.write(read)
+    pysam.index(bam_file)
+    return bam_file
+
+
+def test_BAMContext_non_primary(tmpdir):
+
+    # GIVEN a read pair with a supplementary alignment of the first end
+    bam_file = _split_read_bam(tmpdir)
+
+    # WHEN finding the reads in the regions of the pair and of the supplementary
+    # alignment, written to a bam-file and to fastq files
+    regions = [{"chrom": "1", "start": 1000, "end": 1300},
+               {"chrom": "1", "start": 6000, "end": 6050},
+               {"chrom": "1", "start": 900, "end": 6100}]
+    for out_format in ("bam", "fastq"):
+        out_dir = Path(tmpdir.mkdir(out_format))
+        with BAMContext(bam_file=bam_file, out_dir=out_dir, out_format=out_format) as bam_handle:
+            for region in regions:
+                bam_handle.find_reads_from_region(**region)
+            out_name = bam_handle.out_file if out_format == "bam" else bam_handle.out_names[0]
+
+    # THEN the bam-file should hold the pair and the supplementary alignment once
+        if out_format == "bam":
+            with pysam.AlignmentFile(out_name, "rb") as out_bam:
+                flags = sorted(read.flag for read in out_bam.fetch(until_eof=True))
+            assert flags == [0x1 | 0x2 | 0x20 | 0x40, 0x1 | 0x2 | 0x10 | 0x80, 0x1 | 0x40 | 0x800]
+
+    # THEN the fastq files should hold each read once
+        else:
+            with gzip.open(out_name, "rt") as fastq_handle:
+                assert fastq_handle.read().count("@split_read") == 1
+
+
+def test_BAMContext_stats_sidecar(bam_path, stats_cache, monkeypatch):
+
+    # GIVEN a bam file without cached statistics, and a statistics cache directory
+    sidecar = stats_cache_path(bam_path)
+    assert sidecar.parent == Path(str(stats_cache))
+
+    # WHEN opening the bam file
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        stats = (bam_handle.paired, bam_handle.length, bam_handle.insert_size_percentiles)
+
+    # THEN the statistics should be cached in the cache directory only
+    assert [path.name for path in sidecar.parent.iterdir()] == [sidecar.name]
+    assert not Path(bam_path + STATS_SUFFIX).exists()
+    assert stats[0]
+    assert stats[2][5] <= stats[2][50] <= stats[2][95]
+
+    # WHEN opening the bam file again
+    def _sample_bam_stats(self):
+        raise AssertionError("bam statistics computed again")
+    monkeypatch.setattr(BAMContext, "_sample_bam_stats", _sample_bam_stats)
+    with BAMContext(bam_file=bam_path) as bam_handle:
+
+    # THEN the statistics should be read from the sidecar file
+        assert stats == (bam_handle.paired, bam_handle.length, bam_handle.insert_size_percentiles)
+        assert bam_handle.insert_size == stats[2][50]
+
+
+def test_BAMContext_stats_sidecar_fallback(bam_path, monkeypatch, caplog):
+
+    # GIVEN no statistics cache directory
+    monkeypatch.delenv("MUTACC_STATS_CACHE")
+
+    # WHEN opening the bam file
+    with BAMContext(bam_file=bam_path):
+        pass
+
+    # THEN the statistics should be cached next to the bam file
+    assert stats_cache_path(bam_path) == Path(bam_path + STATS_SUFFIX)
+    assert Path(bam_path + STATS_SUFFIX).exists()
+
+    # GIVEN a cache directory that can not be written to
+    monkeypatch.setenv("MUTACC_STATS_CACHE", str(Path(bam_path).with_name("missing")))
+
+    # WHEN opening the bam file
+    with BAMContext(bam_file=bam_path) as bam_handle:
+
+    # THEN the statistics should still be computed, and the failure logged
+        assert bam_handle.paired
+    assert any(record.levelname == "WARNING" and "Could not cache" in record.getMessage()
+               for record in caplog.records)
+
+
+SHARDED_REGIONS = [
+    {"chrom": "4", "start": 10000400, "end": 10000600, "padding": 100},
+    {"chrom": "1", "start": 10000400, "end": 10000600, "padding": 100},
+    {"chrom": "4", "start": 10001200, "end": 10001300},
+]
+
+
+def test_BAMContext_find_names_sharded(bam_path):
+
+    # GIVEN the read names found in regions on two contigs by a single process
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        bam_handle.find_names_from_regions(SHARDED_REGIONS)
+        serial_reads = set(bam_handle.found_names())
+
+    # WHEN searching the contigs in separate processes
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        bam_handle.find_names_from_regions(SHARDED_REGIONS, workers=2)
+
+    # THEN the same read names should be found
+        assert serial_reads
+        assert set(bam_handle.found_names()) == serial_reads
+
+
+def test_BAMContext_read_groups(bam_path):
+
+    # GIVEN a bam file with reads tagged with one read group
+    read_group = "ADM1059A4.171015_H2TF5CCXX-11_XXXXXX.lane8"
+
+    # WHEN finding read names, in a single process and in separate processes
+    for workers in (1, 2):
+        with BAMContext(bam_file=bam_path, track_read_groups=True) as bam_handle:
+            bam_handle.find_names_from_regions(SHARDED_REGIONS, workers=workers)
+
+            # THEN the read names should be kept by the read group of the reads
+            assert set(bam_handle.read_group_names) == {read_group}
+            assert len(bam_handle.read_group_names[read_group]) == bam_handle.record_number
+            assert {group for _, group in bam_handle.found_read_groups()} == {read_group}
+
+    # WHEN finding read pairs
+    with BAMContext(bam_file=bam_path, track_read_groups=True) as bam_handle:
+        bam_handle.find_reads_from_regions(SHARDED_REGIONS)
+
+        # THEN the read pairs should also be kept by their read group
+        assert set(bam_handle.read_group_names) == {read_group}
+        assert len(bam_handle.read_group_names[read_group]) == bam_handle.record_number
+
+    # WHEN read groups are not asked for
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        bam_handle.find_names_from_regions(SHARDED_REGIONS)
+
+        # THEN the read names should not be kept by read group
+        assert bam_handle.record_number
+        assert bam_handle.read_group_names == {}
+
+
+def test_BAMContext_find_reads_sharded(tmpdir, bam_path):
+
+    # GIVEN the read pairs found in regions on two contigs by a single process
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        bam_handle.find_reads_from_regions(SHARDED_REGIONS)
+        serial_reads = set(bam_handle.found_names())
+
+    # WHEN searching the contigs in separate processes
+    out_dir = Path(tmpdir.mkdir("sharded"))
+    with BAMContext(bam_file=bam_path, out_dir=out_dir) as bam_handle:
+        bam_handle.find_reads_from_regions(SHARDED_REGIONS, workers=2)
+        out_file = bam_handle.out_file
+
+    # THEN the merged bam-file should hold each of the read pairs once
+    with pysam.AlignmentFile(out_file, "rb") as out_bam:
+        read_names = [read.query_name for read in out_bam.fetch(until_eof=True)]
+    assert serial_reads
+    assert set(read_names) == serial_reads
+    assert len(read_names) == 2 * len(serial_reads)
+
+    # THEN the partial bam-files should be removed
+    assert [path.name for path in out_dir.iterdir()] == [Path(out_file).name]
+
+
+def test_BAMContext_fastq_out(tmpdir, bam_path):
+
+    # GIVEN an output directory for fastq files
+    out_dir = Path(tmpdir.mkdir("fastq_out"))
+
+    # WHEN writing the read pairs in a region as fastq
+    with BAMContext(bam_file=bam_path, out_dir=out_dir, out_format="fastq") as bam_handle:
+        bam_handle.find_reads_from_region(
+            chrom="4",
+            start=10000400,
+            end=10000600
+        )
+        found_reads = set(bam_handle.found_names())
+        out_files = bam_handle.out_files
+
+    # THEN each read end should be written in its sequenced orientation
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        reads = {
+            (read.query_name, 2 if read.is_read2 else 1): read
+            for read in bam.fetch(until_eof=True)
+            if not read.is_secondary and not read.is_supplementary
+        }
+    assert len(out_files) == 2
+    for end, out_file in enumerate(out_files, 1):
+        with gzip.open(out_file, "rt") as fastq_handle:
+            lines = fastq_handle.read().splitlines()
+        assert len(lines) == 4 * len(found_reads)
+        for header, sequence, quality in zip(lines[0::4], lines[1::4], lines[3::4]):
+            read_name, suffix = header[1:].split("/")
+            assert suffix == str(end)
+            read = reads[(read_name, end)]
+            assert sequence == read.get_forward_sequence()
+            assert quality == pysam.qualities_to_qualitystring(read.get_forward_qualities())
+
+
+def test_BAMContext_cram(tmpdir, bam_path):
+
+    # GIVEN the bam-file converted to cram
+    cram_path = str(tmpdir.join("reads.cram"))
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        with pysam.AlignmentFile(cram_path, "wc", template=bam,
+                                 format_options=[b"no_ref=1"]) as cram:
+            for read in bam.fetch(until_eof=True):
+                cram.write(read)
+    pysam.index(cram_path)
+
+    with BAMContext(bam_file=bam_path) as bam_handle:
+        bam_handle.find_reads_from_region(chrom="4", start=10000400, end=10000600)
+        bam_reads = set(bam_handle.found_names())
+
+    # WHEN finding the read pairs in a region of the cram file
+    out_dir = Path(tmpdir.mkdir("cram_out"))
+    with BAMContext(bam_file=cram_path, out_dir=out_dir) as bam_handle:
+        bam_handle.find_reads_from_region(chrom="4", start=10000400, end=10000600)
+
+    # THEN the same read pairs should be found, and written to a bam-file
+        assert set(bam_handle.found_names()) == bam_reads
+        assert bam_handle.out_file == str(out_dir.joinpath("mutacc_reads.bam"))
@@ -0,0 +1,57 @@
+import gzip
+import hashlib
+import os
+
+from mutacc.utils.checksums import (ChecksumFile, MANIFEST_NAME, file_checksums,
+                                    read_checksums, write_checksums)
+from mutacc.utils.fastq_handler import fastq_extract
+
+
+def test_ChecksumFile(tmpdir):
+
+    # GIVEN a gzip file written through a checksum file
+    file_path = str(tmpdir.join("test.txt.gz"))
+    with ChecksumFile(file_path) as checksum_file:
+        with gzip.open(checksum_file, 'wt') as gzip_handle:
+            gzip_handle.write("mutacc\n" * 1000)
+
+    # THEN the checksums should be those of the compressed file
+    with open(file_path, 'rb') as file_handle:
+        md5_sum = hashlib.md5(file_handle.read()).hexdigest()
+    assert checksum_file.digests()['md5'] == md5_sum
+    assert file_checksums(file_path) == checksum_file.digests()
+
+
+def test_manifest(tmpdir):
+
+    # GIVEN the checksums of two files written to the manifest
+    paths = [str(tmpdir.join(name)) for name in ("file_1.txt", "file_2.txt")]
+    for path in paths:
+        with open(path, 'w') as file_handle:
+            file_handle.write(path)
+        write_checksums(path, file_checksums(path))
+
+    # THEN the checksums of both files are found
+    assert tmpdir.join(MANIFEST_NAME).exists()
+    for path in paths:
+        assert read_checksums(path) == file_checksums(path)
+
+    # WHEN a file is changed, THEN its checksums are out of date
+    with open(paths[0], 'a') as file_handle:
+        file_handle.write("changed")
+    assert read_checksums(paths[0]) is None
+    assert read_checksums(str(tmpdir.join("file_3.txt"))) is None
+
+
+def test_fastq_extract_checksums(tmpdir):
+
+    # GIVEN reads extracted from fastq files
+    files = ['tests/fixtures/fastq1.fastq', 'tests/fixtures/fastq2.fastq']
+    with open(files[0], 'r') as handle:
+        ids = [line[1:].split()[0] for index, line in enumerate(handle) if index % 4 == 0][:3]
+    paths = fastq_extract(files, ids, tmpdir.mkdir("checksum_test"))
+
+    # THEN the checksums computed while writing are those of the files
+    for path in paths:
+        assert read_checksums(path) == file_checksums(path)
+        assert os.path.getsize(path) > 0
@@ -0,0 +1,128 @@
+import gzip
+import io
+from pathlib import Path
+import subprocess
+
+import pytest
+import pysam
+
+from mutacc.utils import compression
+from mutacc.utils.compression import (gzip_writer, gzip_reader, PipedGzipReader, ReadAheadReader,
+                                      bgzf_block_offsets, read_bgzf_block)
+
+
+def test_gzip_writer(tmpdir, monkeypatch):
+
+    # GIVEN several threads but no pigz executable
+    monkeypatch.setattr(compression.shutil, "which", lambda exe: None)
+    out_file = Path(str(tmpdir)).joinpath("out.fastq.gz")
+
+    # WHEN writing text to a gzip file
+    with gzip_writer(out_file, threads=4) as out_handle:
+        out_handle.write("@read\nACGT\n+\nFFFF\n")
+
+    # THEN the file should be compressed in this thread, and readable with gzip
+    with gzip.open(out_file, "rt") as in_handle:
+        assert in_handle.read() == "@read\nACGT\n+\nFFFF\n"
+
+
+def test_gzip_reader(tmpdir):
+
+    # GIVEN a gzip file
+    in_file = Path(str(tmpdir)).joinpath("in.fastq.gz")
+    with gzip.open(in_file, "wt") as out_handle:
+        out_handle.write("@read\nACGT\n+\nFFFF\n" * 1000)
+
+    # WHEN decompressing in a separate process, which takes the same
+    # arguments as igzip and pigz
+    with gzip_reader(in_file, mode="rb", backends=("gzip",)) as in_handle:
+        # THEN the file should be read through a pipe
+        assert isinstance(in_handle, PipedGzipReader)
+        assert in_handle.read() == b"@read\nACGT\n+\nFFFF\n" * 1000
+
+    # WHEN only part of the file is read
+    with gzip_reader(in_file, backends=("gzip",)) as in_handle:
+        # THEN the rest should not be needed to close the file
+        assert in_handle.readline() == "@read\n"
+
+    # WHEN a truncated file is read to the end
+    truncated_file = Path(str(tmpdir)).joinpath("truncated.fastq.gz")
+    truncated_file.write_bytes(in_file.read_bytes()[:-20])
+    in_handle = gzip_reader(truncated_file, mode="rb", backends=("gzip",))
+    in_handle.read()
+    # THEN the failure of the decompression process should be raised on close
+    with pytest.raises(subprocess.CalledProcessError):
+        in_handle.close()
+
+    # WHEN no executable is found
+    # THEN the next backend should be used
+    with gzip_reader(in_file, backends=("not_an_executable", "zlib")) as in_handle:
+        assert in_handle.readline() == "@read\n"
+
+
+def test_read_ahead_reader():
+
+    # GIVEN a file read ahead in small chunks
+    data = b"@read\nACGT\n+\nFFFF\n" * 1000
+    with ReadAheadReader(io.BytesIO(data), chunk_size=100, chunks=2) as reader:
+        # WHEN reading to the end
+        chunks = iter(reader.read, b"")
+        # THEN all data should be read in order
+        assert b"".join(chunks) == data
+        assert reader.read() == b""
+
+    # WHEN closing the reader before the end, with the queue full
+    handle = io.BytesIO(data)
+    reader = ReadAheadReader(handle, chunk_size=100, chunks=2)
+    assert reader.read() == data[:100]
+    reader.close()
+
+    # THEN the file should be closed
+    assert handle.closed
+
+
+def test_read_ahead_reader_error():
+
+    # GIVEN a file that fails to be read
+    class FailingHandle(io.BytesIO):
+        def read(self, size=-1):
+            raise OSError("corrupt file")
+
+    # WHEN reading ahead
+    # THEN the error should be raised by read
+    with ReadAheadReader(FailingHandle()) as reader:
+        with pytest.raises(OSError):
+            reader.read()
+
+
+def test_read_bgzf_block(tmpdir):
+
+    # GIVEN a BGZF file with two blocks of data
+    bgzf_file = str(tmpdir.join("blocks.gz"))
+    bgzf_handle = pysam.BGZFile(bgzf_file, 'wb')
+    for data in (b"first block\n", b"second\n"):
+        bgzf_handle.write(data)
+        bgzf_handle.flush()
+    bgzf_handle.close()
+
+    # WHEN finding the blocks
+    blocks = list(bgzf_block_offsets(bgzf_file))
+
+    # THEN the decompressed size of each block should be given, with the empty
+    # end of file marker last
+    assert [size for _, size in blocks] == [12, 7, 0]
+    with open(bgzf_file, 'rb') as handle:
+        assert read_bgzf_block(handle) == b"first block\n"
+
+    # GIVEN a block with a corrupt checksum
+    with open(bgzf_file, 'rb') as handle:
+        content = bytearray(handle.read())
+    content[blocks[1][0] - 8] ^= 0xFF
+    corrupt_file = tmpdir.join("corrupt.gz")
+    corrupt_file.write_binary(bytes(content))
+
+    # WHEN reading the block
+    # THEN the corruption should be detected
+    with open(str(corrupt_file), 'rb') as handle:
+        with pytest.raises(ValueError):
+            read_bgzf_block(handle)
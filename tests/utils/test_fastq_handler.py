@@ -1,10 +1,18 @@
 import pytest
 import random
 import gzip
+import io
+import os
+import shutil
+from pathlib import Path
 
+import pysam
 from Bio import SeqIO
 
 from mutacc.utils.fastq_handler import *
+from mutacc.utils.fastq_handler import _merged_lane_names as merged_names
+from mutacc.utils.compression import bgzf_block_offsets
+from mutacc.utils.metrics import ScanMetrics
 
 def test_fastq_extract(tmpdir):
     """
@@ -53,3 +61,331 @@ def test_fastq_extract(tmpdir):
     
 
     
+
+def test_fastq_records():
+    """
+        Test function for fastq_records
+    """
+
+    #GIVEN a fastq with a comment, a read suffix, and no final newline
+    fastq = (b"@read1 1:N:0:CGCGCATT\nACGT\n+\nFFFF\n"
+             b"@read2/1\nAC\n+read2\nFF\n"
+             b"@read3\nA\n+\nF")
+
+    #WHEN scanning the fastq in chunks smaller than a record
+    records = [(name, bytes(record)) for name, record in
+               fastq_records(io.BytesIO(fastq), chunk_size=5)]
+
+    #THEN the read names are found, and the records are kept verbatim
+    assert [name for name, _ in records] == [b"read1", b"read2", b"read3"]
+    assert records[1][1] == b"@read2/1\nAC\n+read2\nFF\n"
+    assert b"".join(record for _, record in records) == fastq + b"\n"
+
+    #WHEN the last record is truncated
+    #THEN a ValueError is raised
+    with pytest.raises(ValueError):
+        list(fastq_records(io.BytesIO(fastq + b"\n@read4\nA\n")))
+
+def test_mapped_fastq_records(tmpdir):
+    """
+        Test function for mapped_fastq_records
+    """
+
+    #GIVEN an uncompressed fastq with a comment, a read suffix, and no final newline
+    fastq = (b"@read1 1:N:0:CGCGCATT\nACGT\n+\nFFFF\n"
+             b"@read2/1\nAC\n+read2\nFF\n"
+             b"@read3\nA\n+\nF")
+    fastq_file = tmpdir.join("mapped.fastq")
+    fastq_file.write_binary(fastq)
+
+    #WHEN scanning the fastq through a memory map
+    metrics = ScanMetrics()
+    records = [(name, bytes(record)) for name, record in
+               mapped_fastq_records(str(fastq_file), metrics)]
+
+    #THEN the records should be the same as when read in chunks
+    assert records == [(name, bytes(record)) for name, record in
+                       fastq_records(io.BytesIO(fastq), chunk_size=5)]
+    assert metrics.decompressed_bytes == len(fastq)
+
+    #THEN no reading time or read rate should be given, since the file is read in
+    #page faults while it is parsed
+    assert metrics.to_dict()["seconds"]["reading"] is None
+    assert metrics.to_dict()["read_bytes_per_second"] is None
+    assert not metrics.to_dict()["reading_timed"]
+
+def _bgzf_copy(fastq_file, tmpdir, block_size=97):
+    """
+        BGZF compresses a fastq file in small blocks
+    """
+    with open(fastq_file, 'rb') as handle:
+        fastq = handle.read()
+    bgzf_file = str(tmpdir.join(Path(fastq_file).name + ".gz"))
+    bgzf_handle = pysam.BGZFile(bgzf_file, 'wb')
+    for position in range(0, len(fastq), block_size):
+        bgzf_handle.write(fastq[position:position + block_size])
+        bgzf_handle.flush()
+    bgzf_handle.close()
+    return bgzf_file
+
+def test_fastq_extract_bgzf(tmpdir, monkeypatch):
+    """
+        Test function for fastq_extract with BGZF compressed fastq files
+    """
+
+    #GIVEN paired fastq files, BGZF compressed with blocks ending within records
+    #and at record boundaries
+    files = ['tests/fixtures/fastq1.fastq','tests/fixtures/fastq2.fastq']
+    bgzf_files = [_bgzf_copy(file, tmpdir) for file in files]
+
+    names = [name for name, _ in fastq_records(open(files[0], 'rb'))]
+    ids = [name.decode() for name in names[::3]]
+
+    #WHEN scanning each block as a range of its own, with several processes
+    monkeypatch.setattr("mutacc.utils.fastq_handler.BGZF_RANGE_SIZE", 1)
+    paths = fastq_extract(bgzf_files, ids, tmpdir.mkdir("bgzf_test"), workers=2)
+
+    #THEN the records found should be the same as when scanning uncompressed
+    #fastq files
+    serial_paths = fastq_extract(files, ids, tmpdir.mkdir("serial_test"))
+    for path, serial_path in zip(paths, serial_paths):
+        with gzip.open(path, 'rb') as handle, gzip.open(serial_path, 'rb') as serial_handle:
+            assert handle.read() == serial_handle.read()
+    with gzip.open(paths[0], 'rb') as handle:
+        assert [name for name, _ in fastq_records(handle)] == names[::3]
+
+def test_fastq_extract_bgzf_empty_blocks(tmpdir, monkeypatch):
+    """
+        Test function for fastq_extract with empty BGZF blocks between the blocks
+    """
+
+    #GIVEN a fastq file BGZF compressed with one record in each block, and an empty
+    #block after each block of data, like the end of file marker
+    fastq_file = 'tests/fixtures/fastq1.fastq'
+    bgzf_file = str(tmpdir.join("records.fastq.gz"))
+    bgzf_handle = pysam.BGZFile(bgzf_file, 'wb')
+    for _, record in fastq_records(open(fastq_file, 'rb')):
+        bgzf_handle.write(bytes(record))
+        bgzf_handle.flush()
+    bgzf_handle.close()
+    with open(bgzf_file, 'rb') as handle:
+        content = handle.read()
+    empty_block = content[-28:]
+    offsets = [offset for offset, size in bgzf_block_offsets(bgzf_file) if size]
+    with open(bgzf_file, 'wb') as handle:
+        for start, end in zip(offsets, offsets[1:] + [len(content) - 28]):
+            handle.write(content[start:end] + empty_block)
+
+    names = [name for name, _ in fastq_records(open(fastq_file, 'rb'))]
+    ids = [name.decode() for name in names]
+
+    #WHEN scanning each block as a range of its own, with several processes
+    monkeypatch.setattr("mutacc.utils.fastq_handler.BGZF_RANGE_SIZE", 1)
+    path = fastq_extract([bgzf_file], ids, tmpdir.mkdir("bgzf_test"), workers=2)[0]
+
+    #THEN each record should be found once, also those starting after an empty block
+    with gzip.open(path, 'rb') as handle:
+        assert [name for name, _ in fastq_records(handle)] == names
+
+@pytest.mark.parametrize("bgzf", [False, True])
+def test_fastq_extract_index(tmpdir, monkeypatch, bgzf):
+    """
+        Test function for fastq_extract with indexed fastq files
+    """
+
+    #GIVEN uncompressed or BGZF compressed fastq files without index
+    files = ['tests/fixtures/fastq1.fastq','tests/fixtures/fastq2.fastq']
+    index_dir = tmpdir.mkdir("index_fastqs")
+    if bgzf:
+        fastq_files = [_bgzf_copy(file, index_dir) for file in files]
+    else:
+        fastq_files = [shutil.copy(file, str(index_dir)) for file in files]
+    names = [name for name, _ in fastq_records(open(files[0], 'rb'))]
+    ids = [name.decode() for name in names[1::4]]
+
+    #WHEN extracting reads with index, with index entries sorted in several runs
+    monkeypatch.setattr("mutacc.utils.fastq_handler.INDEX_RUN_SIZE", 3)
+    paths = fastq_extract(fastq_files, ids, tmpdir.mkdir("index_test"), index=True)
+
+    #THEN later extractions should not scan the fastq files
+    def scan(*args):
+        raise AssertionError("fastq files scanned")
+    monkeypatch.setattr("mutacc.utils.fastq_handler._serial_extract", scan)
+    paths = fastq_extract(fastq_files, ids, tmpdir.mkdir("index_test_2"))
+
+    #THEN an index should be written next to each fastq file
+    for fastq_file in fastq_files:
+        with load_fastq_index(fastq_file) as fastq_index:
+            assert fastq_index.bgzf == bgzf
+            assert len(fastq_index.fingerprints) == len(names)
+            assert list(fastq_index.fingerprints) == sorted(fastq_index.fingerprints)
+
+    #THEN the records found should be the same as when scanning the fastq files
+    monkeypatch.undo()
+    serial_paths = fastq_extract(files, ids, tmpdir.mkdir("serial_test"))
+    for path, serial_path in zip(paths, serial_paths):
+        with gzip.open(path, 'rb') as handle, gzip.open(serial_path, 'rb') as serial_handle:
+            assert handle.read() == serial_handle.read()
+
+    #WHEN a fastq file is changed after it is indexed
+    with open(fastq_files[0], 'ab') as handle:
+        handle.write(b"")
+    os.utime(fastq_files[0], (0, 0))
+
+    #THEN the index should not be used
+    assert load_fastq_index(fastq_files[0]) is None
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_fastq_extract_lanes(tmpdir, workers):
+    """
+        Test function for fastq_extract_lanes
+    """
+
+    #GIVEN paired fastq files split in two lanes
+    files = ['tests/fixtures/fastq1.fastq','tests/fixtures/fastq2.fastq']
+    lanes = [[], []]
+    for file in files:
+        records = [bytes(record) for _, record in fastq_records(open(file, 'rb'))]
+        for lane_number, lane_records in enumerate((records[:5], records[5:])):
+            lane_file = tmpdir.join(f"L{lane_number}_{Path(file).name}")
+            lane_file.write_binary(b"".join(lane_records))
+            lanes[lane_number].append(str(lane_file))
+    names = [name for name, _ in fastq_records(open(files[0], 'rb'))]
+    ids = [name.decode() for name in names[::2]]
+
+    #WHEN extracting reads from the lanes
+    lane_metrics = []
+    out_dir = tmpdir.mkdir("lanes_test")
+    paths = fastq_extract_lanes(lanes, ids, out_dir, workers=workers,
+                                metrics_callback=lane_metrics.append)
+
+    #THEN the reads should be the same, in the same order, as when extracted from
+    #the whole fastq files
+    serial_paths = fastq_extract(files, ids, tmpdir.mkdir("serial_test"))
+    for path, serial_path in zip(paths, serial_paths):
+        with gzip.open(path, 'rb') as handle, gzip.open(serial_path, 'rb') as serial_handle:
+            assert handle.read() == serial_handle.read()
+
+    #THEN one fastq file per read end should be left, named without the lane tags,
+    #with the metrics of all lanes
+    assert len(out_dir.listdir("*.fastq.gz")) == 2
+    assert [Path(path).name for path in paths] == ["fastq1_mutacc.fastq.gz",
+                                                   "fastq2_mutacc.fastq.gz"]
+    assert lane_metrics[0].matches == 2 * len(ids)
+
+
+def test_merged_lane_names():
+
+    #GIVEN the fastq files of two lanes, named with lane tags
+    lanes = [["sample_L001_R1_001.fastq.gz", "sample_L001_R2_001.fastq.gz"],
+             ["sample_L002_R1_001.fastq.gz", "sample_L002_R2_001.fastq.gz"]]
+
+    #THEN the merged fastq files should be named without the lane tags
+    assert merged_names(lanes) == ["sample_R1_001", "sample_R2_001"]
+
+    #GIVEN lanes of different flowcells, with the read end after the lane tag
+    lanes = [["/fc1/FC1_1_R1.fastq.gz", "/fc1/FC1_1_R2.fastq.gz"],
+             ["/fc2/FC2_2_R1.fastq.gz", "/fc2/FC2_2_R2.fastq.gz"]]
+
+    #THEN the read end should be kept in the names
+    assert merged_names(lanes) == ["FC_R1", "FC_R2"]
+
+
+@pytest.mark.parametrize("suffix", [".fastq", ".fastq.gz"])
+def test_fastq_exclude(tmpdir, suffix):
+    """
+        Test function for fastq_exclude
+    """
+
+    # GIVEN a background fastq file, read names to exclude and a variant fastq file
+    background = 'tests/fixtures/fastq1.fastq'
+    with open(background, 'r') as handle:
+        records = list(SeqIO.parse(handle, 'fastq'))
+    excluded_ids = {record.id for record in records[:5]}
+
+    out_dir = tmpdir.mkdir("exclude_test")
+    variants = str(out_dir.join("variants.fastq.gz"))
+    with gzip.open(variants, 'wt') as handle:
+        SeqIO.write(records[:2], handle, 'fastq')
+
+    # WHEN excluding the reads, and appending the variant reads
+    out_path = Path(str(out_dir.join("synthetic" + suffix)))
+    excluded_path = Path(str(out_dir.join("background" + suffix)))
+    excluded = fastq_exclude(background, excluded_ids, out_path,
+                             append_files=[variants], excluded_path=excluded_path)
+
+    # THEN the excluded reads are missing from the background, and the variant
+    # reads are found after the remaining background reads
+    def read_ids(path):
+        handle = gzip.open(path, 'rt') if suffix.endswith('.gz') else open(path, 'r')
+        with handle:
+            return [record.id for record in SeqIO.parse(handle, 'fastq')]
+
+    remaining = [record.id for record in records if record.id not in excluded_ids]
+    assert excluded == 5
+    assert read_ids(excluded_path) == remaining
+    assert read_ids(out_path) == remaining + [record.id for record in records[:2]]
+
+
+def test_fastq_writer_threads(tmpdir, monkeypatch):
+
+    # GIVEN a gzip writer recording the threads given to each output file
+    writer_threads = []
+    def writer(out_file, threads=1, mode='wt'):
+        writer_threads.append(threads)
+        return gzip.open(out_file, mode)
+    monkeypatch.setattr("mutacc.utils.fastq_handler.gzip_writer", writer)
+    files = ['tests/fixtures/fastq1.fastq', 'tests/fixtures/fastq2.fastq']
+
+    # WHEN extracting reads to one file per read end with four threads
+    fastq_extract(files, [], tmpdir.mkdir("extract"), threads=4)
+
+    # THEN the threads should be shared by the read ends
+    assert writer_threads == [2, 2]
+
+    # WHEN excluding reads from a background, also written without exclusions
+    writer_threads.clear()
+    out_dir = tmpdir.mkdir("exclude")
+    fastq_exclude(files[0], [], Path(str(out_dir.join("synthetic.fastq.gz"))), threads=4,
+                  excluded_path=Path(str(out_dir.join("background.fastq.gz"))))
+
+    # THEN the threads should be shared by both output files
+    assert writer_threads == [2, 2]
+
+
+@pytest.mark.parametrize("search", [True, False])
+def test_fastq_exclude_shards(tmpdir, search):
+
+    # GIVEN a fastq file split into three shards
+    background = 'tests/fixtures/fastq1.fastq'
+    with open(background, 'r') as handle:
+        records = list(SeqIO.parse(handle, 'fastq'))
+    shard_of_record = {record.id.encode(): index % 3 for index, record in enumerate(records)}
+    out_dir = tmpdir.mkdir("shards_test")
+    sharded = Path(str(out_dir.join("sharded.fastq.gz")))
+    members = write_fastq_shards(background, shard_of_record.get, sharded, tmp_dir=str(out_dir))
+    shards = [(*members[shard], search or shard == 1) for shard in sorted(members)]
+
+    # WHEN excluding reads of every shard
+    excluded_ids = {record.id for record in records[:6]}
+    out_path = Path(str(out_dir.join("synthetic.fastq.gz")))
+    excluded_path = Path(str(out_dir.join("background.fastq.gz")))
+    excluded = fastq_exclude_shards(sharded, excluded_ids, out_path, shards,
+                                    excluded_path=excluded_path, threads=2)
+
+    # THEN the reads should be excluded from the searched shards only, and each
+    # record of the other shards should be kept once
+    with gzip.open(out_path, 'rt') as handle:
+        out_ids = [record.id for record in SeqIO.parse(handle, 'fastq')]
+    with gzip.open(excluded_path, 'rt') as handle:
+        assert [record.id for record in SeqIO.parse(handle, 'fastq')] == out_ids
+    searched = {shard for shard in members if search or shard == 1}
+    kept = [record.id for record in records
+            if record.id not in excluded_ids or shard_of_record[record.id.encode()] not in searched]
+    assert sorted(out_ids) == sorted(kept)
+    assert excluded == len(records) - len(kept)
+
+    # THEN an output that is not gzip compressed should be refused
+    with pytest.raises(ValueError):
+        fastq_exclude_shards(sharded, excluded_ids, out_path, shards,
+                             excluded_path=Path(str(out_dir.join("background.fastq"))))
@@ -0,0 +1,148 @@
+from mutacc.utils import read_names
+from mutacc.utils.read_names import ReadNameBins, ReadNameSet, route_read_names
+
+READ_NAMES = [f"ST-E00266:38:H2TF5CCXX:8:1101:{index}:2170" for index in range(1000)]
+
+
+def test_ReadNameSet(monkeypatch):
+
+    # GIVEN a set small enough to sort fingerprints into several runs
+    monkeypatch.setattr(read_names, "PENDING_SIZE", 64)
+
+    # WHEN adding read names, some of them twice
+    name_set = ReadNameSet(READ_NAMES)
+    assert not name_set.add(READ_NAMES[0])
+    assert not name_set.add(READ_NAMES[500].encode())
+
+    # THEN each name should be counted once, and be found as str or bytes
+    assert len(name_set) == len(READ_NAMES)
+    assert all(read_name in name_set for read_name in READ_NAMES)
+    assert READ_NAMES[10].encode() in name_set
+    assert "ST-E00266:38:H2TF5CCXX:8:1101:1000:2170" not in name_set
+
+
+def test_ReadNameSet_names(monkeypatch):
+
+    # GIVEN a limit on the number of names kept by a small set
+    monkeypatch.setattr(read_names, "SMALL_SET_SIZE", 10)
+
+    # WHEN adding names up to the limit
+    name_set = ReadNameSet(READ_NAMES[:10])
+
+    # THEN the names should be given as a frozenset of bytes
+    assert name_set.names() == frozenset(read_name.encode() for read_name in READ_NAMES[:10])
+
+    # WHEN adding names past the limit
+    name_set.add(READ_NAMES[10])
+
+    # THEN the names should no longer be kept
+    assert name_set.names() is None
+    assert READ_NAMES[10] in name_set
+
+
+def test_ReadNameSet_collisions(monkeypatch):
+
+    # GIVEN a fingerprint function that gives all names the same fingerprint
+    fingerprint = read_names.fingerprint
+    monkeypatch.setattr(
+        read_names, "fingerprint", lambda read_name: (1, fingerprint(read_name)[1])
+    )
+
+    # WHEN adding names
+    name_set = ReadNameSet(READ_NAMES[:3])
+
+    # THEN the names should still be told apart
+    assert len(name_set) == 3
+    assert all(read_name in name_set for read_name in READ_NAMES[:3])
+    assert READ_NAMES[3] not in name_set
+
+
+def test_ReadNameSet_spill(tmpdir, monkeypatch):
+
+    # GIVEN a memory limit lower than the number of names
+    monkeypatch.setattr(read_names, "PENDING_SIZE", 64)
+    monkeypatch.setattr(read_names, "MEMORY_LIMIT", 200)
+    spill_dir = tmpdir.mkdir("spill")
+
+    # WHEN adding the names to a set with a spill directory
+    with ReadNameSet(READ_NAMES, spill_dir=spill_dir) as name_set:
+
+    # THEN the names should be spilled to run files
+        assert len(spill_dir.listdir()) > 1
+        assert not name_set.add(READ_NAMES[0])
+
+    # THEN the run files should be merged when the set is queried
+        assert all(read_name in name_set for read_name in READ_NAMES)
+        assert "ST-E00266:38:H2TF5CCXX:8:1101:1000:2170" not in name_set
+        assert len(spill_dir.listdir()) == 1
+        assert len(name_set) == len(READ_NAMES)
+
+    # THEN the run files should be removed when the set is closed
+    assert not spill_dir.listdir()
+
+
+def test_ReadNameSet_merge(tmpdir, monkeypatch):
+
+    # GIVEN sets of read names, one spilled to disk, and a set of names as bytes
+    monkeypatch.setattr(read_names, "PENDING_SIZE", 64)
+    monkeypatch.setattr(read_names, "MEMORY_LIMIT", 200)
+    spill_dir = tmpdir.mkdir("spill")
+    spilled_set = ReadNameSet(READ_NAMES[:600], spill_dir=spill_dir)
+    name_sets = [spilled_set, ReadNameSet(READ_NAMES[400:800]),
+                 {read_name.encode() for read_name in READ_NAMES[800:900]}]
+
+    # WHEN merging the sets
+    with ReadNameSet.merge(name_sets, spill_dir=spill_dir) as merged:
+
+    # THEN the fingerprints of the names in any set should be found once
+        assert len(merged) == 900
+        assert all(merged.has_fingerprint(read_names.fingerprint(read_name.encode())[0])
+                   for read_name in READ_NAMES[:900])
+        assert not any(merged.has_fingerprint(read_names.fingerprint(read_name.encode())[0])
+                       for read_name in READ_NAMES[900:])
+    spilled_set.close()
+    assert not spill_dir.listdir()
+
+
+def test_route_read_names():
+
+    # GIVEN read names in two read groups sequenced in separate lanes, and
+    # read names without read group
+    read_group_names = {
+        "lane1": ReadNameSet(READ_NAMES[:400]),
+        "lane2": ReadNameSet(READ_NAMES[400:900]),
+        None: ReadNameSet(READ_NAMES[900:]),
+    }
+
+    # WHEN routing the names to the lanes
+    lane_names = route_read_names(read_group_names, [["lane1"], ["lane2"], ["lane3"]])
+
+    # THEN each lane should get the names of its read group, and the names
+    # without read group
+    assert len(lane_names[0]) == 500
+    assert READ_NAMES[0] in lane_names[0] and READ_NAMES[950] in lane_names[0]
+    assert READ_NAMES[500] not in lane_names[0]
+    assert len(lane_names[1]) == 600
+    assert len(lane_names[2]) == 100
+    assert len(list(lane_names[1].fingerprints())) == 600
+
+
+def test_ReadNameBins(tmpdir, monkeypatch):
+
+    # GIVEN a map small enough to sort into several runs
+    monkeypatch.setattr(read_names, "RUN_SIZE", 64)
+
+    # WHEN adding each read name in two bins, and saving the map
+    map_file = str(tmpdir.join("names.bins"))
+    with ReadNameBins(spill_dir=str(tmpdir)) as name_bins:
+        for index, read_name in enumerate(READ_NAMES):
+            name_bins.add(read_name, index + 10)
+            name_bins.add(read_name.encode(), index)
+        name_bins.save(map_file)
+
+    # THEN each name is found in its lowest bin, and no run file is left
+    with ReadNameBins.load(map_file) as name_bins:
+        assert all(name_bins.get(read_name) == index
+                   for index, read_name in enumerate(READ_NAMES))
+        assert name_bins.get("not_a_read", -1) == -1
+    assert tmpdir.listdir() == [tmpdir.join("names.bins")]
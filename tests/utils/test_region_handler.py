@@ -1,6 +1,6 @@
 import pytest
 
-from mutacc.utils.region_handler import overlaps, overlapping_region
+from mutacc.utils.region_handler import overlaps, overlapping_region, merge_regions
 
 REG1 = {
     "start": 100000000,
@@ -32,3 +32,19 @@ def test_overlapping_region():
 
     assert overlapping_region(REG1, region_list)
     assert not overlapping_region(REG1, [REG3])
+
+def test_merge_regions():
+
+    regions = [
+        ('chr4', 100, 200),
+        ('chr4', 150, 300),
+        ('chr4', 300, 400),
+        ('chr4', 500, 600),
+        ('chr7', 100, 200),
+    ]
+
+    assert merge_regions(regions) == [
+        ('chr4', 100, 400),
+        ('chr4', 500, 600),
+        ('chr7', 100, 200),
+    ]